@@ -1,11 +1,19 @@
 import logging
 
-from pub_sub_consummer.ai_assistant_consumer import AiAssistantConsumer
+from monitoring.startup import get_startup_profile
 
 if __name__ == "__main__":
-    ai_assistant = AiAssistantConsumer()
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        format='%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s'
     )
-    ai_assistant.consume()
\ No newline at end of file
+    startup = get_startup_profile()
+    with startup.stage("env"):
+        from dotenv import load_dotenv
+        load_dotenv()
+    with startup.stage("import"):
+        from pub_sub_consummer.ai_assistant_consumer import AiAssistantConsumer
+        from pub_sub_consummer.supervisor import run_workers
+
+    # One consumer in this process, or WORKER_PROCESSES forked workers sharing the model
+    run_workers(AiAssistantConsumer)
\ No newline at end of file
@@ -0,0 +1,87 @@
+import random
+from typing import Any, Dict, List
+
+_CONSONANTS = "bcdfghklmnprstvz"
+_VOWELS = "aeiou"
+
+
+def _word(rng: random.Random) -> str:
+    return "".join(rng.choice(_CONSONANTS) + rng.choice(_VOWELS) for _ in range(rng.randint(1, 4)))
+
+
+def _sentence(rng: random.Random, vocabulary: List[str]) -> str:
+    words = [rng.choice(vocabulary) for _ in range(rng.randint(6, 24))]
+
+    # Exact identifiers are what dense retrieval tends to miss
+    roll = rng.random()
+    if roll < 0.05:
+        words.insert(rng.randrange(len(words)), f"SKU-{rng.randint(10000, 99999)}")
+    elif roll < 0.08:
+        words.insert(rng.randrange(len(words)), f"ERR_{rng.randint(100, 999)}")
+
+    return " ".join(words).capitalize() + rng.choice(".!?.")
+
+
+def generate_documents(count: int, accounts: int = 4, words_per_document: int = 800,
+                       vocabulary_size: int = 5000, seed: int = 42) -> List[Dict[str, Any]]:
+    """
+    Generate a reproducible corpus of pseudo-word documents
+
+    Parameters:
+        count: Number of documents
+        accounts: Number of accounts the documents are spread over
+        words_per_document: Approximate length of every document, in words
+        vocabulary_size: Number of distinct pseudo-words
+        seed: Seed of the random generator; the same seed gives the same corpus
+
+    Returns:
+        Documents with 'id', 'account_id', 'name' and 'text'
+    """
+    rng = random.Random(seed)
+    vocabulary = [_word(rng) for _ in range(vocabulary_size)]
+
+    documents = []
+    for document_id in range(1, count + 1):
+        sentences = []
+        words = 0
+        while words < words_per_document:
+            sentence = _sentence(rng, vocabulary)
+            sentences.append(sentence)
+            words += sentence.count(" ") + 1
+
+        # Paragraph breaks, so the chunker sees realistic whitespace
+        text = "".join(s + ("\n\n" if rng.random() < 0.15 else " ") for s in sentences).strip()
+        documents.append({
+            "id": document_id,
+            "account_id": document_id % accounts + 1,
+            "name": f"Document {document_id}",
+            "text": text
+        })
+    return documents
+
+
+def generate_queries(documents: List[Dict[str, Any]], count: int, seed: int = 42) -> List[Dict[str, Any]]:
+    """
+    Generate queries taken from the documents, so every query has a known relevant document
+
+    Parameters:
+        documents: The corpus
+        count: Number of queries
+        seed: Seed of the random generator
+
+    Returns:
+        Queries with 'text', 'account_id' and the 'document_id' they were taken from
+    """
+    rng = random.Random(seed)
+
+    queries = []
+    for _ in range(count):
+        document = rng.choice(documents)
+        words = document["text"].split()
+        start = rng.randrange(max(len(words) - 12, 1))
+        queries.append({
+            "text": " ".join(words[start:start + rng.randint(4, 12)]),
+            "account_id": document["account_id"],
+            "document_id": document["id"]
+        })
+    return queries
@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import numpy as np
+
+_TOKEN = re.compile(r"\w+")
+
+
+class FakeEmbeddingProvider:
+    """
+    A deterministic stand-in for EmbeddingProvider that needs no model download.
+    Texts are embedded by hashing their words into a fixed number of signed buckets, so that
+    texts sharing words are close; the cost of the real model is optionally simulated per text.
+    """
+
+    def __init__(self, dimension: int = 384, max_seq_length: int = 256, seconds_per_text: float = 0.0):
+        """
+        Initialize the fake provider
+
+        Parameters:
+            dimension: Size of the embeddings
+            max_seq_length: Number of tokens the simulated model reads
+            seconds_per_text: Time spent per encoded text, to approximate a real model
+        """
+        self.dimension = dimension
+        self.max_seq_length = max_seq_length
+        self.chunk_token_limit = max_seq_length - 2
+        self.seconds_per_text = seconds_per_text
+        self.model_name = "fake-hashing-embeddings"
+        self._lock = threading.Lock()
+
+    def load(self):
+        pass
+
+    def warmup(self):
+        pass
+
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        return len(_TOKEN.findall(text))
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in _TOKEN.findall(text.lower()):
+                digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dimension
+                embeddings[row, bucket] += 1.0 if digest[4] & 1 else -1.0
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.where(norms > 0, norms, 1.0)
+
+        if self.seconds_per_text:
+            # Like the real model, encoding holds a lock and blocks its thread
+            with self._lock:
+                time.sleep(self.seconds_per_text * len(texts))
+        return embeddings
+
+    async def embed_async(self, texts: List[str]) -> np.ndarray:
+        return await asyncio.get_running_loop().run_in_executor(None, self.embed, texts)
+
+
+class InMemoryDatabase:
+    """
+    An in-process stand-in for DatabaseConnector, ranking chunks by brute-force cosine distance.
+    It implements the methods the consumers, the retriever and the vector backends call.
+    """
+
+    def __init__(self):
+        self.documents: Dict[int, Dict[str, Any]] = {}
+        self.chunks: Dict[str, Dict[str, Any]] = {}
+        self.chats: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        self.summaries: Dict[int, Tuple[int, Optional[str], str]] = {}
+        self._matrices: Dict[int, Tuple[List[str], np.ndarray]] = {}
+
+    def add_document(self, document_id: int, account_id: int, name: str, text: str):
+        """Insert a document row, as the API would before requesting its indexing"""
+        self.documents[document_id] = {
+            "id": document_id, "account_id": account_id, "name": name, "text": text, "embedding": None
+        }
+
+    async def store_document_indexes(self, documents: List[Tuple[int, np.ndarray, List[Dict[str, Any]], np.ndarray]],
+                                     replace_chunks: bool = False) -> Dict[int, int]:
+        stored = {}
+        for document_id, embedding, chunks, chunk_embeddings in documents:
+            document = self.documents.get(document_id)
+            if document is None:
+                continue
+
+            document["embedding"] = np.asarray(embedding, dtype=np.float32)
+            for chunk_id in [c for c, chunk in self.chunks.items() if chunk["id"] == document_id]:
+                del self.chunks[chunk_id]
+            for chunk, chunk_embedding in zip(chunks, chunk_embeddings):
+                self.chunks[chunk["chunk_id"]] = {
+                    "chunk_id": chunk["chunk_id"],
+                    "id": document_id,
+                    "chunk_index": chunk["chunk_index"],
+                    "text": chunk["text"],
+                    "content_hash": chunk["content_hash"],
+                    "account_id": document["account_id"],
+                    "embedding": np.asarray(chunk_embedding, dtype=np.float32)
+                }
+            self._matrices.pop(document["account_id"], None)
+            stored[document_id] = document["account_id"]
+        return stored
+
+    async def iter_documents(self, after_id: int = 0, account_id: Optional[int] = None,
+                             batch_size: int = 1000) -> AsyncIterator[List[Tuple[int, int, str]]]:
+        rows = [
+            (document["id"], document["account_id"], document["text"])
+            for document in sorted(self.documents.values(), key=lambda d: d["id"])
+            if document["id"] > after_id and account_id in (None, document["account_id"])
+        ]
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+    async def get_chunk_embeddings_by_hash(self, document_id: int, content_hashes: List[str]) -> Dict[str, np.ndarray]:
+        account_id = self.documents[document_id]["account_id"]
+        wanted = set(content_hashes)
+        return {
+            chunk["content_hash"]: chunk["embedding"]
+            for chunk in self.chunks.values()
+            if chunk["account_id"] == account_id and chunk["content_hash"] in wanted
+        }
+
+    async def rank_documents_by_embedding(self, query_embedding: np.ndarray, account_id: int, top_k: int = 5,
+                                          ef_search: Optional[int] = None,
+                                          probes: Optional[int] = None) -> List[Tuple[int, float]]:
+        documents = [d for d in self.documents.values() if d["account_id"] == account_id and d["embedding"] is not None]
+        if not documents:
+            return []
+
+        distances = 1.0 - np.stack([d["embedding"] for d in documents]) @ query_embedding
+        best = np.argsort(distances)[:top_k]
+        return [(documents[i]["id"], float(distances[i])) for i in best]
+
+    async def rank_documents_by_embeddings(self, queries: List[Tuple[np.ndarray, int, int]]) -> List[List[Tuple[int, float]]]:
+        return [await self.rank_documents_by_embedding(*query) for query in queries]
+
+    async def rank_documents_by_text(self, query_text: str, account_id: int, top_k: int = 5) -> List[Tuple[int, float]]:
+        documents = [d for d in self.documents.values() if d["account_id"] == account_id]
+        ranked = self._rank_by_text(query_text, documents, lambda d: f"{d['name']} {d['text']}")
+        return [(document["id"], rank) for document, rank in ranked[:top_k]]
+
+    async def hydrate_documents(self, document_ids: List[int], account_id: int,
+                                max_chars: Optional[int] = None) -> Dict[int, Tuple[str, str]]:
+        return {
+            document_id: (self.documents[document_id]["name"], self.documents[document_id]["text"][:max_chars])
+            for document_id in document_ids
+            if document_id in self.documents and self.documents[document_id]["account_id"] == account_id
+        }
+
+    async def rank_chunks_by_embedding(self, query_embedding: np.ndarray, account_id: int, top_k: int = 5,
+                                       with_embeddings: bool = False, ef_search: Optional[int] = None,
+                                       probes: Optional[int] = None) -> List[Tuple[str, int, float, Optional[np.ndarray]]]:
+        chunk_ids, document_ids, matrix = await self.get_account_chunk_embeddings(account_id)
+        if not chunk_ids:
+            return []
+
+        distances = 1.0 - matrix @ query_embedding
+        count = min(top_k, len(chunk_ids))
+        best = np.argpartition(distances, count - 1)[:count]
+        best = best[np.argsort(distances[best])]
+        return [
+            (chunk_ids[i], document_ids[i], float(distances[i]), matrix[i].copy() if with_embeddings else None)
+            for i in best
+        ]
+
+    async def rank_chunks_by_embeddings(self, queries: List[Tuple[np.ndarray, int, int, bool]]
+                                        ) -> List[List[Tuple[str, int, float, Optional[np.ndarray]]]]:
+        return [await self.rank_chunks_by_embedding(*query) for query in queries]
+
+    async def rank_chunks_by_text(self, query_text: str, account_id: int, top_k: int = 5,
+                                  with_embeddings: bool = False) -> List[Tuple[str, int, float, Optional[np.ndarray]]]:
+        chunks = [c for c in self.chunks.values() if c["account_id"] == account_id]
+        ranked = self._rank_by_text(query_text, chunks, lambda c: c["text"])
+        return [
+            (chunk["chunk_id"], chunk["id"], rank, chunk["embedding"] if with_embeddings else None)
+            for chunk, rank in ranked[:top_k]
+        ]
+
+    async def hydrate_chunks(self, chunk_ids: List[str], account_id: int,
+                             max_chars: Optional[int] = None) -> Dict[str, Tuple[int, str, str]]:
+        hydrated = {}
+        for chunk_id in chunk_ids:
+            chunk = self.chunks.get(chunk_id)
+            if chunk is not None and chunk["account_id"] == account_id:
+                name = self.documents[chunk["id"]]["name"]
+                hydrated[chunk_id] = (chunk["chunk_index"], name, chunk["text"][:max_chars])
+        return hydrated
+
+    async def get_account_chunk_embeddings(self, account_id: int) -> Tuple[List[str], List[int], np.ndarray]:
+        if account_id not in self._matrices:
+            chunks = [c for c in self.chunks.values() if c["account_id"] == account_id]
+            matrix = np.stack([c["embedding"] for c in chunks]) if chunks else np.zeros((0, 0), dtype=np.float32)
+            self._matrices[account_id] = ([c["chunk_id"] for c in chunks], matrix)
+
+        chunk_ids, matrix = self._matrices[account_id]
+        return chunk_ids, [self.chunks[chunk_id]["id"] for chunk_id in chunk_ids], matrix
+
+    async def add_message_to_chat(self, chat_id: int, message: Dict[str, Any]):
+        self.chats[chat_id].append(message)
+
+    async def upsert_chat_message(self, chat_id: int, message: Dict[str, Any]):
+        messages = self.chats[chat_id]
+        for i, existing in enumerate(messages):
+            if existing.get("id") == message.get("id"):
+                messages[i] = message
+                return
+        messages.append(message)
+
+    async def get_recent_chat_messages(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        return list(self.chats[chat_id][-limit:])
+
+    async def get_chat_summary(self, chat_id: int) -> Optional[Tuple[int, Optional[str], str]]:
+        return self.summaries.get(chat_id)
+
+    async def store_chat_summary(self, chat_id: int, message_count: int, last_message_id: Optional[str],
+                                 summary: str):
+        self.summaries[chat_id] = (message_count, last_message_id, summary)
+
+    async def listen(self, channel: str) -> AsyncIterator[str]:
+        # Nothing else writes to this database, so no notification ever arrives
+        await asyncio.Event().wait()
+        yield ""
+
+    @staticmethod
+    def _rank_by_text(query_text: str, rows: List[Dict[str, Any]], text_of) -> List[Tuple[Dict[str, Any], float]]:
+        terms = set(_TOKEN.findall(query_text.lower()))
+        ranked = []
+        for row in rows:
+            words = _TOKEN.findall(text_of(row).lower())
+            matches = sum(1 for word in words if word in terms)
+            if matches:
+                ranked.append((row, matches / len(words)))
+        ranked.sort(key=lambda item: item[1], reverse=True)
+        return ranked
+
+
+class FakeMessage:
+    """A stand-in for a received Pub/Sub message that records when it is settled"""
+
+    def __init__(self, message_id: str, data: bytes):
+        self.message_id = message_id
+        self.data = data
+        self.acked: Optional[bool] = None
+        self.settled = threading.Event()
+
+    def ack(self):
+        self.acked = True
+        self.settled.set()
+
+    def nack(self):
+        self.acked = False
+        self.settled.set()
+
+
+class FakeSubscriber:
+    """A stand-in for pubsub_v1.SubscriberClient; messages are delivered by calling the consumer callback directly"""
+
+    def subscription_path(self, project_id: Optional[str], subscription_id: str) -> str:
+        return f"projects/{project_id}/subscriptions/{subscription_id}"
+
+    def subscribe(self, subscription_path: str, callback, flow_control=None) -> Future:
+        return Future()
+
+    def close(self):
+        pass
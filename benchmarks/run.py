@@ -0,0 +1,271 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Tuple
+
+from benchmarks.corpus import generate_documents, generate_queries
+from benchmarks.fakes import FakeEmbeddingProvider, FakeMessage, FakeSubscriber, InMemoryDatabase
+from benchmarks.stats import StageTimer, compare
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of chunking, embedding, search and answering")
+    parser.add_argument("--documents", type=int, default=200, help="Number of synthetic documents")
+    parser.add_argument("--words-per-document", type=int, default=800, help="Approximate document length")
+    parser.add_argument("--accounts", type=int, default=4, help="Number of accounts the documents are spread over")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries and chat messages")
+    parser.add_argument("--top-k", type=int, default=5, help="Passages retrieved per query")
+    parser.add_argument("--mode", default="vector", help="Retrieval mode: vector, lexical or hybrid")
+    parser.add_argument("--backend", default="postgres", help="Vector backend, ranking through the (in-memory) "
+                                                               "database connector or with mmap files")
+    parser.add_argument("--embeddings", choices=("fake", "model"), default="fake",
+                        help="Hashing stand-in, or the real EMBEDDING_MODEL_NAME model (must be available locally)")
+    parser.add_argument("--fake-encode-ms", type=float, default=0.0, help="Simulated encoding time per text")
+    parser.add_argument("--llm-first-token-ms", type=float, default=300.0, help="Fake Gemini time to first token")
+    parser.add_argument("--llm-chunk-ms", type=float, default=20.0, help="Fake Gemini time between chunks")
+    parser.add_argument("--concurrency", type=int, default=8, help="Messages processed at the same time")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic corpus and queries")
+    parser.add_argument("--output", help="Result file, defaults to benchmarks/results/<time>-<commit>.json")
+    parser.add_argument("--compare", help="Earlier result file to compare with")
+    return parser.parse_args()
+
+
+def install_stand_ins(args) -> InMemoryDatabase:
+    """Replace the shared database, model and LLM of the process with offline stand-ins"""
+    from db.connector import DatabaseConnector
+    from llm.fake_gemini import FakeGeminiModel
+    from llm.gemini_client import GeminiClient
+    from vector_store.embeddings import EmbeddingProvider
+
+    db = InMemoryDatabase()
+    DatabaseConnector._instance = db
+
+    if args.embeddings == "fake":
+        EmbeddingProvider._instance = FakeEmbeddingProvider(seconds_per_text=args.fake_encode_ms / 1000)
+
+    GeminiClient._instance = GeminiClient(FakeGeminiModel(
+        reply="This synthetic answer stands in for a Gemini response of realistic length. " * 8,
+        first_token_delay=args.llm_first_token_ms / 1000,
+        chunk_delay=args.llm_chunk_ms / 1000
+    ))
+
+    os.environ["RETRIEVAL_BACKEND"] = args.backend
+    os.environ.setdefault("VECTOR_INDEX_DIR", tempfile.mkdtemp(prefix="rag-benchmark-"))
+    os.environ["RETRIEVAL_MODE"] = args.mode
+    return db
+
+
+def bench_chunking(documents: List[Dict[str, Any]], provider) -> StageTimer:
+    from vector_store.chunking import chunk_document
+
+    timer = StageTimer("chunking")
+    timer.start()
+    for document in documents:
+        with timer.measure():
+            chunk_document({'document_id': document["id"], 'document_text': document["text"]},
+                           provider.chunk_token_limit, 32, provider.count_tokens)
+    timer.stop()
+    return timer
+
+
+def bench_embedding(documents: List[Dict[str, Any]], provider) -> StageTimer:
+    from vector_store.chunking import chunk_document
+
+    chunked = [
+        [chunk['text'] for chunk in chunk_document({'document_id': d["id"], 'document_text': d["text"]},
+                                                    provider.chunk_token_limit, 32, provider.count_tokens)]
+        for d in documents
+    ]
+
+    timer = StageTimer("embedding")
+    provider.warmup()
+    timer.start()
+    for texts in chunked:
+        with timer.measure(len(texts)):
+            provider.embed(texts)
+    timer.stop()
+    return timer
+
+
+async def bench_indexing(consumer, documents: List[Dict[str, Any]], concurrency: int) -> StageTimer:
+    timer = StageTimer("indexing")
+    limit = asyncio.Semaphore(concurrency)
+
+    async def index(document):
+        async with limit:
+            with timer.measure():
+                await consumer.callback({"document_id": document["id"], "document_text": document["text"]})
+
+    timer.start()
+    await asyncio.gather(*(index(document) for document in documents))
+    timer.stop()
+    return timer
+
+
+async def bench_search(db, retriever, queries: List[Dict[str, Any]], top_k: int,
+                       mode: str) -> Tuple[List[StageTimer], float]:
+    """
+    Time ranking with precomputed query embeddings, then the full retrieval path with its caches.
+    Also returns the share of queries whose source document is among the retrieved passages.
+    """
+    embeddings = retriever.embeddings.embed([query["text"] for query in queries])
+
+    document_search = StageTimer("document_search")
+    passage_search = StageTimer("passage_search")
+    retrieval = StageTimer("retrieval")
+    hits = 0
+
+    for timer, search in (
+        (document_search, lambda q, e: db.rank_documents_by_embedding(e, q["account_id"], top_k)),
+        (passage_search, lambda q, e: retriever.backend.rank_chunks(e, q["account_id"], top_k)),
+    ):
+        timer.start()
+        for query, embedding in zip(queries, embeddings):
+            with timer.measure():
+                await search(query, embedding)
+        timer.stop()
+
+    retrieval.start()
+    for query in queries:
+        with retrieval.measure():
+            passages = await retriever.retrieve_passages(query["text"], query["account_id"], top_k, mode=mode)
+        hits += any(passage.document_id == query["document_id"] for passage in passages)
+    retrieval.stop()
+
+    return [document_search, passage_search, retrieval], hits / len(queries)
+
+
+def bench_end_to_end(consumer, queries: List[Dict[str, Any]], concurrency: int,
+                     first_writes: Dict[int, float]) -> List[StageTimer]:
+    """Deliver chat messages through the Pub/Sub callback and time them until they are acked"""
+    answer = StageTimer("end_to_end")
+    first_token = StageTimer("time_to_first_token")
+
+    loop_thread = threading.Thread(target=consumer.loop.run_forever, daemon=True)
+    loop_thread.start()
+
+    def deliver(chat_id: int, query: Dict[str, Any]):
+        data = json.dumps({
+            "chat_id": chat_id,
+            "account_id": query["account_id"],
+            "messages": [{"id": f"msg{chat_id}", "sender": "user", "text": query["text"]}]
+        }).encode("utf-8")
+        message = FakeMessage(str(chat_id), data)
+
+        delivered_at = time.perf_counter()
+        consumer.wrapped_callback(message)
+        message.settled.wait()
+        answer.record(time.perf_counter() - delivered_at)
+        if chat_id in first_writes:
+            first_token.record(first_writes[chat_id] - delivered_at)
+
+    answer.start()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(deliver, range(1, len(queries) + 1), queries))
+    answer.stop()
+
+    consumer.loop.call_soon_threadsafe(consumer.loop.stop)
+    loop_thread.join()
+    return [answer, first_token]
+
+
+def shutdown_loop(loop: asyncio.AbstractEventLoop):
+    """Cancel the background tasks left on a consumer loop, such as the retriever's notification listener"""
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    db = install_stand_ins(args)
+
+    from llm.response_sinks import ChatMessageSink
+    from llm.retrieval import get_document_retriever
+    from pub_sub_consummer.ai_assistant_consumer import AiAssistantConsumer
+    from pub_sub_consummer.document_indexing_consumer import DocumentIndexingConsumer
+    from vector_store.embeddings import get_embedding_provider
+
+    documents = generate_documents(args.documents, args.accounts, args.words_per_document, seed=args.seed)
+    queries = generate_queries(documents, args.queries, seed=args.seed)
+    for document in documents:
+        db.add_document(document["id"], document["account_id"], document["name"], document["text"])
+
+    provider = get_embedding_provider()
+    timers = [bench_chunking(documents, provider), bench_embedding(documents, provider)]
+
+    indexing_consumer = DocumentIndexingConsumer(subscriber=FakeSubscriber())
+    timers.append(indexing_consumer.loop.run_until_complete(
+        bench_indexing(indexing_consumer, documents, args.concurrency)
+    ))
+    search_timers, recall = indexing_consumer.loop.run_until_complete(
+        bench_search(db, get_document_retriever(), queries, args.top_k, args.mode)
+    )
+    timers += search_timers
+    shutdown_loop(indexing_consumer.loop)
+
+    # Record when each chat receives the first piece of its answer
+    first_writes: Dict[int, float] = {}
+
+    class TimedSink(ChatMessageSink):
+        async def write(self, text: str):
+            first_writes.setdefault(self.chat_id, time.perf_counter())
+            await super().write(text)
+
+    assistant = AiAssistantConsumer(
+        response_sink_factory=lambda chat_id, message: TimedSink(db, chat_id, message, assistant.stream_flush_interval),
+        subscriber=FakeSubscriber()
+    )
+    get_document_retriever().result_cache.invalidate()
+    timers += bench_end_to_end(assistant, queries, args.concurrency, first_writes)
+    shutdown_loop(assistant.loop)
+
+    result = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "config": vars(args),
+        "stages": {timer.name: timer.summary() for timer in timers},
+    }
+    result["stages"]["retrieval"]["recall_at_k"] = round(recall, 4)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{result['commit']}.json")
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(result, file, indent=2)
+
+    for name, summary in result["stages"].items():
+        print(f"{name:>20}: {json.dumps(summary)}")
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            for line in compare(json.load(file), result):
+                print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+
+class StageTimer:
+    """Collects the latency of every operation of a benchmark stage and its overall duration; thread-safe"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.items = 0
+        self._started_at: Optional[float] = None
+        self._elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._started_at = time.perf_counter()
+
+    def stop(self):
+        self._elapsed += time.perf_counter() - self._started_at
+        self._started_at = None
+
+    @contextmanager
+    def measure(self, items: int = 1) -> Iterator[None]:
+        """Time one operation, which processes the given number of items"""
+        started_at = time.perf_counter()
+        yield
+        self.record(time.perf_counter() - started_at, items)
+
+    def record(self, latency: float, items: int = 1):
+        """Record the latency in seconds of an operation timed elsewhere"""
+        with self._lock:
+            self.latencies.append(latency)
+            self.items += items
+
+    def summary(self) -> Dict[str, Any]:
+        """Throughput and latency percentiles of the stage, in items per second and milliseconds"""
+        elapsed = self._elapsed
+        latencies = np.asarray(self.latencies, dtype=np.float64) * 1000
+        if not len(latencies):
+            return {"operations": 0, "items": 0}
+
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        return {
+            "operations": len(latencies),
+            "items": self.items,
+            "elapsed_s": round(elapsed, 4) if elapsed else None,
+            "throughput_per_s": round(self.items / elapsed, 2) if elapsed else None,
+            "mean_ms": round(float(latencies.mean()), 3),
+            "p50_ms": round(float(p50), 3),
+            "p95_ms": round(float(p95), 3),
+            "p99_ms": round(float(p99), 3),
+            "max_ms": round(float(latencies.max()), 3),
+        }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any],
+            metrics=("throughput_per_s", "p50_ms", "p95_ms", "p99_ms")) -> List[str]:
+    """
+    Describe the change of every stage between two benchmark results
+
+    Parameters:
+        baseline: The earlier result
+        current: The new result
+        metrics: The summary fields to compare
+
+    Returns:
+        One line per stage present in both results
+    """
+    lines = []
+    for stage, summary in current["stages"].items():
+        before = baseline["stages"].get(stage)
+        if not before:
+            continue
+
+        changes = []
+        for metric in metrics:
+            old, new = before.get(metric), summary.get(metric)
+            if old and new is not None:
+                changes.append(f"{metric} {old} -> {new} ({(new - old) / old:+.1%})")
+        lines.append(f"{stage}: " + ", ".join(changes))
+    return lines
@@ -0,0 +1,51 @@
+import argparse
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from vector_store.bulk_indexer import BulkIndexer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Chunk, embed and store many documents at once, outside the queue")
+    parser.add_argument("--jsonl", help="Index the documents of this JSONL file instead of the documents table")
+    parser.add_argument("--account-id", type=int, help="Only index the documents of this account (documents table only)")
+    parser.add_argument("--workers", type=int, help="Number of encoding processes, defaults to the number of CPUs")
+    parser.add_argument("--batch-size", type=int, default=64, help="Documents per encoding task and per transaction")
+    parser.add_argument("--checkpoint", default="bulk_indexing.checkpoint.json", help="Progress file to resume from")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the beginning")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    indexer = BulkIndexer(
+        args.checkpoint,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        max_tokens=int(os.getenv("CHUNK_MAX_TOKENS", "0")) or None,
+        overlap_tokens=int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+    )
+
+    try:
+        if args.jsonl:
+            await indexer.index_jsonl(args.jsonl)
+        else:
+            await indexer.index_database(args.account_id)
+    finally:
+        await indexer.db.close()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(main())
@@ -0,0 +1,39 @@
+import argparse
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+from db import get_db_connector
+from db.connector import VECTOR_INDEX_METHODS, VECTOR_INDEXED_TABLES
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Create the approximate nearest neighbour indexes on the embedding columns")
+    parser.add_argument("--method", choices=VECTOR_INDEX_METHODS,
+                        help="Index method, defaults to the VECTOR_INDEX_METHOD setting")
+    parser.add_argument("--table", dest="tables", action="append", choices=VECTOR_INDEXED_TABLES,
+                        help="Only index this table, can be repeated; defaults to every embedding table")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+
+    db = get_db_connector()
+    try:
+        await db.create_vector_indexes(args.method, tuple(args.tables or VECTOR_INDEXED_TABLES))
+    finally:
+        await db.close()
+    logger.info("Vector indexes created")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(main())
@@ -1,6 +1,7 @@
-from db.connector import get_db_connector, DatabaseConnector
+from db.connector import get_db_connector, DatabaseConnector, INDEX_UPDATES_CHANNEL
 
 __all__ = [
     'get_db_connector',
-    'DatabaseConnector'
+    'DatabaseConnector',
+    'INDEX_UPDATES_CHANNEL'
 ]
\ No newline at end of file
@@ -1,16 +1,36 @@
 import os
 import json
 import logging
-from psycopg_pool import ConnectionPool
-from typing import Dict, Any, Optional
+import time
+from contextlib import asynccontextmanager
+from pgvector.psycopg import register_vector_async
+from psycopg import AsyncConnection, pq, sql
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from typing import AsyncIterator, Dict, Any, List, Optional, Tuple
 import numpy as np
 
+from monitoring import get_registry, get_startup_profile, observe_stage, timed
+
 logger = logging.getLogger(__name__)
 
+VECTOR_INDEX_METHODS = ('hnsw', 'ivfflat')
+
+VECTOR_INDEXED_TABLES = ('documents', 'document_chunks')
+
+CHAT_MESSAGE_STORES = ('table', 'jsonb')
+
+# Notified with the account ID whenever the indexed documents of an account change
+INDEX_UPDATES_CHANNEL = 'document_index_updated'
+
+# Full-text query matching any of the words of a chat message, rather than all of them as
+# plainto_tsquery would; ts_rank_cd still ranks passages matching more of them first
+LEXICAL_QUERY = "NULLIF(replace(plainto_tsquery('simple', %s)::text, '&', '|'), '')::tsquery"
+
 
 class DatabaseConnector:
     """
     A connector for the MySQL database.
+    Uses an asynchronous connection pool so that queries never block the consumer's event loop.
     Implements the Singleton pattern.
     """
     _instance = None
@@ -36,16 +56,246 @@ class DatabaseConnector:
             'use_pure': True,
         }
 
+        self.vector_index_config = {
+            'method': os.getenv('VECTOR_INDEX_METHOD', 'hnsw'),
+            'hnsw_m': int(os.getenv('HNSW_M', '16')),
+            'hnsw_ef_construction': int(os.getenv('HNSW_EF_CONSTRUCTION', '64')),
+            'hnsw_ef_search': int(os.getenv('HNSW_EF_SEARCH', '40')),
+            'hnsw_iterative_scan': os.getenv('HNSW_ITERATIVE_SCAN'),
+            'ivfflat_lists': int(os.getenv('IVFFLAT_LISTS', '100')),
+            'ivfflat_probes': int(os.getenv('IVFFLAT_PROBES', '10')),
+        }
+
+        self.conninfo = f"postgresql://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}"
+
+        self.pool_config = {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '1')),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '5')),
+            'timeout': float(os.getenv('DB_POOL_TIMEOUT', '30')),
+            'max_waiting': int(os.getenv('DB_POOL_MAX_WAITING', '0')),
+            'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', '600')),
+            'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME', '3600')),
+            'reconnect_timeout': float(os.getenv('DB_POOL_RECONNECT_TIMEOUT', '300')),
+        }
+        check_connections = os.getenv('DB_POOL_CHECK_CONNECTIONS', 'true').lower() == 'true'
+
+        # Statements are prepared server side once they ran DB_PREPARE_THRESHOLD times on a connection,
+        # and the hot queries right away. Disable it behind a transaction-pooling pgbouncer.
+        self.prepare_statements = os.getenv('DB_PREPARED_STATEMENTS', 'true').lower() == 'true'
+        connection_kwargs = {
+            'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '10')),
+            'prepare_threshold': int(os.getenv('DB_PREPARE_THRESHOLD', '5')) if self.prepare_statements else None,
+        }
+
+        # 'jsonb' rewrites the chats.messages array as before, 'table' appends rows to chat_messages.
+        # The API still reads the arrays, so the table is opt-in until it reads the table too.
+        self.chat_message_store = os.getenv('CHAT_MESSAGE_STORE', 'jsonb')
+        if self.chat_message_store not in CHAT_MESSAGE_STORES:
+            raise ValueError(f"Unknown chat message store '{self.chat_message_store}', "
+                             f"expected one of {CHAT_MESSAGE_STORES}")
+
         try:
-            self.connection_pool = ConnectionPool(
-                f"postgresql://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}",
-                min_size=1, max_size=5)
-            logger.info("Database connection pool created successfully")
+            # The pool is opened when a worker starts or on first use, from inside the consumer's event loop
+            self.connection_pool = AsyncConnectionPool(
+                self.conninfo,
+                kwargs=connection_kwargs,
+                configure=self._configure_connection,
+                # Connections dropped by the server or a proxy are replaced before being handed out
+                check=AsyncConnectionPool.check_connection if check_connections else None,
+                name='rag-api',
+                open=False,
+                **self.pool_config
+            )
+            logger.info(f"Database connection pool created successfully: {self.pool_config}")
         except Exception as e:
             logger.error(f"Error creating database connection pool: {str(e)}")
             raise
 
-    def update_document_embedding(self, document_id: int, embedding: np.ndarray) -> bool:
+        get_registry().add_collector(self._collect_metrics)
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """
+        Usage statistics of the connection pool since it was created
+
+        Returns:
+            The psycopg pool statistics, with zero values filled in, plus 'saturation', the share of
+            the maximum pool size in use, and 'wait_seconds', the total time spent waiting for a connection
+        """
+        stats = {
+            'pool_min': 0, 'pool_max': 0, 'pool_size': 0, 'pool_available': 0, 'requests_waiting': 0,
+            'requests_num': 0, 'requests_queued': 0, 'requests_wait_ms': 0, 'requests_errors': 0,
+            'connections_num': 0, 'connections_errors': 0, 'connections_lost': 0,
+        }
+        stats.update(self.connection_pool.get_stats())
+        # A pool that was never opened reports its minimum size although it holds no connection
+        in_use = 0 if self.connection_pool.closed else stats['pool_size'] - stats['pool_available']
+        stats['saturation'] = in_use / stats['pool_max'] if stats['pool_max'] else 0.0
+        stats['wait_seconds'] = stats['requests_wait_ms'] / 1000
+        return stats
+
+    def _collect_metrics(self):
+        """Size, saturation and waits of the connection pool, at scrape time"""
+        stats = self.pool_stats()
+        return [
+            ("rag_db_pool_connections", "gauge", "Connections open in the pool", {}, stats["pool_size"]),
+            ("rag_db_pool_max_connections", "gauge", "Maximum size of the pool", {}, stats["pool_max"]),
+            ("rag_db_pool_available_connections", "gauge", "Idle connections in the pool", {},
+             stats["pool_available"]),
+            ("rag_db_pool_saturation", "gauge", "Share of the maximum pool size in use", {}, stats["saturation"]),
+            ("rag_db_pool_waiting_requests", "gauge", "Requests waiting for a connection", {},
+             stats["requests_waiting"]),
+            ("rag_db_pool_requests_total", "counter", "Connections requested from the pool", {},
+             stats["requests_num"]),
+            ("rag_db_pool_queued_requests_total", "counter", "Connection requests that had to wait", {},
+             stats["requests_queued"]),
+            ("rag_db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection", {},
+             stats["wait_seconds"]),
+            ("rag_db_pool_request_errors_total", "counter", "Connection requests that timed out or were rejected", {},
+             stats["requests_errors"]),
+            ("rag_db_pool_connections_lost_total", "counter", "Connections found broken by the health check", {},
+             stats["connections_lost"]),
+        ]
+
+    async def open(self, timeout: Optional[float] = None):
+        """
+        Open the pool and wait for its first connections, e.g. while a worker starts, so the first message
+        does not pay for connecting. If the database does not answer in time the pool keeps connecting
+        in the background and the error is logged.
+
+        Parameters:
+            timeout: Seconds to wait for the connections, defaults to the pool timeout
+        """
+        if not self.connection_pool.closed:
+            return
+        with get_startup_profile().stage("pool"):
+            await self.connection_pool.open()
+            try:
+                await self.connection_pool.wait(timeout=timeout or self.pool_config['timeout'])
+            except PoolTimeout as e:
+                logger.warning(f"Database connections not ready yet, opening them in the background: {str(e)}")
+
+    async def close(self):
+        """Close the pooled connections, waiting for the borrowed ones to be returned"""
+        if not self.connection_pool.closed:
+            await self.connection_pool.close()
+
+    @asynccontextmanager
+    async def _connection(self) -> AsyncIterator[AsyncConnection]:
+        """Borrow a connection from the pool, opening the pool the first time"""
+        if self.connection_pool.closed:
+            await self.connection_pool.open()
+        started_at = time.perf_counter()
+        async with self.connection_pool.connection() as connection:
+            observe_stage("db.pool_wait", time.perf_counter() - started_at)
+            yield connection
+
+    @asynccontextmanager
+    async def _read_connection(self, ef_search: Optional[int] = None,
+                               probes: Optional[int] = None) -> AsyncIterator[AsyncConnection]:
+        """
+        Borrow a connection for read-only queries. It runs in autocommit mode, so the queries open no
+        transaction and returning the connection costs no COMMIT round trip. Search parameter overrides
+        only last for a transaction, so with overrides the queries run in one.
+
+        Parameters:
+            ef_search: Overrides the HNSW ef_search setting for the queries
+            probes: Overrides the IVFFlat probes setting for the queries
+        """
+        async with self._connection() as connection:
+            await connection.set_autocommit(True)
+            try:
+                if ef_search is None and probes is None:
+                    yield connection
+                else:
+                    async with connection.transaction():
+                        async with connection.cursor() as cursor:
+                            await self._apply_search_params(cursor, ef_search=ef_search, probes=probes)
+                        yield connection
+            finally:
+                # A broken connection cannot be switched back, the pool discards it anyway
+                if connection.info.transaction_status == pq.TransactionStatus.IDLE:
+                    await connection.set_autocommit(False)
+
+    async def _configure_connection(self, connection):
+        """
+        Prepare a new pooled connection: register the pgvector adapters and apply the
+        default ANN search settings
+        """
+        await register_vector_async(connection)
+        async with connection.cursor() as cursor:
+            await self._apply_search_params(
+                cursor,
+                ef_search=self.vector_index_config['hnsw_ef_search'],
+                probes=self.vector_index_config['ivfflat_probes'],
+                iterative_scan=self.vector_index_config['hnsw_iterative_scan'],
+                local=False
+            )
+        await connection.commit()
+
+    @staticmethod
+    async def _apply_search_params(cursor, ef_search: Optional[int] = None, probes: Optional[int] = None,
+                                   iterative_scan: Optional[str] = None, local: bool = True):
+        """
+        Set the pgvector search parameters on a connection
+
+        Parameters:
+            cursor: The cursor to run the settings on
+            ef_search: Size of the HNSW candidate list; higher is more accurate and slower
+            probes: Number of IVFFlat lists to visit; higher is more accurate and slower
+            iterative_scan: HNSW iterative scan mode (pgvector >= 0.8), keeps filtered queries from returning too few rows
+            local: Only apply the settings to the current transaction
+        """
+        settings = {
+            'hnsw.ef_search': ef_search,
+            'ivfflat.probes': probes,
+            'hnsw.iterative_scan': iterative_scan,
+        }
+        for name, value in settings.items():
+            if value is not None:
+                await cursor.execute("SELECT set_config(%s, %s, %s)", (name, str(value), local))
+
+    async def create_vector_indexes(self, method: Optional[str] = None, tables=VECTOR_INDEXED_TABLES):
+        """
+        Create the approximate nearest neighbour indexes on the embedding columns.
+        The indexes are built concurrently so that indexing and search keep running meanwhile.
+
+        Parameters:
+            method: 'hnsw' or 'ivfflat', defaults to the VECTOR_INDEX_METHOD setting
+            tables: The tables whose embedding column should be indexed
+        """
+        method = method or self.vector_index_config['method']
+        if method not in VECTOR_INDEX_METHODS:
+            raise ValueError(f"Unknown vector index method '{method}', expected one of {VECTOR_INDEX_METHODS}")
+
+        if method == 'hnsw':
+            options = sql.SQL("m = {}, ef_construction = {}").format(
+                sql.Literal(self.vector_index_config['hnsw_m']),
+                sql.Literal(self.vector_index_config['hnsw_ef_construction'])
+            )
+        else:
+            options = sql.SQL("lists = {}").format(sql.Literal(self.vector_index_config['ivfflat_lists']))
+
+        async with self._connection() as connection:
+            await connection.set_autocommit(True)
+            try:
+                for table in tables:
+                    index_name = f"{table}_embedding_{method}_idx"
+                    create_query = sql.SQL(
+                        "CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {table} "
+                        "USING {method} (embedding vector_cosine_ops) WITH ({options})"
+                    ).format(
+                        index=sql.Identifier(index_name),
+                        table=sql.Identifier(table),
+                        method=sql.SQL(method),
+                        options=options
+                    )
+                    logger.info(f"Creating vector index {index_name}")
+                    await connection.execute(create_query)
+            finally:
+                await connection.set_autocommit(False)
+
+    @timed("db.update_document_embedding")
+    async def update_document_embedding(self, document_id: int, embedding: np.ndarray) -> bool:
         """
         Update a document's embedding in the database
 
@@ -56,19 +306,18 @@ class DatabaseConnector:
         Returns:
             True if successful, False otherwise
         """
-        embedding_json = json.dumps(embedding.tolist())
-
-        with self.connection_pool.connection() as connection:
-            with connection.cursor() as cursor:
+        async with self._connection() as connection:
+            async with connection.cursor() as cursor:
                 # Update the document embedding
                 update_query = """
                 UPDATE documents
-                SET embedding = %s
+                SET embedding = %b
                 WHERE id = %s
                 """
 
-                cursor.execute(update_query, (embedding_json, document_id))
-                connection.commit()
+                await cursor.execute(update_query, (self._to_vector(embedding), document_id),
+                                     prepare=self.prepare_statements)
+                await connection.commit()
 
                 if cursor.rowcount == 0:
                     logger.warning(f"Document {document_id} not found in the database")
@@ -77,43 +326,714 @@ class DatabaseConnector:
                 logger.info(f"Updated embedding for document {document_id}")
                 return True
 
-    def query_documents_by_embedding(self, query_embedding, top_k=5):
+    @timed("db.rank_documents_by_embedding")
+    async def rank_documents_by_embedding(self, query_embedding: np.ndarray, account_id: int, top_k: int = 5,
+                                          ef_search: Optional[int] = None,
+                                          probes: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        Rank an account's documents by cosine distance to the query embedding.
+        Only the IDs and distances are read; hydrate_documents fetches the text of the chosen ones.
+
+        Parameters:
+            query_embedding: The normalized query embedding
+            account_id: The account whose documents are searched
+            top_k: Number of documents to return
+            ef_search: Overrides the HNSW ef_search setting for this query
+            probes: Overrides the IVFFlat probes setting for this query
+
+        Returns:
+            The (document ID, distance) of the closest documents, closest first
+        """
         query = '''
-        SELECT id, name, text, embedding, account_id, documents.embedding <=> %s AS distance
+        SELECT id, embedding <=> %b AS distance
         FROM documents
+        WHERE account_id = %s
         ORDER BY distance ASC
         LIMIT %s
         '''
 
-        embedding_json = json.dumps(query_embedding.tolist())
-        with self.connection_pool.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(query, (embedding_json, top_k))
-                raw_docs = cursor.fetchall()
-                documents = [{
-                    "id": doc[0],
-                    "name": doc[1],
-                    "text": doc[2],
-                    "embedding": doc[3],
-                    "account_id": doc[4]
-                } for doc in raw_docs]
-                return documents
-
-
-    def add_message_to_chat(self, chat_id: int, message: Dict[str, Any]):
-        add_message_query = '''
-        UPDATE chats
-        SET messages       = messages || %s::jsonb,
-            unread_messages= true
+        async with self._read_connection(ef_search=ef_search, probes=probes) as connection:
+            async with connection.cursor(binary=True) as cursor:
+                await cursor.execute(query, (self._to_vector(query_embedding), account_id, top_k),
+                                     prepare=self.prepare_statements)
+                return await cursor.fetchall()
+
+    @timed("db.rank_documents_by_embeddings")
+    async def rank_documents_by_embeddings(self, queries: List[Tuple[np.ndarray, int, int]]) -> List[List[Tuple[int, float]]]:
+        """
+        Rank the documents of several queries in one statement, each against its own account's documents
+
+        Parameters:
+            queries: The (normalized query embedding, account ID, number of documents) of every query
+
+        Returns:
+            The (document ID, distance) of the closest documents of every query, in the order of the queries
+        """
+        # Every query runs its own index scan through the lateral join, as if it was sent alone
+        query = '''
+        SELECT search.position, document.id, document.distance
+        FROM unnest(%b::vector[], %s::bigint[], %s::integer[])
+            WITH ORDINALITY AS search(embedding, account_id, top_k, position)
+        CROSS JOIN LATERAL (
+            SELECT documents.id, documents.embedding <=> search.embedding AS distance
+            FROM documents
+            WHERE documents.account_id = search.account_id
+            ORDER BY distance ASC
+            LIMIT search.top_k
+        ) AS document
+        ORDER BY search.position, document.distance
+        '''
+        params = (
+            [self._to_vector(embedding) for embedding, _, _ in queries],
+            [int(account_id) for _, account_id, _ in queries],
+            [top_k for _, _, top_k in queries],
+        )
+
+        async with self._read_connection() as connection:
+            async with connection.cursor(binary=True) as cursor:
+                await cursor.execute(query, params, prepare=self.prepare_statements)
+                rows = await cursor.fetchall()
+
+        results: List[List[Tuple[int, float]]] = [[] for _ in queries]
+        for position, document_id, distance in rows:
+            results[position - 1].append((document_id, distance))
+        return results
+
+    @timed("db.rank_documents_by_text")
+    async def rank_documents_by_text(self, query_text: str, account_id: int, top_k: int = 5) -> List[Tuple[int, float]]:
+        """
+        Rank an account's documents by full-text match with the query
+
+        Parameters:
+            query_text: The search query, as typed by the user
+            account_id: The account whose documents are searched
+            top_k: Number of documents to return
+
+        Returns:
+            The (document ID, text search rank) of the best-matching documents, best first
+        """
+        query = f'''
+        WITH search AS (SELECT {LEXICAL_QUERY} AS query)
+        SELECT id, ts_rank_cd(search_vector, search.query) AS rank
+        FROM documents, search
+        WHERE account_id = %s AND search_vector @@ search.query
+        ORDER BY rank DESC
+        LIMIT %s
+        '''
+
+        async with self._read_connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query, (query_text, account_id, top_k))
+                return await cursor.fetchall()
+
+    @timed("db.hydrate_documents")
+    async def hydrate_documents(self, document_ids: List[int], account_id: int,
+                                max_chars: Optional[int] = None) -> Dict[int, Tuple[str, str]]:
+        """
+        Fetch the name and text of ranked documents
+
+        Parameters:
+            document_ids: The IDs of the documents
+            account_id: The account the documents must belong to
+            max_chars: Only the first max_chars characters of the text are read, if set
+
+        Returns:
+            The (name, text) of every document found, by ID
+        """
+        text_column = "left(text, %s)" if max_chars else "text"
+        query = f'''
+        SELECT id, name, {text_column}
+        FROM documents
+        WHERE id = ANY(%s) AND account_id = %s
+        '''
+        params = (max_chars,) if max_chars else ()
+
+        async with self._read_connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query, params + (list(document_ids), account_id), prepare=self.prepare_statements)
+                return {row[0]: (row[1], row[2]) for row in await cursor.fetchall()}
+
+    @timed("db.store_document_indexes")
+    async def store_document_indexes(self, documents: List[Tuple[int, np.ndarray, List[Dict[str, Any]], np.ndarray]],
+                                     replace_chunks: bool = False) -> Dict[int, int]:
+        """
+        Write the embeddings and chunks of many documents in a single transaction.
+        Document embeddings are updated with one pipelined executemany and the chunks are
+        streamed with a binary COPY, so the number of round trips does not grow with the batch.
+        Stored chunks whose ID and content hash are unchanged are left in place; only new or
+        changed chunks are written and chunks that no longer exist are deleted.
+
+        Parameters:
+            documents: Tuples of (document_id, document embedding, chunk dictionaries, chunk embeddings)
+            replace_chunks: Rewrite every chunk, even unchanged ones, e.g. after switching the embedding model
+
+        Returns:
+            The account of every stored document, by document ID; documents missing from the database are skipped
+        """
+        if not documents:
+            return {}
+
+        update_query = """
+        UPDATE documents
+        SET embedding = %b
         WHERE id = %s
-        RETURNING *;
+        """
+        copy_query = """
+        COPY document_chunks (chunk_id, document_id, account_id, chunk_index, text, content_hash, embedding)
+        FROM STDIN WITH (FORMAT BINARY)
+        """
+
+        async with self._connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("SELECT id, account_id FROM documents WHERE id = ANY(%s)",
+                                     ([doc[0] for doc in documents],))
+                account_ids = dict(await cursor.fetchall())
+
+                stored = [doc for doc in documents if doc[0] in account_ids]
+                for document_id, *_ in documents:
+                    if document_id not in account_ids:
+                        logger.warning(f"Document {document_id} not found in the database")
+
+                if not stored:
+                    return {}
+
+                stored_ids = [doc[0] for doc in stored]
+
+                # Prepared by psycopg once the batch reaches DB_PREPARE_THRESHOLD documents
+                await cursor.executemany(update_query, [
+                    (self._to_vector(embedding), document_id) for document_id, embedding, _, _ in stored
+                ])
+
+                await cursor.execute("SELECT chunk_id, content_hash FROM document_chunks WHERE document_id = ANY(%s)",
+                                     (stored_ids,))
+                existing_chunks = set(await cursor.fetchall())
+                new_chunks = {
+                    (chunk['chunk_id'], chunk['content_hash']) for _, _, chunks, _ in stored for chunk in chunks
+                }
+
+                if replace_chunks:
+                    removed_ids = [chunk_id for chunk_id, _ in existing_chunks]
+                    existing_chunks = set()
+                else:
+                    removed_ids = [chunk_id for chunk_id, _ in existing_chunks - new_chunks]
+                if removed_ids:
+                    await cursor.execute("DELETE FROM document_chunks WHERE chunk_id = ANY(%s)", (removed_ids,))
+
+                written = 0
+                async with cursor.copy(copy_query) as copy:
+                    copy.set_types(["text", "int8", "int8", "int4", "text", "text", "vector"])
+                    for document_id, _, chunks, chunk_embeddings in stored:
+                        for chunk, chunk_embedding in zip(chunks, chunk_embeddings):
+                            if (chunk['chunk_id'], chunk['content_hash']) in existing_chunks:
+                                continue
+                            await copy.write_row((chunk['chunk_id'], document_id, account_ids[document_id],
+                                                  chunk['chunk_index'], chunk['text'], chunk['content_hash'],
+                                                  self._to_vector(chunk_embedding)))
+                            written += 1
+
+                # Delivered to listeners when the transaction commits
+                for account_id in {account_ids[document_id] for document_id in stored_ids}:
+                    await cursor.execute("SELECT pg_notify(%s, %s)", (INDEX_UPDATES_CHANNEL, str(account_id)))
+            await connection.commit()
+
+        logger.info(f"Stored embeddings for {len(stored_ids)} documents: "
+                    f"{written} chunks written, {len(removed_ids)} removed")
+        return {document_id: account_ids[document_id] for document_id in stored_ids}
+
+    async def iter_documents(self, after_id: int = 0, account_id: Optional[int] = None,
+                             batch_size: int = 1000) -> AsyncIterator[List[Tuple[int, int, str]]]:
+        """
+        Stream documents in ID order, without loading the table in memory.
+        Every batch is read by a short query starting after the last ID of the previous one, so a long
+        scan holds neither a connection nor a snapshot that would keep vacuum from cleaning up.
+
+        Parameters:
+            after_id: Only documents with a greater ID are read, to resume an interrupted scan
+            account_id: Only read the documents of this account
+            batch_size: Number of documents read per query
+
+        Returns:
+            An async iterator over batches of (document_id, account_id, text) tuples
+        """
+        query = """
+        SELECT id, account_id, text
+        FROM documents
+        WHERE id > %s AND (%s::bigint IS NULL OR account_id = %s) AND text IS NOT NULL
+        ORDER BY id
+        LIMIT %s
+        """
+
+        while True:
+            async with self._read_connection() as connection:
+                async with connection.cursor() as cursor:
+                    await cursor.execute(query, (after_id, account_id, account_id, batch_size),
+                                         prepare=self.prepare_statements)
+                    rows = await cursor.fetchall()
+
+            if not rows:
+                return
+            yield rows
+            if len(rows) < batch_size:
+                return
+            after_id = rows[-1][0]
+
+    @timed("db.get_chunk_embeddings_by_hash")
+    async def get_chunk_embeddings_by_hash(self, document_id: int, content_hashes: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Find already computed embeddings for chunk contents, among every chunk of the document's account
+
+        Parameters:
+            document_id: The document being indexed
+            content_hashes: The content hashes of its chunks
+
+        Returns:
+            The stored embedding of every known content hash
+        """
+        query = '''
+        SELECT DISTINCT ON (content_hash) content_hash, embedding
+        FROM document_chunks
+        WHERE account_id = (SELECT account_id FROM documents WHERE id = %s)
+          AND content_hash = ANY(%s)
+        '''
+
+        async with self._read_connection() as connection:
+            async with connection.cursor(binary=True) as cursor:
+                await cursor.execute(query, (document_id, list(content_hashes)))
+                return {row[0]: self._from_vector(row[1]) for row in await cursor.fetchall()}
+
+    @timed("db.rank_chunks_by_embedding")
+    async def rank_chunks_by_embedding(self, query_embedding: np.ndarray, account_id: int, top_k: int = 5,
+                                       with_embeddings: bool = False, ef_search: Optional[int] = None,
+                                       probes: Optional[int] = None) -> List[Tuple[str, int, float, Optional[np.ndarray]]]:
+        """
+        Rank the chunks of an account's documents by cosine distance to the query embedding.
+        Only the IDs and distances are read; hydrate_chunks fetches the text of the chosen ones.
+
+        Parameters:
+            query_embedding: The normalized query embedding
+            account_id: The account whose documents are searched
+            top_k: Number of chunks to return
+            with_embeddings: Also read the embedding of every chunk
+            ef_search: Overrides the HNSW ef_search setting for this query
+            probes: Overrides the IVFFlat probes setting for this query
+
+        Returns:
+            The (chunk ID, document ID, distance, embedding or None) of the closest chunks, closest first
+        """
+        embedding_column = "embedding" if with_embeddings else "NULL::vector"
+        query = f'''
+        SELECT chunk_id, document_id, embedding <=> %b AS distance, {embedding_column}
+        FROM document_chunks
+        WHERE account_id = %s
+        ORDER BY distance ASC
+        LIMIT %s
+        '''
+
+        async with self._read_connection(ef_search=ef_search, probes=probes) as connection:
+            async with connection.cursor(binary=True) as cursor:
+                await cursor.execute(query, (self._to_vector(query_embedding), account_id, top_k),
+                                     prepare=self.prepare_statements)
+                rows = await cursor.fetchall()
+
+        return [(chunk_id, document_id, distance, self._from_vector(embedding))
+                for chunk_id, document_id, distance, embedding in rows]
+
+    @timed("db.rank_chunks_by_embeddings")
+    async def rank_chunks_by_embeddings(self, queries: List[Tuple[np.ndarray, int, int, bool]]
+                                        ) -> List[List[Tuple[str, int, float, Optional[np.ndarray]]]]:
+        """
+        Rank the chunks of several queries in one statement, each against its own account's documents
+
+        Parameters:
+            queries: The (normalized query embedding, account ID, number of chunks, with embeddings) of every query
+
+        Returns:
+            The (chunk ID, document ID, distance, embedding or None) of the closest chunks of every query,
+            in the order of the queries
+        """
+        query = '''
+        SELECT search.position, chunk.chunk_id, chunk.document_id, chunk.distance, chunk.embedding
+        FROM unnest(%b::vector[], %s::bigint[], %s::integer[], %s::boolean[])
+            WITH ORDINALITY AS search(embedding, account_id, top_k, with_embeddings, position)
+        CROSS JOIN LATERAL (
+            SELECT document_chunks.chunk_id, document_chunks.document_id,
+                   document_chunks.embedding <=> search.embedding AS distance,
+                   CASE WHEN search.with_embeddings THEN document_chunks.embedding END AS embedding
+            FROM document_chunks
+            WHERE document_chunks.account_id = search.account_id
+            ORDER BY distance ASC
+            LIMIT search.top_k
+        ) AS chunk
+        ORDER BY search.position, chunk.distance
         '''
+        params = (
+            [self._to_vector(embedding) for embedding, _, _, _ in queries],
+            [int(account_id) for _, account_id, _, _ in queries],
+            [top_k for _, _, top_k, _ in queries],
+            [with_embeddings for _, _, _, with_embeddings in queries],
+        )
+
+        async with self._read_connection() as connection:
+            async with connection.cursor(binary=True) as cursor:
+                await cursor.execute(query, params, prepare=self.prepare_statements)
+                rows = await cursor.fetchall()
+
+        results: List[List[Tuple[str, int, float, Optional[np.ndarray]]]] = [[] for _ in queries]
+        for position, chunk_id, document_id, distance, embedding in rows:
+            results[position - 1].append((chunk_id, document_id, distance, self._from_vector(embedding)))
+        return results
+
+    @timed("db.rank_chunks_by_text")
+    async def rank_chunks_by_text(self, query_text: str, account_id: int, top_k: int = 5,
+                                  with_embeddings: bool = False) -> List[Tuple[str, int, float, Optional[np.ndarray]]]:
+        """
+        Rank the chunks of an account's documents by full-text match with the query
+
+        Parameters:
+            query_text: The search query, as typed by the user
+            account_id: The account whose documents are searched
+            top_k: Number of chunks to return
+            with_embeddings: Also read the embedding of every chunk
+
+        Returns:
+            The (chunk ID, document ID, text search rank, embedding or None) of the best-matching chunks, best first
+        """
+        embedding_column = "embedding" if with_embeddings else "NULL::vector"
+        query = f'''
+        WITH search AS (SELECT {LEXICAL_QUERY} AS query)
+        SELECT chunk_id, document_id, ts_rank_cd(search_vector, search.query) AS rank, {embedding_column}
+        FROM document_chunks, search
+        WHERE account_id = %s AND search_vector @@ search.query
+        ORDER BY rank DESC
+        LIMIT %s
+        '''
+
+        async with self._read_connection() as connection:
+            async with connection.cursor(binary=True) as cursor:
+                await cursor.execute(query, (query_text, account_id, top_k))
+                rows = await cursor.fetchall()
+
+        return [(chunk_id, document_id, rank, self._from_vector(embedding))
+                for chunk_id, document_id, rank, embedding in rows]
+
+    @timed("db.hydrate_chunks")
+    async def hydrate_chunks(self, chunk_ids: List[str], account_id: int,
+                             max_chars: Optional[int] = None) -> Dict[str, Tuple[int, str, str]]:
+        """
+        Fetch the text and document name of ranked chunks
+
+        Parameters:
+            chunk_ids: The IDs of the chunks
+            account_id: The account the chunks must belong to
+            max_chars: Only the first max_chars characters of the text are read, if set
+
+        Returns:
+            The (chunk index, document name, text) of every chunk found, by chunk ID
+        """
+        text_column = "left(document_chunks.text, %s)" if max_chars else "document_chunks.text"
+        query = f'''
+        SELECT document_chunks.chunk_id, document_chunks.chunk_index, documents.name, {text_column}
+        FROM document_chunks
+        JOIN documents ON documents.id = document_chunks.document_id
+        WHERE document_chunks.chunk_id = ANY(%s) AND document_chunks.account_id = %s
+        '''
+        params = (max_chars,) if max_chars else ()
+
+        async with self._read_connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query, params + (list(chunk_ids), account_id), prepare=self.prepare_statements)
+                return {row[0]: (row[1], row[2], row[3]) for row in await cursor.fetchall()}
+
+    @timed("db.get_account_chunk_embeddings")
+    async def get_account_chunk_embeddings(self, account_id: int) -> Tuple[List[str], List[int], np.ndarray]:
+        """
+        Fetch every chunk embedding of an account, used to build an in-process vector index
+
+        Parameters:
+            account_id: The account whose chunks are fetched
+
+        Returns:
+            The chunk IDs, their document IDs and a (chunks, dim) float32 matrix of embeddings
+        """
+        query = '''
+        SELECT chunk_id, document_id, embedding
+        FROM document_chunks
+        WHERE account_id = %s
+        ORDER BY document_id, chunk_index
+        '''
+
+        async with self._read_connection() as connection:
+            async with connection.cursor(binary=True) as cursor:
+                await cursor.execute(query, (account_id,))
+                rows = await cursor.fetchall()
+
+        chunk_ids = [row[0] for row in rows]
+        document_ids = [row[1] for row in rows]
+        embeddings = np.array([self._from_vector(row[2]) for row in rows], dtype=np.float32)
+        return chunk_ids, document_ids, embeddings
+
+    @timed("db.add_message_to_chat")
+    async def add_message_to_chat(self, chat_id: int, message: Dict[str, Any]):
+        """
+        Append a message to a chat and flag the chat as having unread messages
+
+        Parameters:
+            chat_id: The ID of the chat
+            message: The message dictionary, identified by its 'id'
+        """
+        if self.chat_message_store == 'table':
+            add_message_query = '''
+            INSERT INTO chat_messages (chat_id, message_id, message)
+            VALUES (%s, %s, %s::jsonb)
+            ON CONFLICT (chat_id, message_id) DO NOTHING
+            '''
+            params = (chat_id, message['id'], json.dumps(message))
+        else:
+            add_message_query = '''
+            UPDATE chats
+            SET messages       = messages || %s::jsonb,
+                unread_messages= true
+            WHERE id = %s
+            '''
+            params = (json.dumps(message), chat_id)
+
+        async with self._connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(add_message_query, params, prepare=self.prepare_statements)
+                if self.chat_message_store == 'table':
+                    await self._mark_chat_unread(cursor, chat_id)
+                await connection.commit()
+
+    @timed("db.upsert_chat_message")
+    async def upsert_chat_message(self, chat_id: int, message: Dict[str, Any]):
+        """
+        Replace the message with the same ID in a chat, or append it if the chat does not have it yet.
+        Used to write responses, which are rewritten while they are streamed and when their question is redelivered.
+
+        Parameters:
+            chat_id: The ID of the chat
+            message: The message dictionary, identified by its 'id'
+        """
+        if self.chat_message_store == 'table':
+            upsert_message_query = '''
+            INSERT INTO chat_messages (chat_id, message_id, message)
+            VALUES (%(chat_id)s, %(message_id)s, %(message)s::jsonb)
+            ON CONFLICT (chat_id, message_id) DO UPDATE SET message = EXCLUDED.message
+            '''
+        else:
+            upsert_message_query = '''
+            UPDATE chats
+            SET messages        = CASE
+                    WHEN messages @> jsonb_build_array(jsonb_build_object('id', %(message_id)s::text))
+                    THEN (SELECT jsonb_agg(CASE WHEN element ->> 'id' = %(message_id)s THEN %(message)s::jsonb
+                                                ELSE element END ORDER BY position)
+                          FROM jsonb_array_elements(messages) WITH ORDINALITY AS elements(element, position))
+                    ELSE messages || %(message)s::jsonb
+                END,
+                unread_messages = true
+            WHERE id = %(chat_id)s
+            '''
+
+        async with self._connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(upsert_message_query, {
+                    'message_id': message['id'],
+                    'message': json.dumps(message),
+                    'chat_id': chat_id
+                }, prepare=self.prepare_statements)
+                if self.chat_message_store == 'table':
+                    await self._mark_chat_unread(cursor, chat_id)
+                await connection.commit()
+
+    async def _mark_chat_unread(self, cursor, chat_id: int):
+        """Flag a chat as having unread messages, leaving the row alone if it already is"""
+        await cursor.execute(
+            "UPDATE chats SET unread_messages = true WHERE id = %s AND unread_messages IS NOT TRUE",
+            (chat_id,), prepare=self.prepare_statements
+        )
+
+    @timed("db.get_recent_chat_messages")
+    async def get_recent_chat_messages(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        """
+        Read the last messages of a chat
+
+        Parameters:
+            chat_id: The ID of the chat
+            limit: Maximum number of messages to read
+
+        Returns:
+            The message dictionaries, oldest first
+        """
+        if self.chat_message_store == 'table':
+            # Walks the (chat_id, created_at, id) index backwards, reading only the returned rows
+            query = '''
+            SELECT message
+            FROM (SELECT message, created_at, id
+                  FROM chat_messages
+                  WHERE chat_id = %s
+                  ORDER BY created_at DESC, id DESC
+                  LIMIT %s) AS recent
+            ORDER BY created_at, id
+            '''
+        else:
+            query = '''
+            SELECT element
+            FROM (SELECT element, position
+                  FROM chats, jsonb_array_elements(messages) WITH ORDINALITY AS elements(element, position)
+                  WHERE id = %s
+                  ORDER BY position DESC
+                  LIMIT %s) AS recent
+            ORDER BY position
+            '''
+
+        async with self._read_connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query, (chat_id, limit), prepare=self.prepare_statements)
+                return [row[0] for row in await cursor.fetchall()]
+
+    @timed("db.get_chat_summary")
+    async def get_chat_summary(self, chat_id: int) -> Optional[Tuple[int, Optional[str], str]]:
+        """
+        Read the stored summary of the oldest messages of a chat
+
+        Parameters:
+            chat_id: The ID of the chat
+
+        Returns:
+            A (message_count, last_message_id, summary) tuple, or None if the chat was never summarized
+        """
+        query = '''
+        SELECT message_count, last_message_id, summary
+        FROM chat_summaries
+        WHERE chat_id = %s
+        '''
+
+        async with self._read_connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query, (chat_id,), prepare=self.prepare_statements)
+                return await cursor.fetchone()
+
+    @timed("db.store_chat_summary")
+    async def store_chat_summary(self, chat_id: int, message_count: int, last_message_id: Optional[str],
+                                 summary: str):
+        """
+        Store the summary of the oldest messages of a chat, replacing the previous one
+
+        Parameters:
+            chat_id: The ID of the chat
+            message_count: Number of messages the summary covers
+            last_message_id: The ID of the last message the summary covers, if it has one
+            summary: The summary text
+        """
+        query = '''
+        INSERT INTO chat_summaries (chat_id, message_count, last_message_id, summary)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (chat_id) DO UPDATE
+            SET message_count   = EXCLUDED.message_count,
+                last_message_id = EXCLUDED.last_message_id,
+                summary         = EXCLUDED.summary,
+                updated_at      = now()
+        '''
+
+        async with self._connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query, (chat_id, message_count, last_message_id, summary),
+                                     prepare=self.prepare_statements)
+                await connection.commit()
+
+    async def iter_chat_histories(self, after_id: int = 0,
+                                  batch_size: int = 100) -> AsyncIterator[List[Tuple[int, List[Dict[str, Any]]]]]:
+        """
+        Stream the chats.messages arrays in chat ID order, one short query per batch like iter_documents
+
+        Parameters:
+            after_id: Only chats with a greater ID are read, to resume an interrupted scan
+            batch_size: Number of chats read per query
+
+        Returns:
+            An async iterator over batches of (chat_id, messages) tuples
+        """
+        query = """
+        SELECT id, messages
+        FROM chats
+        WHERE id > %s AND jsonb_array_length(messages) > 0
+        ORDER BY id
+        LIMIT %s
+        """
+
+        while True:
+            async with self._read_connection() as connection:
+                async with connection.cursor() as cursor:
+                    await cursor.execute(query, (after_id, batch_size))
+                    rows = await cursor.fetchall()
+
+            if not rows:
+                return
+            yield rows
+            if len(rows) < batch_size:
+                return
+            after_id = rows[-1][0]
+
+    @timed("db.insert_chat_messages")
+    async def insert_chat_messages(self, rows: List[Tuple[int, str, Any, Dict[str, Any]]]) -> int:
+        """
+        Copy messages into chat_messages, skipping the ones already there
+
+        Parameters:
+            rows: Tuples of (chat_id, message_id, created_at, message dictionary), in chat order
+
+        Returns:
+            The number of inserted messages
+        """
+        if not rows:
+            return 0
+
+        insert_query = '''
+        INSERT INTO chat_messages (chat_id, message_id, created_at, message)
+        VALUES (%s, %s, %s, %s::jsonb)
+        ON CONFLICT (chat_id, message_id) DO NOTHING
+        '''
+
+        async with self._connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.executemany(insert_query, [
+                    (chat_id, message_id, created_at, json.dumps(message))
+                    for chat_id, message_id, created_at, message in rows
+                ])
+                inserted = cursor.rowcount
+            await connection.commit()
+        return inserted
+
+    async def listen(self, channel: str) -> AsyncIterator[str]:
+        """
+        Listen to a notification channel on a dedicated connection
+
+        Parameters:
+            channel: The channel to LISTEN on
+
+        Returns:
+            An async iterator over the payloads of the notifications
+        """
+        connection = await AsyncConnection.connect(self.conninfo, autocommit=True)
+        async with connection:
+            await connection.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+            logger.info(f"Listening to {channel} notifications")
+            async for notification in connection.notifies():
+                yield notification.payload
 
-        with self.connection_pool.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(add_message_query, (json.dumps(message), chat_id))
-                connection.commit()
+    @staticmethod
+    def _to_vector(embedding: np.ndarray) -> np.ndarray:
+        """Make sure an embedding is a contiguous float32 array, which pgvector sends in binary form as is"""
+        return np.ascontiguousarray(embedding, dtype=np.float32)
 
+    @staticmethod
+    def _from_vector(value: Any) -> Optional[np.ndarray]:
+        """Convert a vector column, which pgvector reads as a pgvector.Vector, to a float32 array; NULL stays None"""
+        if value is None:
+            return None
+        if hasattr(value, 'to_numpy'):
+            return value.to_numpy()
+        return np.asarray(value, dtype=np.float32)
 
 
 def get_db_connector():
@@ -0,0 +1,13 @@
+-- Chunk-level embeddings: one row per chunk produced by vector_store.chunking.chunk_document
+CREATE EXTENSION IF NOT EXISTS vector;
+
+CREATE TABLE IF NOT EXISTS document_chunks
+(
+    chunk_id    TEXT PRIMARY KEY,
+    document_id BIGINT      NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    chunk_index INTEGER     NOT NULL,
+    text        TEXT        NOT NULL,
+    embedding   vector(384) NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS document_chunks_document_id_idx ON document_chunks (document_id);
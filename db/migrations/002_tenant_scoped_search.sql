@@ -0,0 +1,17 @@
+-- Tenant-scoped vector search: chunks carry the account of their document so that
+-- the account_id predicate can be applied before ranking.
+ALTER TABLE document_chunks ADD COLUMN IF NOT EXISTS account_id BIGINT;
+
+UPDATE document_chunks
+SET account_id = documents.account_id
+FROM documents
+WHERE documents.id = document_chunks.document_id
+  AND document_chunks.account_id IS NULL;
+
+ALTER TABLE document_chunks ALTER COLUMN account_id SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS document_chunks_account_id_idx ON document_chunks (account_id);
+CREATE INDEX IF NOT EXISTS documents_account_id_idx ON documents (account_id);
+
+-- The ANN indexes themselves are managed by DatabaseConnector.create_vector_indexes,
+-- which builds them concurrently with the configured method and parameters.
@@ -0,0 +1,11 @@
+-- Content hashes let re-indexing reuse the embeddings of unchanged chunks, including
+-- identical chunks of other documents of the same account.
+ALTER TABLE document_chunks ADD COLUMN IF NOT EXISTS content_hash TEXT;
+
+UPDATE document_chunks
+SET content_hash = encode(sha256(convert_to(text, 'UTF8')), 'hex')
+WHERE content_hash IS NULL;
+
+ALTER TABLE document_chunks ALTER COLUMN content_hash SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS document_chunks_account_id_content_hash_idx ON document_chunks (account_id, content_hash);
@@ -0,0 +1,11 @@
+-- Full-text search next to vector search, for hybrid retrieval. The 'simple' configuration
+-- neither stems nor drops stop words, so product codes, error strings and names are matched
+-- exactly as they are written.
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(text, ''))) STORED;
+
+ALTER TABLE document_chunks ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', text)) STORED;
+
+CREATE INDEX IF NOT EXISTS documents_search_vector_idx ON documents USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS document_chunks_search_vector_idx ON document_chunks USING GIN (search_vector);
@@ -0,0 +1,15 @@
+-- Append-only chat messages: one row per message, instead of rewriting the whole chats.messages array on
+-- every reply. Existing arrays are copied with migrate_chat_messages.py.
+CREATE TABLE IF NOT EXISTS chat_messages
+(
+    id         BIGSERIAL PRIMARY KEY,
+    chat_id    BIGINT      NOT NULL REFERENCES chats (id) ON DELETE CASCADE,
+    message_id TEXT        NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    message    JSONB       NOT NULL,
+    -- Streamed responses replace their own row, and backfills can be run again
+    UNIQUE (chat_id, message_id)
+);
+
+-- The last messages of a chat, in order; the ID breaks ties between messages of the same instant
+CREATE INDEX IF NOT EXISTS chat_messages_chat_id_created_at_idx ON chat_messages (chat_id, created_at, id);
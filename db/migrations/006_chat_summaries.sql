@@ -0,0 +1,11 @@
+-- The rolling summary of the oldest messages of a chat, kept across worker restarts so a question never
+-- waits for the whole history to be summarized again.
+CREATE TABLE IF NOT EXISTS chat_summaries
+(
+    chat_id         BIGINT PRIMARY KEY REFERENCES chats (id) ON DELETE CASCADE,
+    -- The watermark: the last message the summary covers, or their number for messages without an ID
+    last_message_id TEXT,
+    message_count   INTEGER     NOT NULL,
+    summary         TEXT        NOT NULL,
+    updated_at      TIMESTAMPTZ NOT NULL DEFAULT now()
+);
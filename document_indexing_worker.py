@@ -1,11 +1,19 @@
 import logging
 
-from pub_sub_consummer.document_indexing_consumer import DocumentIndexingConsumer
+from monitoring.startup import get_startup_profile
 
 if __name__ == "__main__":
-    document_indexer = DocumentIndexingConsumer()
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        format='%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s'
     )
-    document_indexer.consume()
+    startup = get_startup_profile()
+    with startup.stage("env"):
+        from dotenv import load_dotenv
+        load_dotenv()
+    with startup.stage("import"):
+        from pub_sub_consummer.document_indexing_consumer import DocumentIndexingConsumer
+        from pub_sub_consummer.supervisor import run_workers
+
+    # One consumer in this process, or WORKER_PROCESSES forked workers sharing the model
+    run_workers(DocumentIndexingConsumer)
\ No newline at end of file
@@ -1,8 +1,20 @@
-from llm.gemini_client import GeminiClient
-from llm.retrieval import get_document_retriever, DocumentRetriever
-
-__all__ = [
-    'GeminiClient',
-    'get_document_retriever',
-    'DocumentRetriever'
-]
\ No newline at end of file
+import importlib
+
+# The submodules are imported on first access, so importing e.g. llm.context_builder does not
+# load google.generativeai or the retrieval stack
+_EXPORTS = {
+    'GeminiClient': 'llm.gemini_client',
+    'get_document_retriever': 'llm.retrieval',
+    'DocumentRetriever': 'llm.retrieval',
+    'SearchResult': 'llm.retrieval',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name]), name)
+    globals()[name] = value
+    return value
\ No newline at end of file
@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+import numpy as np
+
+from llm.retrieval import InvalidationClock, SearchResult
+from monitoring import get_registry
+
+logger = logging.getLogger(__name__)
+
+
+class _AccountAnswers:
+    """The cached answers of one account, with their question embeddings in one matrix"""
+
+    def __init__(self, capacity: int, dimension: int):
+        self.embeddings = np.zeros((capacity, dimension), dtype=np.float32)
+        self.fingerprints = np.empty(capacity, dtype=object)
+        self.answers: List[Optional[str]] = [None] * capacity
+        self.expires_at = np.zeros(capacity)
+        self.last_used = np.zeros(capacity)
+        self.size = 0
+
+    def live(self, now: float) -> int:
+        return int(np.count_nonzero(self.expires_at[:self.size] > now))
+
+
+class SemanticAnswerCache:
+    """
+    Caches the answers of an account by the embedding of their question, so a question close enough
+    to an earlier one is answered without calling the LLM.
+    An answer is only reused while the retrieval of the new question returns the same passages it was
+    generated from, and is dropped when the account's documents are re-indexed.
+    Every account keeps a bounded matrix of question embeddings that a lookup scores in one product.
+    It is meant to be used from a single event loop and is not thread-safe.
+    """
+
+    def __init__(self, threshold: Optional[float] = None, max_entries: Optional[int] = None,
+                 max_accounts: Optional[int] = None, ttl: Optional[float] = None):
+        """
+        Initialize the cache
+
+        Parameters:
+            threshold: Cosine similarity from which two questions share an answer
+            max_entries: Maximum number of answers per account, the least recently used is evicted
+            max_accounts: Maximum number of accounts, the least recently used is evicted
+            ttl: Time in seconds after which an answer expires
+        """
+        self.threshold = threshold if threshold is not None else float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+        self.max_entries = max_entries or int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+        self.max_accounts = max_accounts or int(os.getenv("ANSWER_CACHE_ACCOUNTS", "1000"))
+        self.ttl = ttl or float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+
+        # Keyed by account ID as a string, whether it came from a message or a notification
+        self._accounts: OrderedDict[str, _AccountAnswers] = OrderedDict()
+        # Answers generated while their account is invalidated are not stored
+        self.invalidations = InvalidationClock(self.max_accounts)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        get_registry().add_collector(self._collect_metrics)
+
+    @staticmethod
+    def fingerprint(results: List[SearchResult]) -> str:
+        """Identify the set of passages or documents an answer was generated from"""
+        keys = sorted(str(result.chunk_id or result.document_id) for result in results)
+        return hashlib.blake2b("\n".join(keys).encode("utf-8"), digest_size=16).hexdigest()
+
+    def generation(self) -> int:
+        """The invalidation generation, to take before retrieving the passages of an answer and pass to set"""
+        return self.invalidations.now()
+
+    def get(self, account_id: Hashable, embedding: np.ndarray, fingerprint: str) -> Optional[str]:
+        """
+        Find the answer of a close enough question generated from the same passages
+
+        Parameters:
+            account_id: The account the question was asked in
+            embedding: The normalized embedding of the question
+            fingerprint: The fingerprint of the passages retrieved for the question
+
+        Returns:
+            The cached answer, or None
+        """
+        account_id = str(account_id)
+        store = self._accounts.get(account_id)
+        if store is None or store.size == 0:
+            self.misses += 1
+            return None
+
+        now = time.monotonic()
+        scores = store.embeddings[:store.size] @ np.asarray(embedding, dtype=np.float32)
+        valid = (store.expires_at[:store.size] > now) & (store.fingerprints[:store.size] == fingerprint)
+        scores = np.where(valid, scores, -np.inf)
+
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            self.misses += 1
+            return None
+
+        self._accounts.move_to_end(account_id)
+        store.last_used[best] = now
+        self.hits += 1
+        return store.answers[best]
+
+    def set(self, account_id: Hashable, embedding: np.ndarray, fingerprint: str, answer: str,
+            generation: int):
+        """
+        Store the answer of a question
+
+        Parameters:
+            account_id: The account the question was asked in
+            embedding: The normalized embedding of the question
+            fingerprint: The fingerprint of the passages the answer was generated from
+            answer: The answer
+            generation: The generation taken before the passages were retrieved
+        """
+        if self.invalidations.changed_since(account_id, generation):
+            logger.debug(f"Not caching an answer for account {account_id}, its documents changed meanwhile")
+            return
+
+        account_id = str(account_id)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        store = self._accounts.get(account_id)
+        if store is None or store.embeddings.shape[1] != embedding.shape[0]:
+            store = _AccountAnswers(self.max_entries, embedding.shape[0])
+            self._accounts[account_id] = store
+            while len(self._accounts) > self.max_accounts:
+                _, evicted = self._accounts.popitem(last=False)
+                self.evictions += evicted.live(time.monotonic())
+        self._accounts.move_to_end(account_id)
+
+        now = time.monotonic()
+        slot = self._slot(store, embedding, fingerprint, now)
+        store.embeddings[slot] = embedding
+        store.fingerprints[slot] = fingerprint
+        store.answers[slot] = answer
+        store.expires_at[slot] = now + self.ttl
+        store.last_used[slot] = now
+
+    def _slot(self, store: _AccountAnswers, embedding: np.ndarray, fingerprint: str, now: float) -> int:
+        """The slot to write an answer to: the same question's, a free one or the least recently used"""
+        if store.size:
+            scores = store.embeddings[:store.size] @ embedding
+            same = (store.fingerprints[:store.size] == fingerprint) & (scores >= self.threshold)
+            if same.any():
+                return int(np.argmax(np.where(same, scores, -np.inf)))
+
+        if store.size < self.max_entries:
+            store.size += 1
+            return store.size - 1
+
+        # Expired answers are replaced first
+        last_used = np.where(store.expires_at > now, store.last_used, -np.inf)
+        slot = int(np.argmin(last_used))
+        if store.expires_at[slot] > now:
+            self.evictions += 1
+        return slot
+
+    def invalidate(self, account_id: Optional[Hashable] = None) -> int:
+        """
+        Drop the cached answers of an account, or of every account
+
+        Parameters:
+            account_id: The account whose documents changed; every account if omitted
+
+        Returns:
+            The number of dropped answers
+        """
+        now = time.monotonic()
+        self.invalidations.invalidate(account_id)
+        if account_id is None:
+            removed = sum(store.live(now) for store in self._accounts.values())
+            self._accounts.clear()
+            return removed
+
+        store = self._accounts.pop(str(account_id), None)
+        return store.live(now) if store is not None else 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Size and hit-rate metrics of the cache"""
+        now = time.monotonic()
+        lookups = self.hits + self.misses
+        return {
+            "size": sum(store.live(now) for store in self._accounts.values()),
+            "accounts": len(self._accounts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _collect_metrics(self):
+        """Hit and miss counts of the cache, at scrape time"""
+        stats = self.stats()
+        labels = {"cache": "answers"}
+        return [
+            ("rag_cache_hits_total", "counter", "Number of cache lookups that found an entry", labels, stats["hits"]),
+            ("rag_cache_misses_total", "counter", "Number of cache lookups that found no entry", labels, stats["misses"]),
+            ("rag_cache_evictions_total", "counter", "Number of entries evicted from a full cache", labels, stats["evictions"]),
+            ("rag_cache_entries", "gauge", "Number of entries in a cache", labels, stats["size"]),
+        ]
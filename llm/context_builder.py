@@ -0,0 +1,157 @@
+import logging
+import os
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from llm.retrieval import SearchResult
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate the Gemini token count of a text, which averages about four characters per token"""
+    return len(text) // 4 + 1
+
+
+class ContextBuilder:
+    """
+    Builds the context of a prompt from retrieved passages:
+    - near-duplicate passages are dropped and the rest selected by Maximal Marginal Relevance,
+      so the budget is not spent on overlapping chunks of the same text
+    - the selection stops at a token budget, cutting the last passage short if it only partly fits
+    - the selected passages are written most relevant first, with their real relevance
+    """
+
+    def __init__(self, token_budget: Optional[int] = None, mmr_lambda: Optional[float] = None,
+                 duplicate_threshold: Optional[float] = None, min_passage_tokens: int = 64,
+                 count_tokens: Optional[Callable[[str], int]] = None):
+        """
+        Initialize the builder
+
+        Parameters:
+            token_budget: Maximum number of tokens of the context
+            mmr_lambda: Weight of relevance against novelty when selecting passages, between 0 and 1
+            duplicate_threshold: Cosine similarity above which a passage duplicates an already selected one
+            min_passage_tokens: A passage is only cut short if at least this many tokens of it fit
+            count_tokens: Counts the tokens of a text, defaults to an estimate for Gemini
+        """
+        self.token_budget = token_budget or int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+        self.mmr_lambda = mmr_lambda if mmr_lambda is not None else float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+        if duplicate_threshold is None:
+            duplicate_threshold = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.95"))
+        self.duplicate_threshold = duplicate_threshold
+        self.min_passage_tokens = min_passage_tokens
+        self.count_tokens = count_tokens or estimate_tokens
+
+    def build(self, passages: List[SearchResult]) -> Optional[str]:
+        """
+        Build the context from retrieved passages
+
+        Parameters:
+            passages: Retrieved passages or documents, best first, with their text and, when
+                available, their distance to the query and their embedding
+
+        Returns:
+            The context, or None if no passage has text
+        """
+        candidates = [passage for passage in passages if passage.text]
+        if not candidates:
+            return None
+
+        relevance = self._relevance(candidates)
+        selected = []
+        used_tokens = 0
+
+        for index in self._select(candidates, relevance):
+            passage = candidates[index]
+            header = self._header(passage)
+            text = passage.text
+
+            remaining = self.token_budget - used_tokens - self.count_tokens(header)
+            tokens = self.count_tokens(text)
+            if tokens > remaining:
+                if remaining < self.min_passage_tokens:
+                    continue
+                text = self._truncate(text, remaining)
+                tokens = self.count_tokens(text)
+
+            selected.append((relevance[index], f"{header}\n{text}\n"))
+            used_tokens += tokens + self.count_tokens(header)
+
+        if not selected:
+            return None
+
+        logger.debug(f"Built a context of {len(selected)} of {len(candidates)} passages, about {used_tokens} tokens")
+        selected.sort(key=lambda item: item[0], reverse=True)
+        return "\n".join(part for _, part in selected)
+
+    @staticmethod
+    def _relevance(passages: List[SearchResult]) -> List[float]:
+        """
+        Cosine similarity of every passage to the query. Passages without a distance, e.g. from a
+        lexical search, score below the least relevant passage with one, keeping their retrieval order.
+        """
+        known = [1.0 - p.distance for p in passages if p.distance is not None]
+        floor = min(known) if known else 1.0
+
+        relevance = []
+        unknown = 0
+        for passage in passages:
+            if passage.distance is not None:
+                relevance.append(1.0 - passage.distance)
+            else:
+                unknown += 1
+                relevance.append(floor - 0.01 * unknown)
+        return relevance
+
+    def _select(self, passages: List[SearchResult], relevance: List[float]) -> List[int]:
+        """Order the passages by Maximal Marginal Relevance, leaving out near duplicates"""
+        embeddings = [
+            None if passage.embedding is None else np.asarray(passage.embedding, dtype=np.float32)
+            for passage in passages
+        ]
+
+        remaining = list(range(len(passages)))
+        selected: List[int] = []
+        while remaining:
+            best, best_score = None, None
+            for index in list(remaining):
+                redundancy = max(
+                    (float(embeddings[index] @ embeddings[other]) for other in selected
+                     if embeddings[index] is not None and embeddings[other] is not None),
+                    default=0.0
+                )
+                if redundancy >= self.duplicate_threshold:
+                    remaining.remove(index)
+                    continue
+
+                score = self.mmr_lambda * relevance[index] - (1.0 - self.mmr_lambda) * redundancy
+                if best_score is None or score > best_score:
+                    best, best_score = index, score
+
+            if best is None:
+                break
+            selected.append(best)
+            remaining.remove(best)
+
+        return selected
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        """Cut a text at a word boundary so that it holds at most max_tokens tokens"""
+        words = text.split(" ")
+        low, high = 0, len(words)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(" ".join(words[:middle]) + "...") <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return " ".join(words[:low]) + "..."
+
+    @staticmethod
+    def _header(passage: SearchResult) -> str:
+        name = passage.name or f"Document {passage.document_id}"
+        if passage.distance is None:
+            return f"--- {name} ---"
+        return f"--- {name} (Relevance: {1.0 - passage.distance:.2f}) ---"
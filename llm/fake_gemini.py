@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+from typing import AsyncIterator, List, Optional
+
+
+class FakeGeminiModel:
+    """
+    A local stand-in for google.generativeai.GenerativeModel, for tests and benchmarks.
+    It answers every message with a fixed reply, streamed in fixed-size pieces.
+    """
+
+    def __init__(self, reply: str = "This is a fake Gemini response.", chunk_size: int = 8,
+                 first_token_delay: float = 0.0, chunk_delay: float = 0.0):
+        """
+        Initialize the fake model
+
+        Parameters:
+            reply: The text of every response
+            chunk_size: Number of characters per streamed chunk
+            first_token_delay: Seconds to wait before the first chunk
+            chunk_delay: Seconds to wait between chunks
+        """
+        self.reply = reply
+        self.chunk_size = chunk_size
+        self.first_token_delay = first_token_delay
+        self.chunk_delay = chunk_delay
+        self.sessions: List["FakeChatSession"] = []
+
+    def start_chat(self) -> "FakeChatSession":
+        session = FakeChatSession(self)
+        self.sessions.append(session)
+        return session
+
+
+class FakeChatSession:
+    """A chat session of FakeGeminiModel that records what was sent to it"""
+
+    def __init__(self, model: FakeGeminiModel):
+        self.model = model
+        self.history = []
+        self.sent_messages: List[str] = []
+
+    async def send_message_async(self, content: str, stream: bool = False):
+        self.sent_messages.append(content)
+        if stream:
+            return FakeStreamResponse(self.model)
+
+        await asyncio.sleep(self.model.first_token_delay)
+        return _response(self.model.reply)
+
+
+class FakeStreamResponse:
+    """An async iterable of response chunks, like a streamed GenerateContentResponse"""
+
+    def __init__(self, model: FakeGeminiModel):
+        self.model = model
+
+    async def __aiter__(self) -> AsyncIterator[SimpleNamespace]:
+        await asyncio.sleep(self.model.first_token_delay)
+        reply = self.model.reply
+        for start in range(0, len(reply), self.model.chunk_size):
+            if start:
+                await asyncio.sleep(self.model.chunk_delay)
+            yield _response(reply[start:start + self.model.chunk_size])
+
+
+def _response(text: Optional[str]) -> SimpleNamespace:
+    """Build an object shaped like a Gemini response holding a single text part"""
+    part = SimpleNamespace(text=text)
+    candidate = SimpleNamespace(content=SimpleNamespace(parts=[part]))
+    return SimpleNamespace(candidates=[candidate], text=text)
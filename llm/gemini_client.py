@@ -1,7 +1,8 @@
 import os
-from typing import List, Dict, Optional
+import time
+from typing import AsyncIterator, List, Dict, Optional
 
-import google.generativeai as genai
+from monitoring import get_startup_profile, observe_stage, timed
 
 
 class GeminiClient:
@@ -13,7 +14,19 @@ class GeminiClient:
             cls._instance = cls()
         return cls._instance
 
-    def __init__(self):
+    def __init__(self, gemini_model=None):
+        """
+        Initialize the client.
+
+        Parameters:
+            gemini_model: A model exposing start_chat(), e.g. a FakeGeminiModel; defaults to GEMINI_MODEL_ID
+        """
+        if gemini_model is not None:
+            self.gemini_model = gemini_model
+            return
+
+        # Only the real client needs the SDK, which takes a while to import
+        genai = get_startup_profile().import_module("google.generativeai")
         self.api_key = os.getenv("GEMINI_API_KEY")
         genai.configure(api_key=self.api_key)
         self.gemini_model = genai.GenerativeModel(os.getenv("GEMINI_MODEL_ID"))
@@ -24,28 +37,92 @@ class GeminiClient:
         role = "user" if message["sender"] != "assistant" else "model"
         return {"role": role, "parts": [message["text"]]}
 
-    async def generate_response(self, messages: List[Dict[str, str]], context: Optional[str] = None) -> str:
-        """Sends a chat session to Gemini AI and retrieves the response."""
+    @staticmethod
+    def extract_text(response) -> str:
+        """Concatenates the text parts of the first candidate of a response or stream chunk."""
+        text = ""
+        if response.candidates:
+            for candidate in response.candidates[:1]:
+                for part in candidate.content.parts:
+                    text += part.text  # Direct string since Python handles text differently
+        return text
+
+    def _start_chat(self, messages: List[Dict[str, str]], context: Optional[str] = None,
+                    summary: Optional[str] = None):
+        """
+        Starts a chat session holding the summary of the earlier conversation, every message but the last one,
+        and the context.
+        """
         chat_session = self.gemini_model.start_chat()
 
-        # Convert chat history (excluding the last message) to AI format
+        ai_messages = []
+        if summary:
+            ai_messages.append({"role": "user", "parts": [f"Summary of the earlier conversation:\n{summary}"]})
 
-        ai_messages = [self.to_genai_message(msg) for msg in messages[:-1] if msg["text"]]
+        # Convert chat history (excluding the last message) to AI format
+        ai_messages += [self.to_genai_message(msg) for msg in messages[:-1] if msg["text"]]
         if context:
             context_message = {"role": "user", "parts": [context]} if context else None
             ai_messages += [context_message]
 
         # Assign the history to the session
         chat_session.history = ai_messages
+        return chat_session
+
+    @timed("gemini.generate_response")
+    async def generate_response(self, messages: List[Dict[str, str]], context: Optional[str] = None,
+                                summary: Optional[str] = None) -> str:
+        """Sends a chat session to Gemini AI and retrieves the response."""
+        chat_session = self._start_chat(messages, context, summary)
 
-        # Send the last user message to Gemini
-        response = chat_session.send_message(messages[-1]["text"])
+        # Send the last user message to Gemini without blocking the event loop
+        response = await chat_session.send_message_async(messages[-1]["text"])
 
         # Extract the first candidate's response
-        text = ""
-        if response.candidates:
-            for candidate in response.candidates[:1]:
-                for part in candidate.content.parts:
-                    text += part.text  # Direct string since Python handles text differently
+        return self.extract_text(response)
 
-        return text
+    async def stream_response(self, messages: List[Dict[str, str]], context: Optional[str] = None,
+                              summary: Optional[str] = None) -> AsyncIterator[str]:
+        """Sends a chat session to Gemini AI and yields the response text as it is generated."""
+        chat_session = self._start_chat(messages, context, summary)
+
+        started_at = time.perf_counter()
+        response = await chat_session.send_message_async(messages[-1]["text"], stream=True)
+
+        first_chunk = True
+        async for chunk in response:
+            if first_chunk:
+                observe_stage("gemini.first_chunk", time.perf_counter() - started_at)
+                first_chunk = False
+            text = self.extract_text(chunk)
+            if text:
+                yield text
+
+        observe_stage("gemini.stream_response", time.perf_counter() - started_at)
+
+    @timed("gemini.summarize_conversation")
+    async def summarize_conversation(self, messages: List[Dict[str, str]], previous_summary: Optional[str] = None) -> str:
+        """
+        Summarizes chat messages, extending the summary of the messages before them.
+
+        Parameters:
+            messages: The messages to add to the summary
+            previous_summary: The summary of the earlier messages, if any
+
+        Returns:
+            The updated summary
+        """
+        transcript = "\n".join(
+            f"{'Assistant' if msg['sender'] == 'assistant' else 'User'}: {msg['text']}" for msg in messages if msg["text"]
+        )
+        prompt = (
+            "Summarize this conversation for an assistant that will continue it. Keep names, numbers, "
+            "decisions and open questions, and answer with the summary only, in at most 200 words.\n\n"
+        )
+        if previous_summary:
+            prompt += f"Summary of the conversation so far:\n{previous_summary}\n\n"
+        prompt += f"New messages:\n{transcript}"
+
+        chat_session = self.gemini_model.start_chat()
+        response = await chat_session.send_message_async(prompt)
+        return self.extract_text(response)
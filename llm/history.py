@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from db.connector import DatabaseConnector
+from llm.gemini_client import GeminiClient
+from llm.retrieval import TTLLRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class ChatSummary(NamedTuple):
+    """The rolling summary of the oldest messages of a chat"""
+    message_count: int
+    last_message_id: Optional[str]
+    text: Optional[str]
+
+
+class ConversationHistory:
+    """
+    Bounds the chat history sent to the LLM on every turn.
+    The last messages are sent verbatim and the older ones are replaced by a rolling summary.
+    Summaries are stored with the chat, cached per chat and extended in the background with the messages
+    that aged out of the window since, so answering only waits for them when older messages would be
+    dropped otherwise, e.g. for a chat that was never summarized.
+    """
+
+    def __init__(self, llm: GeminiClient, db: Optional[DatabaseConnector] = None,
+                 recent_messages: Optional[int] = None, summary_batch: Optional[int] = None):
+        """
+        Initialize the history manager
+
+        Parameters:
+            llm: The client used to summarize
+            db: Stores the summaries, so they outlive the cache and the worker; without it they are only cached
+            recent_messages: Number of messages before the question that are sent verbatim
+            summary_batch: Number of aged-out messages that triggers a summary refresh; until then they
+                are still sent verbatim, so at most recent_messages + 2 * summary_batch messages are sent
+        """
+        self.llm = llm
+        self.db = db
+        self.recent_messages = recent_messages if recent_messages is not None else int(
+            os.getenv("HISTORY_RECENT_MESSAGES", "8"))
+        self.summary_batch = summary_batch or int(os.getenv("HISTORY_SUMMARY_BATCH", "4"))
+        self.summaries = TTLLRUCache(
+            max_size=int(os.getenv("HISTORY_SUMMARY_CACHE_SIZE", "10000")),
+            ttl=float(os.getenv("HISTORY_SUMMARY_CACHE_TTL", "86400"))
+        )
+        self._refreshes: Dict[Any, asyncio.Task] = {}
+
+    async def window(self, chat_id: Any, messages: List[Dict[str, Any]]) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+        """
+        Select the history to send with the last message of a chat
+
+        Parameters:
+            chat_id: The chat the messages belong to
+            messages: Every message of the chat, the question last
+
+        Returns:
+            The summary of the older messages, if any, and the messages to send verbatim, the question last
+        """
+        keep = self.recent_messages + 1
+        if len(messages) <= keep:
+            return None, messages
+
+        older = messages[:-keep]
+        summary = await self._stored_summary(chat_id, older)
+        unsummarized = older[summary.message_count:]
+
+        if len(unsummarized) > 2 * self.summary_batch:
+            # More messages aged out than are sent verbatim, so the summary must cover them before answering
+            await asyncio.shield(self._schedule_refresh(chat_id, older, summary))
+            summary = await self._stored_summary(chat_id, older)
+            unsummarized = older[summary.message_count:]
+        elif len(unsummarized) >= self.summary_batch:
+            self._schedule_refresh(chat_id, older, summary)
+
+        # Until a refresh completes the newest aged-out messages stay verbatim, within a bound
+        verbatim = unsummarized[-2 * self.summary_batch:]
+        return summary.text, verbatim + messages[-keep:]
+
+    async def _stored_summary(self, chat_id: Any, older: List[Dict[str, Any]]) -> ChatSummary:
+        """
+        The summary of a chat, or an empty one if it is missing or no longer matches the messages.
+        The summary is read from the database when it is not cached, e.g. after a restart.
+        """
+        summary = self.summaries.get(chat_id)
+        if summary is None and self.db is not None:
+            try:
+                row = await self.db.get_chat_summary(chat_id)
+            except Exception as e:
+                logger.error(f"Error reading the summary of chat {chat_id}: {str(e)}")
+                row = None
+            if row is not None:
+                summary = ChatSummary(*row)
+                self.summaries.set(chat_id, summary)
+        return self._locate_summary(chat_id, summary, older)
+
+    @staticmethod
+    def _locate_summary(chat_id: Any, summary: Optional[ChatSummary], older: List[Dict[str, Any]]) -> ChatSummary:
+        """
+        Count the messages a summary covers in the loaded messages.
+        The summary is located by its last message, so it still applies when only the last messages of a
+        chat are loaded and older ones fell out of the list.
+        """
+        if summary is None:
+            return ChatSummary(0, None, None)
+
+        if summary.last_message_id is None:
+            return summary if summary.message_count <= len(older) else ChatSummary(0, None, None)
+
+        for position in range(len(older) - 1, -1, -1):
+            if older[position].get("id") == summary.last_message_id:
+                return summary._replace(message_count=position + 1)
+
+        logger.info(f"History of chat {chat_id} changed, summarizing it again")
+        return ChatSummary(0, None, None)
+
+    def _schedule_refresh(self, chat_id: Any, older: List[Dict[str, Any]], summary: ChatSummary) -> asyncio.Task:
+        """Extend the summary of a chat in the background, once at a time per chat"""
+        task = self._refreshes.get(chat_id)
+        if task is not None and not task.done():
+            return task
+
+        task = asyncio.get_running_loop().create_task(self._refresh(chat_id, list(older), summary))
+        self._refreshes[chat_id] = task
+        task.add_done_callback(lambda done: self._forget_refresh(chat_id, done))
+        return task
+
+    def _forget_refresh(self, chat_id: Any, task: asyncio.Task):
+        if self._refreshes.get(chat_id) is task:
+            del self._refreshes[chat_id]
+
+    async def _refresh(self, chat_id: Any, older: List[Dict[str, Any]], summary: ChatSummary):
+        try:
+            text = await self.llm.summarize_conversation(older[summary.message_count:], summary.text)
+            refreshed = ChatSummary(len(older), older[-1].get("id"), text)
+            self.summaries.set(chat_id, refreshed)
+            logger.info(f"Summarized {len(older)} messages of chat {chat_id}")
+            if self.db is not None:
+                await self.db.store_chat_summary(chat_id, *refreshed)
+        except Exception as e:
+            logger.error(f"Error summarizing chat {chat_id}: {str(e)}")
@@ -0,0 +1,72 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict
+
+from db.connector import DatabaseConnector
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseSink(ABC):
+    """Receives a response while it is being generated"""
+
+    @abstractmethod
+    async def write(self, text: str):
+        """
+        Receive the response generated so far
+
+        Parameters:
+            text: The full text generated so far, not only the new tokens
+        """
+        return NotImplemented
+
+    @abstractmethod
+    async def close(self, text: str):
+        """
+        Receive the complete response
+
+        Parameters:
+            text: The final text of the response
+        """
+        return NotImplemented
+
+
+class ChatMessageSink(ResponseSink):
+    """
+    Writes a partial response into its chat message, at most once per flush interval.
+    The first tokens are written immediately so the user sees the answer start as soon as possible.
+    """
+
+    def __init__(self, db: DatabaseConnector, chat_id: int, message: Dict[str, Any], flush_interval: float = 0.5):
+        """
+        Initialize the sink
+
+        Parameters:
+            db: The database connector
+            chat_id: The chat the response belongs to
+            message: The response message; its text is replaced on every flush
+            flush_interval: Minimum time in seconds between two writes of a partial response
+        """
+        self.db = db
+        self.chat_id = chat_id
+        self.message = message
+        self.flush_interval = flush_interval
+        self._last_flush = float("-inf")
+        self._flushed_text = None
+
+    async def write(self, text: str):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            await self._flush(text)
+
+    async def close(self, text: str):
+        await self._flush(text)
+
+    async def _flush(self, text: str):
+        if text == self._flushed_text:
+            return
+
+        self._last_flush = time.monotonic()
+        await self.db.upsert_chat_message(self.chat_id, {**self.message, "text": text})
+        self._flushed_text = text
+        logger.debug(f"Flushed {len(text)} characters to chat {self.chat_id}")
@@ -1,13 +1,233 @@
+import asyncio
+import hashlib
 import logging
 import json
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields, replace
+
 import numpy as np
-from typing import List, Dict, Any, Optional
-from sentence_transformers import SentenceTransformer
+from psycopg import OperationalError
+from typing import List, Dict, Any, Awaitable, Callable, Hashable, Optional, Tuple
 
-from db.connector import get_db_connector
+from db.connector import get_db_connector, INDEX_UPDATES_CHANNEL
+from monitoring import get_registry, timed
+from vector_store.backends import get_vector_backend
+from vector_store.embedding_batcher import EmbeddingBatcher
+from vector_store.embeddings import get_embedding_provider
+from vector_store.ranking_coalescer import RankingCoalescer
 
 logger = logging.getLogger(__name__)
 
+# 'vector' ranks by embedding distance, 'lexical' by full-text match, 'hybrid' fuses both rankings
+RETRIEVAL_MODES = ('vector', 'lexical', 'hybrid')
+
+# Raised while the database is unavailable: the caller should retry rather than answer without context
+TRANSIENT_ERRORS = (OperationalError, ConnectionError, TimeoutError)
+
+
+@dataclass(slots=True)
+class SearchResult:
+    """
+    A document or passage retrieved for a query.
+    Ranking fills its IDs and scores; only the results that are kept are then hydrated with their name and text.
+    """
+    document_id: int
+    chunk_id: Optional[str] = None
+    distance: Optional[float] = None
+    rank: Optional[float] = None
+    rrf_score: Optional[float] = None
+    embedding: Optional[np.ndarray] = None
+    chunk_index: Optional[int] = None
+    name: Optional[str] = None
+    text: Optional[str] = None
+
+    def merge(self, other: "SearchResult"):
+        """Fill the fields this result is missing from the same result found by another ranking"""
+        for field in fields(self):
+            if getattr(self, field.name) is None:
+                setattr(self, field.name, getattr(other, field.name))
+
+    def copy(self) -> "SearchResult":
+        """A copy that can be changed without changing this result, its embedding included"""
+        return replace(self, embedding=None if self.embedding is None else self.embedding.copy())
+
+
+def reciprocal_rank_fusion(rankings: List[List[SearchResult]], key: str, top_k: int,
+                           k: int = 60) -> List[SearchResult]:
+    """
+    Fuse several rankings of the same kind of items with Reciprocal Rank Fusion:
+    every item scores the sum of 1 / (k + rank) over the rankings it appears in.
+
+    Parameters:
+        rankings: The rankings to fuse, each one best first
+        key: The attribute identifying the same item across rankings
+        top_k: Number of items to return
+        k: Dampens the weight of the top ranks, 60 as in the original paper
+
+    Returns:
+        The best items by fused score, with the score in 'rrf_score' and the fields of every ranking
+    """
+    scores: Dict[Any, float] = {}
+    items: Dict[Any, SearchResult] = {}
+
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            item_key = getattr(item, key)
+            scores[item_key] = scores.get(item_key, 0.0) + 1.0 / (k + rank)
+            if item_key in items:
+                items[item_key].merge(item)
+            else:
+                items[item_key] = item
+
+    best = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    for item_key in best:
+        items[item_key].rrf_score = scores[item_key]
+    return [items[item_key] for item_key in best]
+
+
+class TTLLRUCache:
+    """
+    A bounded mapping that evicts the least recently used entry once full and expires entries after a TTL.
+    It is meant to be used from a single event loop and is not thread-safe.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+        Initialize the cache
+
+        Parameters:
+            max_size: Maximum number of entries
+            ttl: Time in seconds after which an entry expires
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Get the value of a key, or None if it is missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """Store a value, evicting the least recently used entries if the cache is full"""
+        if self.max_size <= 0:
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, predicate: Optional[Callable[[Hashable], bool]] = None) -> int:
+        """
+        Remove entries from the cache
+
+        Parameters:
+            predicate: Selects the keys to remove; every entry is removed if omitted
+
+        Returns:
+            The number of removed entries
+        """
+        if predicate is None:
+            removed = len(self._entries)
+            self._entries.clear()
+            return removed
+
+        keys = [key for key in self._entries if predicate(key)]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        """Size and hit-rate metrics of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class InvalidationClock:
+    """
+    Tells whether an account was invalidated since a given time, so that a cache does not store what was
+    computed from the documents an invalidation replaced meanwhile.
+    Only the last `max_accounts` invalidated accounts are remembered; the others count as invalidated when
+    the last of them was forgotten, which can only drop a write that was still valid, never keep a stale one.
+    It is meant to be used from a single event loop and is not thread-safe.
+    """
+
+    def __init__(self, max_accounts: int):
+        """
+        Initialize the clock
+
+        Parameters:
+            max_accounts: Maximum number of invalidated accounts remembered
+        """
+        self.max_accounts = max(max_accounts, 1)
+        self._time = 0
+        # Invalidation time of the accounts not remembered, and of every account after a global invalidation
+        self._forgotten_at = 0
+        # Keyed by account ID as a string, whether it came from a message or a notification, oldest first
+        self._invalidated_at: OrderedDict[str, int] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._invalidated_at)
+
+    def now(self) -> int:
+        """The current time, to take before reading what is cached and pass to changed_since"""
+        return self._time
+
+    def invalidate(self, account_id: Optional[Hashable] = None):
+        """
+        Record an invalidation
+
+        Parameters:
+            account_id: The account whose documents changed; every account if omitted
+        """
+        self._time += 1
+        if account_id is None:
+            self._forgotten_at = self._time
+            self._invalidated_at.clear()
+            return
+
+        account_id = str(account_id)
+        self._invalidated_at[account_id] = self._time
+        self._invalidated_at.move_to_end(account_id)
+        while len(self._invalidated_at) > self.max_accounts:
+            _, invalidated_at = self._invalidated_at.popitem(last=False)
+            self._forgotten_at = max(self._forgotten_at, invalidated_at)
+
+    def changed_since(self, account_id: Hashable, time: int) -> bool:
+        """Whether the account may have been invalidated after the given time"""
+        return self._invalidated_at.get(str(account_id), self._forgotten_at) > time
+
 
 class DocumentRetriever:
     """
@@ -25,35 +245,365 @@ class DocumentRetriever:
     def __init__(self):
         """Initialize the document retriever"""
         logger.info("Initializing Document Retriever")
-        self.model = SentenceTransformer("all-MiniLM-L6-v2")
+        self.embeddings = get_embedding_provider()
         self.db = get_db_connector()
+        self.backend = get_vector_backend()
+
+        # Normalized query text -> query embedding
+        self.embedding_cache = TTLLRUCache(
+            max_size=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "4096")),
+            ttl=float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "3600"))
+        )
+        # (kind, account_id, mode, query key, top_k, max_chars[, with_embeddings]) -> retrieved documents or passages
+        self.result_cache = TTLLRUCache(
+            max_size=int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024")),
+            ttl=float(os.getenv("RETRIEVAL_CACHE_TTL", "300"))
+        )
+        # Results retrieved while their account is invalidated are not cached
+        self.invalidations = InvalidationClock(self.result_cache.max_size)
+        # Questions arriving together, e.g. from many chats at once, are encoded in one model call
+        # and ranked in one statement or matrix product, then each caller gets its own results
+        batch_size = int(os.getenv("RETRIEVAL_BATCH_SIZE", "32"))
+        self.query_batcher = EmbeddingBatcher(
+            self.embeddings, max_batch_size=batch_size,
+            max_latency=float(os.getenv("QUERY_EMBEDDING_BATCH_WINDOW_MS", "20")) / 1000, flush_when_idle=True
+        )
+        self.chunk_ranker = RankingCoalescer(
+            "chunks",
+            rank=lambda request: self.backend.rank_chunks(*request),
+            rank_batch=lambda requests: self.backend.rank_chunks_batch(requests),
+            max_batch_size=batch_size
+        )
+        self.document_ranker = RankingCoalescer(
+            "documents",
+            rank=lambda request: self.db.rank_documents_by_embedding(*request[:3]),
+            rank_batch=lambda requests: self.db.rank_documents_by_embeddings([request[:3] for request in requests]),
+            max_batch_size=batch_size
+        )
+        self.default_mode = os.getenv("RETRIEVAL_MODE", "vector")
+        if self.default_mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode '{self.default_mode}', expected one of {RETRIEVAL_MODES}")
+        # Each ranking fused in hybrid mode contributes this many times top_k candidates
+        self.hybrid_candidates = int(os.getenv("HYBRID_CANDIDATES_FACTOR", "4"))
+        self.rrf_k = int(os.getenv("RRF_K", "60"))
+        # Retrieved texts are cut to this many characters when read, 0 reads them whole
+        self.max_text_chars = int(os.getenv("RETRIEVAL_MAX_TEXT_CHARS", "8000")) or None
+        self._invalidation_task: Optional[asyncio.Task] = None
+        self._invalidation_listeners: List[Callable[[Optional[int]], Any]] = []
+        get_registry().add_collector(self._collect_metrics)
         logger.info("Document retriever initialized")
 
-    async def retrieve_documents(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
+    async def retrieve_documents(self, query: str, account_id: int, top_k: int = 3, mode: Optional[str] = None,
+                                 max_chars: Optional[int] = None) -> List[SearchResult]:
         """
         Retrieve relevant documents for a query.
+        The documents are ranked by ID first, and only the top_k winners are read with their text.
 
         Parameters:
             query: The search query
+            account_id: The account whose documents are searched
             top_k: Number of most relevant documents to retrieve
+            mode: One of RETRIEVAL_MODES, defaults to the RETRIEVAL_MODE setting
+            max_chars: Length the text of every document is cut to, defaults to the RETRIEVAL_MAX_TEXT_CHARS setting
 
         Returns:
-            List of document dictionaries with text and metadata
+            The documents with their name, text, and distance, text search rank or fused score depending on the mode
         """
+        # Lexical searches never embed the query, so they start the listener too
+        self._ensure_invalidation_listener()
         try:
-            query_embedding = self.model.encode(query, show_progress_bar=False)
-            norm = np.linalg.norm(query_embedding)
-            if norm > 0:
-                query_embedding = query_embedding / norm
+            mode = self._check_mode(mode)
+            max_chars = max_chars or self.max_text_chars
+            query_embedding = await self.embed_query(query) if mode != "lexical" else None
 
-            # Get all documents with embeddings from the database
-            documents = self.db.query_documents_by_embedding(query_embedding, top_k)
+            cache_key = ("documents", account_id, mode, self._query_key(query, query_embedding), top_k, max_chars)
+            cached_at = self.invalidations.now()
+            documents = self._cached_results(cache_key)
+            if documents is None:
+                documents = await self._search(
+                    mode, top_k, key="document_id",
+                    vector_search=lambda limit: self._ranked_documents(
+                        self.document_ranker.rank(query_embedding, account_id, limit), "distance"),
+                    lexical_search=lambda limit: self._ranked_documents(
+                        self.db.rank_documents_by_text(query, account_id, limit), "rank")
+                )
+                documents = await self._hydrate_documents(documents, account_id, max_chars)
+                self._cache_results(cache_key, documents, cached_at)
             return documents
 
+        except TRANSIENT_ERRORS:
+            raise
         except Exception as e:
             logger.exception(f"Error retrieving documents: {str(e)}")
             return []
 
+    async def retrieve_passages(self, query: str, account_id: int, top_k: int = 5, mode: Optional[str] = None,
+                                max_chars: Optional[int] = None, with_embeddings: bool = False) -> List[SearchResult]:
+        """
+        Retrieve the document chunks that best match a query.
+        The chunks are ranked by ID first, and only the top_k winners are read with their text.
+
+        Parameters:
+            query: The search query
+            account_id: The account whose documents are searched
+            top_k: Number of passages to retrieve
+            mode: One of RETRIEVAL_MODES, defaults to the RETRIEVAL_MODE setting
+            max_chars: Length the text of every passage is cut to, defaults to the RETRIEVAL_MAX_TEXT_CHARS setting
+            with_embeddings: Also return the embedding of every passage
+
+        Returns:
+            The passages with their chunk text, document name, and distance, text search rank or fused
+            score depending on the mode
+        """
+        # Lexical searches never embed the query, so they start the listener too
+        self._ensure_invalidation_listener()
+        try:
+            mode = self._check_mode(mode)
+            max_chars = max_chars or self.max_text_chars
+            query_embedding = await self.embed_query(query) if mode != "lexical" else None
+            # Passages found only by the lexical search of hybrid mode get their distance from their embedding
+            read_embeddings = with_embeddings or mode == "hybrid"
+
+            cache_key = ("passages", account_id, mode, self._query_key(query, query_embedding), top_k, max_chars,
+                         with_embeddings)
+            cached_at = self.invalidations.now()
+            passages = self._cached_results(cache_key)
+            if passages is None:
+                passages = await self._search(
+                    mode, top_k, key="chunk_id",
+                    vector_search=lambda limit: self._ranked_chunks(
+                        self.chunk_ranker.rank(query_embedding, account_id, limit, read_embeddings), "distance"),
+                    lexical_search=lambda limit: self._ranked_chunks(
+                        self.db.rank_chunks_by_text(query, account_id, limit, read_embeddings), "rank")
+                )
+                self._fill_distances(passages, query_embedding)
+                if not with_embeddings:
+                    for passage in passages:
+                        passage.embedding = None
+                passages = await self._hydrate_chunks(passages, account_id, max_chars)
+                self._cache_results(cache_key, passages, cached_at)
+            return passages
+
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            logger.exception(f"Error retrieving passages: {str(e)}")
+            return []
+
+    def invalidate_account(self, account_id: int) -> int:
+        """
+        Drop the cached results of an account after its documents changed.
+
+        Parameters:
+            account_id: The account whose results are dropped
+
+        Returns:
+            The number of dropped entries
+        """
+        self.invalidations.invalidate(account_id)
+        removed = self.result_cache.invalidate(lambda key: str(key[1]) == str(account_id))
+        logger.debug(f"Invalidated {removed} cached retrieval results for account {account_id}")
+        for listener in self._invalidation_listeners:
+            listener(account_id)
+        return removed
+
+    def add_invalidation_listener(self, listener: Callable[[Optional[int]], Any]):
+        """
+        Get notified whenever cached results are dropped, e.g. to drop what was built from them too
+
+        Parameters:
+            listener: Called with the account whose documents changed, or None if any may have
+        """
+        self._invalidation_listeners.append(listener)
+
+    def cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Hit-rate and size metrics of both cache tiers"""
+        return {
+            "query_embeddings": self.embedding_cache.stats(),
+            "results": self.result_cache.stats(),
+        }
+
+    def _cached_results(self, cache_key: Tuple) -> Optional[List[SearchResult]]:
+        """Copies of the cached results of a retrieval, which the caller is free to change, or None"""
+        results = self.result_cache.get(cache_key)
+        return None if results is None else [result.copy() for result in results]
+
+    def _cache_results(self, cache_key: Tuple, results: List[SearchResult], cached_at: int):
+        """
+        Cache copies of the results of a retrieval, unless their account was invalidated while they were retrieved
+
+        Parameters:
+            cache_key: The key of the retrieval, its account ID second
+            results: The results returned to the caller
+            cached_at: The invalidation time taken before the cache lookup
+        """
+        if self.invalidations.changed_since(cache_key[1], cached_at):
+            logger.debug(f"Not caching results for account {cache_key[1]}, its documents changed meanwhile")
+            return
+        self.result_cache.set(cache_key, tuple(result.copy() for result in results))
+
+    def _check_mode(self, mode: Optional[str]) -> str:
+        mode = mode or self.default_mode
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode '{mode}', expected one of {RETRIEVAL_MODES}")
+        return mode
+
+    async def _search(self, mode: str, top_k: int, key: str,
+                      vector_search: Callable[[int], Awaitable[List[SearchResult]]],
+                      lexical_search: Callable[[int], Awaitable[List[SearchResult]]]) -> List[SearchResult]:
+        """
+        Run the searches of a retrieval mode, fusing both rankings with RRF in hybrid mode
+
+        Parameters:
+            mode: One of RETRIEVAL_MODES
+            top_k: Number of results to return
+            key: The result attribute identifying the same result in both rankings
+            vector_search: Ranks by embedding distance, given the number of results
+            lexical_search: Ranks by full-text match, given the number of results
+
+        Returns:
+            The results, best first
+        """
+        with timed(f"retrieval.{mode}_search"):
+            if mode == "vector":
+                return await vector_search(top_k)
+            if mode == "lexical":
+                return await lexical_search(top_k)
+
+            candidates = top_k * self.hybrid_candidates
+            vector_ranking, lexical_ranking = await asyncio.gather(vector_search(candidates), lexical_search(candidates))
+            return reciprocal_rank_fusion([vector_ranking, lexical_ranking], key=key, top_k=top_k, k=self.rrf_k)
+
+    @staticmethod
+    async def _ranked_documents(ranking: Awaitable[List[Tuple[int, float]]], score: str) -> List[SearchResult]:
+        """Wrap the (document ID, score) rows of a ranking query, the score being a 'distance' or a 'rank'"""
+        return [SearchResult(document_id, **{score: value}) for document_id, value in await ranking]
+
+    @staticmethod
+    async def _ranked_chunks(ranking: Awaitable[List[Tuple[str, int, float, Optional[np.ndarray]]]],
+                             score: str) -> List[SearchResult]:
+        """Wrap the (chunk ID, document ID, score, embedding) rows of a ranking query"""
+        return [
+            SearchResult(document_id, chunk_id=chunk_id, embedding=embedding, **{score: value})
+            for chunk_id, document_id, value, embedding in await ranking
+        ]
+
+    async def _hydrate_documents(self, documents: List[SearchResult], account_id: int,
+                                 max_chars: Optional[int]) -> List[SearchResult]:
+        """Read the name and text of the ranked documents, dropping the ones deleted since"""
+        if not documents:
+            return documents
+
+        with timed("retrieval.hydrate"):
+            rows = await self.db.hydrate_documents([d.document_id for d in documents], account_id, max_chars)
+
+        hydrated = []
+        for document in documents:
+            row = rows.get(document.document_id)
+            if row is not None:
+                document.name, document.text = row
+                hydrated.append(document)
+        return hydrated
+
+    async def _hydrate_chunks(self, passages: List[SearchResult], account_id: int,
+                              max_chars: Optional[int]) -> List[SearchResult]:
+        """Read the text and document name of the ranked passages, dropping the chunks replaced since"""
+        if not passages:
+            return passages
+
+        with timed("retrieval.hydrate"):
+            rows = await self.db.hydrate_chunks([p.chunk_id for p in passages], account_id, max_chars)
+
+        hydrated = []
+        for passage in passages:
+            row = rows.get(passage.chunk_id)
+            if row is not None:
+                passage.chunk_index, passage.name, passage.text = row
+                hydrated.append(passage)
+        return hydrated
+
+    @staticmethod
+    def _fill_distances(results: List[SearchResult], query_embedding: Optional[np.ndarray]):
+        """Give the results found only by the lexical search of hybrid mode their distance to the query too"""
+        if query_embedding is None:
+            return
+        for result in results:
+            if result.distance is None and result.embedding is not None:
+                result.distance = float(1.0 - np.dot(np.asarray(result.embedding, dtype=np.float32), query_embedding))
+
+    def _collect_metrics(self):
+        """Hit and miss counts of both cache tiers, at scrape time"""
+        samples = []
+        for cache, stats in self.cache_stats().items():
+            labels = {"cache": cache}
+            samples += [
+                ("rag_cache_hits_total", "counter", "Number of cache lookups that found an entry", labels, stats["hits"]),
+                ("rag_cache_misses_total", "counter", "Number of cache lookups that found no entry", labels, stats["misses"]),
+                ("rag_cache_evictions_total", "counter", "Number of entries evicted from a full cache", labels, stats["evictions"]),
+                ("rag_cache_entries", "gauge", "Number of entries in a cache", labels, stats["size"]),
+            ]
+        return samples
+
+    async def embed_query(self, query: str) -> np.ndarray:
+        """
+        Encode a query with the shared embedding provider, in one batch with the queries encoded concurrently,
+        reusing the embedding of an identical earlier query.
+
+        Parameters:
+            query: The search query
+
+        Returns:
+            The normalized query embedding
+        """
+        self._ensure_invalidation_listener()
+
+        cache_key = self._normalize_query(query)
+        query_embedding = self.embedding_cache.get(cache_key)
+        if query_embedding is None:
+            with timed("retrieval.embed_query"):
+                embeddings = await self.query_batcher.embed([query])
+            query_embedding = embeddings[0]
+            self.embedding_cache.set(cache_key, query_embedding)
+        return query_embedding
+
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        """Collapse case and whitespace so trivially different spellings share a cache entry"""
+        return re.sub(r'\s+', ' ', query).strip().lower()
+
+    def _query_key(self, query: str, query_embedding: Optional[np.ndarray]) -> str:
+        """Identify a query for the result cache; lexical results depend on its text rather than its embedding"""
+        if query_embedding is None:
+            return self._normalize_query(query)
+        return self._embedding_hash(query_embedding)
+
+    @staticmethod
+    def _embedding_hash(embedding: np.ndarray) -> str:
+        return hashlib.blake2b(np.ascontiguousarray(embedding, dtype=np.float32).tobytes(), digest_size=16).hexdigest()
+
+    def _ensure_invalidation_listener(self):
+        """Start listening for index updates from the indexing workers, once per event loop"""
+        if self._invalidation_task is None or self._invalidation_task.done():
+            self._invalidation_task = asyncio.get_running_loop().create_task(self._listen_for_index_updates())
+
+    async def _listen_for_index_updates(self):
+        """Invalidate cached results when an account's documents are re-indexed, reconnecting on errors"""
+        while True:
+            try:
+                async for payload in self.db.listen(INDEX_UPDATES_CHANNEL):
+                    self.invalidate_account(int(payload))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Lost index update notifications: {str(e)}")
+
+            # Updates may have been missed while disconnected
+            self.invalidations.invalidate()
+            self.result_cache.invalidate()
+            for listener in self._invalidation_listeners:
+                listener(None)
+            await asyncio.sleep(5)
+
     async def _get_documents_with_embeddings(self) -> List[Dict[str, Any]]:
         """
         Get all documents with embeddings from the database.
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from db import get_db_connector
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Copy the chats.messages arrays into the chat_messages table")
+    parser.add_argument("--batch-size", type=int, default=100, help="Chats copied per transaction")
+    parser.add_argument("--checkpoint", default="chat_messages_migration.checkpoint.json",
+                        help="Progress file to resume from")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the beginning")
+    return parser.parse_args()
+
+
+def parse_timestamp(value: Any) -> Optional[datetime]:
+    """Parse the ISO 8601 timestamp of a message, or return None if it has none or it is malformed"""
+    if not isinstance(value, str):
+        return None
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+
+
+def message_rows(chat_id: int, messages: List[Any]) -> List[Tuple[int, str, datetime, Dict[str, Any]]]:
+    """
+    Turn the messages array of a chat into chat_messages rows.
+    Creation times never go backwards, so reading the rows by time keeps the order of the array.
+    """
+    messages = [message for message in messages if isinstance(message, dict)]
+    timestamps = [parse_timestamp(message.get("timestamp")) for message in messages]
+    created_at = next((t for t in timestamps if t is not None), datetime.now(timezone.utc))
+
+    rows = []
+    for position, (message, timestamp) in enumerate(zip(messages, timestamps)):
+        if timestamp is not None and timestamp > created_at:
+            created_at = timestamp
+        message_id = str(message.get("id") or f"legacy-{position}")
+        rows.append((chat_id, message_id, created_at, message))
+    return rows
+
+
+def load_checkpoint(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    with open(path) as checkpoint:
+        return json.load(checkpoint)["after_id"]
+
+
+def save_checkpoint(path: str, after_id: int):
+    # Written to a temporary file first, so an interruption never leaves a truncated checkpoint
+    with open(f"{path}.tmp", "w") as checkpoint:
+        json.dump({"after_id": after_id}, checkpoint)
+    os.replace(f"{path}.tmp", path)
+
+
+async def main():
+    args = parse_args()
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    db = get_db_connector()
+    after_id = load_checkpoint(args.checkpoint)
+    if after_id:
+        logger.info(f"Resuming after chat {after_id}")
+
+    chats = messages = 0
+    async for batch in db.iter_chat_histories(after_id, args.batch_size):
+        rows = [row for chat_id, history in batch for row in message_rows(chat_id, history or [])]
+        inserted = await db.insert_chat_messages(rows)
+
+        chats += len(batch)
+        messages += inserted
+        save_checkpoint(args.checkpoint, batch[-1][0])
+        logger.info(f"Copied {chats} chats, {messages} new messages, up to chat {batch[-1][0]}")
+
+    await db.close()
+    logger.info(f"Done: {chats} chats, {messages} new messages")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(main())
@@ -0,0 +1,14 @@
+from monitoring.metrics import get_registry, MetricsRegistry
+from monitoring.server import start_metrics_server
+from monitoring.startup import get_startup_profile, StartupProfile
+from monitoring.timing import timed, observe_stage
+
+__all__ = [
+    'get_registry',
+    'MetricsRegistry',
+    'start_metrics_server',
+    'get_startup_profile',
+    'StartupProfile',
+    'timed',
+    'observe_stage'
+]
@@ -0,0 +1,56 @@
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from monitoring.metrics import get_registry
+
+logger = logging.getLogger(__name__)
+
+_server: Optional[ThreadingHTTPServer] = None
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = get_registry().render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to log at the default level
+        logger.debug(format, *args)
+
+
+def start_metrics_server(port: Optional[int] = None, host: Optional[str] = None) -> Optional[ThreadingHTTPServer]:
+    """
+    Serve the metrics of the process at /metrics in the Prometheus text format, from a background thread
+
+    Parameters:
+        port: The port to listen on, defaults to METRICS_PORT; the server is not started if it is unset or 0
+        host: The address to listen on, defaults to METRICS_HOST or 127.0.0.1
+
+    Returns:
+        The running server, or None if it is disabled
+    """
+    global _server
+    if _server is not None:
+        return _server
+
+    port = port if port is not None else int(os.getenv("METRICS_PORT", "0"))
+    if not port:
+        return None
+
+    host = host or os.getenv("METRICS_HOST", "127.0.0.1")
+    _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return _server
@@ -0,0 +1,89 @@
+import importlib
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from types import ModuleType
+from typing import Dict, Iterator, Optional
+
+from monitoring.metrics import get_registry
+
+logger = logging.getLogger(__name__)
+
+
+class StartupProfile:
+    """
+    Records how long each step of a worker's cold start takes: the imports of heavy dependencies and the
+    initialization stages (env, pool, model, subscriber...), reported once the worker is ready for messages.
+    Stages may nest, e.g. an import timed while the consumer is created, so their durations do not add up
+    to the total.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.ready_after: Optional[float] = None
+        self._lock = threading.Lock()
+        get_registry().add_collector(self._collect_metrics)
+
+    def restart(self):
+        """Start over, e.g. in a forked worker that inherited the records of its parent"""
+        with self._lock:
+            self.started_at = time.perf_counter()
+            self.stages = {}
+            self.ready_after = None
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """Time a block as a startup stage"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started_at)
+
+    def import_module(self, name: str) -> ModuleType:
+        """Import a module on first use, timing the import if it was not imported yet"""
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+        with self.stage(f"import {name}"):
+            return importlib.import_module(name)
+
+    def report(self):
+        """Log the duration of every stage and of the whole startup, once"""
+        with self._lock:
+            if self.ready_after is not None:
+                return
+            self.ready_after = time.perf_counter() - self.started_at
+            stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in self.stages.items())
+        logger.info(f"Ready after {self.ready_after:.2f}s ({stages})")
+
+    def _collect_metrics(self):
+        """The startup durations, at scrape time"""
+        with self._lock:
+            samples = [
+                ("rag_startup_stage_seconds", "gauge", "Duration of a startup stage of the worker", {"stage": stage},
+                 seconds)
+                for stage, seconds in self.stages.items()
+            ]
+            if self.ready_after is not None:
+                samples.append(("rag_startup_seconds", "gauge", "Time from the worker start until it was ready",
+                                {}, self.ready_after))
+        return samples
+
+
+def get_startup_profile() -> StartupProfile:
+    return StartupProfile.get_instance()
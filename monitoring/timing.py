@@ -0,0 +1,84 @@
+import functools
+import inspect
+import logging
+import os
+import time
+from typing import Optional
+
+from monitoring.metrics import get_registry
+
+logger = logging.getLogger(__name__)
+
+STAGE_DURATION = get_registry().histogram(
+    "rag_stage_duration_seconds", "Duration of a processing stage", ("stage",)
+)
+STAGE_ERRORS = get_registry().counter(
+    "rag_stage_errors_total", "Number of processing stages that raised an exception", ("stage",)
+)
+
+_tracer = None
+_tracer_loaded = False
+
+
+def _get_tracer():
+    """The OpenTelemetry tracer if OTEL_SPANS_ENABLED is set and the API is installed, None otherwise"""
+    global _tracer, _tracer_loaded
+    if not _tracer_loaded:
+        _tracer_loaded = True
+        if os.getenv("OTEL_SPANS_ENABLED", "false").lower() == "true":
+            try:
+                from opentelemetry import trace
+                _tracer = trace.get_tracer("rag-api")
+            except ImportError:
+                logger.warning("OTEL_SPANS_ENABLED is set but opentelemetry-api is not installed, spans are disabled")
+    return _tracer
+
+
+def observe_stage(stage: str, seconds: float):
+    """Record the duration of a stage timed elsewhere"""
+    STAGE_DURATION.observe(seconds, stage=stage)
+
+
+class timed:
+    """
+    Times a processing stage into the rag_stage_duration_seconds histogram, and into an OpenTelemetry span
+    if enabled. Use it as a context manager around a block, or as a decorator of a function or coroutine function.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self._started_at: Optional[float] = None
+        self._span = None
+
+    def __enter__(self):
+        tracer = _get_tracer()
+        if tracer is not None:
+            self._span = tracer.start_as_current_span(self.stage)
+            self._span.__enter__()
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe_stage(self.stage, time.perf_counter() - self._started_at)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(stage=self.stage)
+        if self._span is not None:
+            self._span.__exit__(exc_type, exc_value, traceback)
+            self._span = None
+        return False
+
+    def __call__(self, function):
+        stage = self.stage
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with timed(stage):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return function(*args, **kwargs)
+        return wrapper
@@ -1,9 +1,16 @@
+import os
+import time
 from datetime import datetime
-from typing import Dict, Any, List, Optional
+from typing import Callable, Dict, Any, List, Optional
 from zoneinfo import ZoneInfo
 
 from db import DatabaseConnector, get_db_connector
-from llm import GeminiClient, get_document_retriever
+from llm import GeminiClient, SearchResult, get_document_retriever
+from llm.answer_cache import SemanticAnswerCache
+from llm.context_builder import ContextBuilder
+from llm.history import ConversationHistory
+from llm.response_sinks import ChatMessageSink, ResponseSink
+from monitoring import observe_stage, timed
 from pub_sub_consummer.pub_sub_consumer import PubSubConsumer
 
 
@@ -11,29 +18,68 @@ class AiAssistantConsumer(PubSubConsumer):
 
     __subscription_id__ = "AiAssistant-sub"
 
-    def __init__(self):
-        """Initialize the consumer with LLM client and document retriever"""
-        super().__init__()
+    def __init__(self, response_sink_factory: Optional[Callable[[int, Dict[str, Any]], ResponseSink]] = None,
+                 subscriber=None):
+        """
+        Initialize the consumer with LLM client and document retriever
+
+        Args:
+            response_sink_factory: Builds the sink of a streamed response from the chat ID and the
+                response message; defaults to writing the partial response into the chat
+            subscriber: A Pub/Sub subscriber client, defaults to a new SubscriberClient
+        """
+        super().__init__(subscriber)
         self.llm = GeminiClient.get_instance()
         self.retriever = get_document_retriever()
         self.db: DatabaseConnector = get_db_connector()
+        self.context_builder = ContextBuilder()
+        self.history = ConversationHistory(self.llm, self.db)
+        # Messages without a history are answered from the last messages stored for their chat
+        self.chat_history_limit = int(os.getenv("CHAT_HISTORY_LIMIT", "50"))
+        # More passages are retrieved than fit in the context, so near duplicates can be skipped
+        self.context_candidates = int(os.getenv("CONTEXT_CANDIDATES", "10"))
+
+        self.stream_responses = os.getenv("STREAM_RESPONSES", "true").lower() == "true"
+        self.stream_flush_interval = float(os.getenv("STREAM_FLUSH_INTERVAL_MS", "500")) / 1000
+        self.response_sink_factory = response_sink_factory or self._chat_message_sink
+
+        # Opt-in: answers to a chat's first question are reused for close enough questions of the account
+        self.answer_cache: Optional[SemanticAnswerCache] = None
+        if os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true":
+            self.answer_cache = SemanticAnswerCache()
+            self.retriever.add_invalidation_listener(self.answer_cache.invalidate)
         self.logger.info("AI assistant consumer initialized")
 
+    async def startup(self):
+        # Connect while the worker starts rather than on its first message
+        await self.db.open()
+
+    @timed("assistant.callback")
     async def callback(self, message: Dict[str, Any]):
         """
         Process a message and generate a response.
 
         Args:
-            message: A dictionary containing 'messages' list
+            message: A dictionary containing 'chat_id', 'account_id' and optionally the 'messages' list,
+                which is otherwise read from the database
         """
         try:
             chat_id = message.get("chat_id")
-            messages = message.get("messages", [])
+            account_id = message.get("account_id")
+            messages = message.get("messages")
+
+            if messages is None and chat_id is not None:
+                with timed("assistant.load_history"):
+                    messages = await self.db.get_recent_chat_messages(chat_id, self.chat_history_limit)
 
             if not messages:
                 self.logger.error("Invalid message: missing or empty messages list")
                 return
 
+            if not account_id:
+                self.logger.error(f"Invalid message for chat {chat_id}: missing account_id")
+                return
+
             # Get the last message (the user's question)
             last_message = messages[-1]
             query_text = last_message.get("text", "")
@@ -44,22 +90,57 @@ class AiAssistantConsumer(PubSubConsumer):
 
             self.logger.info(f"Processing query: {query_text}")
 
-            # Retrieve relevant documents
-            relevant_docs = await self.retriever.retrieve_documents(query_text, top_k=3)
+            # Later questions depend on the earlier turns of their chat, so only first questions share answers
+            use_answer_cache = self.answer_cache is not None and len(messages) == 1
+            if use_answer_cache:
+                cache_generation = self.answer_cache.generation()
 
-            # Prepare context from retrieved documents
-            context = self._prepare_context(relevant_docs)
-
-            # Generate response using LLM
-            response_text = await self.llm.generate_response(messages, context)
+            # Retrieve the passages that best match the question
+            with timed("assistant.retrieve"):
+                # The embeddings let the context builder leave out near-duplicate passages
+                relevant_passages = await self.retriever.retrieve_passages(
+                    query_text, account_id, top_k=self.context_candidates, with_embeddings=True
+                )
 
-            # Create response message
-            response_message = self._create_response_message(response_text)
+            if use_answer_cache:
+                query_embedding = await self.retriever.embed_query(query_text)
+                fingerprint = self.answer_cache.fingerprint(relevant_passages)
+                cached_answer = self.answer_cache.get(account_id, query_embedding, fingerprint)
+                if cached_answer is not None:
+                    with timed("assistant.cached_answer"):
+                        await self._send_answer(chat_id, last_message, cached_answer)
+                    self.logger.info(f"Answered chat {chat_id} from the answer cache")
+                    return
+
+            # Prepare context from retrieved passages
+            with timed("assistant.prepare_context"):
+                context = self._prepare_context(relevant_passages)
+
+            # Send the latest messages verbatim and a summary of the older ones
+            summary, messages = await self.history.window(chat_id, messages)
+
+            if self.stream_responses:
+                # Stream the response into the chat as it is generated
+                response_message = self._create_response_message("", last_message)
+                sink = self.response_sink_factory(chat_id, response_message)
+                with timed("assistant.stream_response"):
+                    response_text = await self._stream_response(messages, context, sink, summary)
+            else:
+                # Generate response using LLM
+                with timed("assistant.generate_response"):
+                    response_text = await self.llm.generate_response(messages, context, summary)
+
+                # Create response message
+                response_message = self._create_response_message(response_text, last_message)
+
+                with timed("assistant.store_response"):
+                    await self.db.upsert_chat_message(chat_id, response_message)
+
+            if use_answer_cache and response_text:
+                self.answer_cache.set(account_id, query_embedding, fingerprint, response_text, cache_generation)
 
             self.logger.info(f"Generated response: {response_text[:100]}...")
 
-            self.db.add_message_to_chat(chat_id=chat_id, message=response_message)
-
         except Exception as e:
             self.logger.exception(f"Error processing message: {str(e)}")
 
@@ -72,9 +153,52 @@ class AiAssistantConsumer(PubSubConsumer):
                 if isinstance(message.get("messages"), list):
                     message["messages"].append(error_message)
 
-            except Exception as e:
+            except Exception:
                 self.logger.exception("Error creating error response")
 
+            # Only a retry may succeed where the database or Gemini was unavailable; other errors
+            # would fail again on every redelivery, so their message is acked
+            if self.is_transient_error(e):
+                raise
+            self.logger.error(f"Dropping message for chat {message.get('chat_id')} after a permanent error")
+
+    async def _stream_response(self, messages: List[Dict[str, Any]], context: Optional[str],
+                               sink: ResponseSink, summary: Optional[str] = None) -> str:
+        """
+        Stream the LLM response into a sink.
+
+        Parameters:
+            messages: The chat messages
+            context: The context prepared from the retrieved passages
+            sink: Receives the partial and final response
+            summary: The summary of the messages older than the given ones
+
+        Returns:
+            The complete response text
+        """
+        response_text = ""
+        started_at = time.perf_counter()
+        async for text in self.llm.stream_response(messages, context, summary):
+            if not response_text:
+                observe_stage("assistant.first_token", time.perf_counter() - started_at)
+            response_text += text
+            await sink.write(response_text)
+
+        with timed("assistant.store_response"):
+            await sink.close(response_text)
+        return response_text
+
+    async def _send_answer(self, chat_id: int, question: Dict[str, Any], text: str):
+        """Write a complete answer into the chat, the way generated answers are written"""
+        response_message = self._create_response_message(text, question)
+        if self.stream_responses:
+            await self.response_sink_factory(chat_id, response_message).close(text)
+        else:
+            await self.db.upsert_chat_message(chat_id, response_message)
+
+    def _chat_message_sink(self, chat_id: int, message: Dict[str, Any]) -> ResponseSink:
+        return ChatMessageSink(self.db, chat_id, message, self.stream_flush_interval)
+
     @staticmethod
     def _get_time():
         tz = ZoneInfo("America/New_York")
@@ -86,59 +210,36 @@ class AiAssistantConsumer(PubSubConsumer):
         formatted_time = formatted_time[:-2] + ":" + formatted_time[-2:]  # Format timezone offset
         return formatted_time
 
-    def _create_response_message(self, text: str) -> Dict[str, Any]:
+    def _create_response_message(self, text: str, question: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
         Create a response message dictionary.
+        The response to a question always gets the same ID, so when its message is redelivered the
+        response written by an earlier attempt, possibly partial, is overwritten rather than duplicated.
 
         Parameters:
             text: The response text
+            question: The message answered, if any
 
         Returns:
             A message dictionary
         """
         formatted_time = self._get_time()
+        question_id = question.get("id") if question else None
         return {
-            "id": f"msg{formatted_time}",
+            "id": f"{question_id}-response" if question_id else f"msg{formatted_time}",
             "timestamp": formatted_time,
             "sender": "assistant",
             "text": text
         }
 
-    def _prepare_context(self, documents: List[Dict[str, Any]]) -> Optional[str]:
+    def _prepare_context(self, documents: List[SearchResult]) -> Optional[str]:
         """
-        Prepare context from retrieved documents.
+        Prepare context from retrieved documents or passages, within the context token budget.
 
         Parameters:
-            documents: List of document dictionaries
+            documents: Retrieved documents or passages, best first
 
         Returns:
             Context string or None if no documents
         """
-        if not documents:
-            return None
-
-        context_parts = []
-
-        for i, doc in enumerate(documents, 1):
-            doc_text = doc.get("text", "")
-
-            if not doc_text:
-                continue
-
-            # Limit text length to avoid context overload
-            if len(doc_text) > 1500:
-                doc_text = doc_text[:1500] + "..."
-
-            doc_name = doc.get("name", f"Document {doc.get('id', i)}")
-            similarity = doc.get("similarity", 0.0)
-
-            # Add document to context
-            context_parts.append(f"--- {doc_name} (Relevance: {similarity:.2f}) ---\n{doc_text}\n")
-
-        if not context_parts:
-            return None
-
-        return "\n".join(context_parts)
-
-
-
+        return self.context_builder.build(documents)
@@ -1,11 +1,16 @@
-from typing import Dict, Any, Optional
+import asyncio
+import os
+from typing import Dict, Any, List, Tuple
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
 
 from db.connector import get_db_connector
+from monitoring import timed
 from pub_sub_consummer.pub_sub_consumer import PubSubConsumer
-from vector_store.chunking import chunk_text
+from vector_store.backends import get_vector_backend
+from vector_store.chunking import chunk_document, content_hash
+from vector_store.embedding_batcher import EmbeddingBatcher
+from vector_store.embeddings import get_embedding_provider, mean_embedding
 
 
 class DocumentIndexingConsumer(PubSubConsumer):
@@ -15,13 +20,29 @@ class DocumentIndexingConsumer(PubSubConsumer):
     """
     __subscription_id__ = "DocumentIndexing-sub"
 
-    def __init__(self):
-        """Initialize the consumer with the embedding model and database connector"""
-        super().__init__()
-        self.model = SentenceTransformer("all-MiniLM-L6-v2")
+    def __init__(self, subscriber=None):
+        """
+        Initialize the consumer with the embedding model and database connector
+
+        Args:
+            subscriber: A Pub/Sub subscriber client, defaults to a new SubscriberClient
+        """
+        super().__init__(subscriber)
+        self.embeddings = get_embedding_provider()
+        self.batcher = EmbeddingBatcher(self.embeddings)
+        self.chunk_max_tokens = int(os.getenv("CHUNK_MAX_TOKENS", "0")) or None
+        self.chunk_overlap_tokens = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
         self.db = get_db_connector()
+        self.vector_backend = get_vector_backend()
         self.logger.info("Document indexing consumer initialized")
 
+    async def startup(self):
+        # Connect and load the model while the worker starts rather than on its first message;
+        # loading takes seconds, so it runs off the event loop
+        await self.db.open()
+        await asyncio.to_thread(self.embeddings.load)
+
+    @timed("indexing.callback")
     async def callback(self, message: Dict[str, Any]):
         """
         Process a document indexing message
@@ -43,50 +64,98 @@ class DocumentIndexingConsumer(PubSubConsumer):
 
             self.logger.info(f"Processing document {document_id} with {len(document_text)} characters")
 
-            embedding = self._generate_document_embedding(document_text)
+            chunks, chunk_embeddings = await self._generate_chunk_embeddings(document_id, document_text)
+            embedding = mean_embedding(chunk_embeddings)
+            with timed("indexing.store"):
+                stored = await self.db.store_document_indexes([(document_id, embedding, chunks, chunk_embeddings)])
 
-            if embedding is not None:
-                success = self.db.update_document_embedding(document_id, embedding)
+            if document_id not in stored:
+                self.logger.error(f"Failed to update document {document_id} in the database")
+                return
+
+            with timed("indexing.backend_sync"):
+                await self.vector_backend.upsert_document(
+                    stored[document_id], document_id, [chunk['chunk_id'] for chunk in chunks], chunk_embeddings
+                )
 
-                if success:
-                    self.logger.info(f"Successfully indexed document {document_id}")
-                else:
-                    self.logger.error(f"Failed to update document {document_id} in the database")
+            self.logger.info(f"Successfully indexed document {document_id}")
 
         except Exception as e:
             self.logger.exception(f"Error processing document {message.get('document_id', 'unknown')}: {str(e)}")
 
-    def _generate_document_embedding(self, text: str, chunk_size: int = 500, chunk_overlap: int = 50) -> Optional[
-        np.ndarray]:
+            # Only a retry may succeed where the database was unavailable; other errors would fail again
+            # on every redelivery, so their message is acked
+            if self.is_transient_error(e):
+                raise
+            self.logger.error(f"Dropping document {message.get('document_id', 'unknown')} after a permanent error")
+
+    async def _generate_chunk_embeddings(self, document_id: int,
+                                         text: str) -> Tuple[List[Dict[str, Any]], np.ndarray]:
         """
-        Generate a document embedding by chunking the text and averaging chunk embeddings.
+        Chunk a document by model tokens and embed every chunk whose content has no stored embedding yet.
+        Chunks hold at most CHUNK_MAX_TOKENS tokens, by default as many as the model reads without truncating.
+        The chunks are encoded through the shared batcher, together with the chunks of other in-flight documents.
 
         Args:
+            document_id: The ID of the document
             text: The document text
-            chunk_size: The target size for each chunk
-            chunk_overlap: The number of characters to overlap between chunks
 
         Returns:
-            The document embedding as a numpy array, or None if an error occurs
+            The chunk dictionaries and their normalized embeddings
         """
-        try:
-            chunks = chunk_text(text, chunk_size, chunk_overlap)
-
-            if not chunks:
-                self.logger.warning("No chunks generated from document text")
-                # If no chunks, just encode the first 512 characters
-                chunks = [text[:512]]
-
-            embeddings = self.model.encode(chunks, show_progress_bar=False)
-            avg_embedding = np.mean(embeddings, axis=0)
-
-            norm = np.linalg.norm(avg_embedding)
-            if norm > 0:
-                avg_embedding = avg_embedding / norm
+        # Tokenizing a large document is CPU-bound, keep it off the event loop
+        with timed("indexing.chunk"):
+            chunks = await asyncio.to_thread(self._chunk_document, document_id, text)
+
+        if not chunks:
+            self.logger.warning("No chunks generated from document text")
+            # If no chunks, just encode the first 512 characters
+            chunks = [{
+                'chunk_id': f"{document_id}_0",
+                'document_id': document_id,
+                'chunk_index': 0,
+                'text': text[:512],
+                'content_hash': content_hash(text[:512]),
+                'chunk_count': 1
+            }]
+
+        # Reuse the embeddings of chunks the account already has, and only encode new contents
+        with timed("indexing.reuse_lookup"):
+            known_embeddings = await self.db.get_chunk_embeddings_by_hash(
+                document_id, list({chunk['content_hash'] for chunk in chunks})
+            )
+        new_chunks = {}
+        for chunk in chunks:
+            if chunk['content_hash'] not in known_embeddings:
+                new_chunks.setdefault(chunk['content_hash'], chunk['text'])
+
+        if new_chunks:
+            with timed("indexing.embed"):
+                new_embeddings = await self.batcher.embed(list(new_chunks.values()))
+            known_embeddings.update(zip(new_chunks.keys(), new_embeddings))
+
+        embeddings = np.stack([np.asarray(known_embeddings[chunk['content_hash']], dtype=np.float32)
+                               for chunk in chunks])
+
+        self.logger.info(f"Generated embeddings for {len(chunks)} chunks, "
+                         f"{len(new_chunks)} of them encoded and the others reused")
+        return chunks, embeddings
+
+    def _chunk_document(self, document_id: int, text: str) -> List[Dict[str, Any]]:
+        """
+        Chunk a document by model tokens. Runs in a worker thread: reading the token limit of the model
+        loads the model if it is not loaded yet.
 
-            self.logger.info(f"Generated embedding from {len(chunks)} chunks")
-            return avg_embedding
+        Parameters:
+            document_id: The ID of the document
+            text: The document text
 
-        except Exception as e:
-            self.logger.error(f"Error generating document embedding: {str(e)}")
-            return None
+        Returns:
+            The chunk dictionaries
+        """
+        return chunk_document(
+            {'document_id': document_id, 'document_text': text},
+            self.chunk_max_tokens or self.embeddings.chunk_token_limit,
+            self.chunk_overlap_tokens,
+            self.embeddings.count_tokens
+        )
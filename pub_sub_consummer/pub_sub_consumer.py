@@ -2,51 +2,202 @@ import asyncio
 import json
 import logging
 import os
+import signal
+import threading
 from abc import ABC, abstractmethod
+from concurrent.futures import CancelledError, Future
+from functools import partial
+from typing import TYPE_CHECKING, Set
 
-from dotenv import load_dotenv
-from google.cloud import pubsub_v1
-from google.cloud.pubsub_v1.subscriber.message import Message
+from monitoring import get_registry, get_startup_profile, start_metrics_server
 
-load_dotenv()
+if TYPE_CHECKING:
+    from google.cloud.pubsub_v1.subscriber.message import Message
+
+MESSAGES = get_registry().counter(
+    "rag_pubsub_messages_total", "Number of settled Pub/Sub messages", ("subscription", "outcome")
+)
 
 
 class PubSubConsumer(ABC):
     __subscription_id__ = None
 
-    def __init__(self):
+    def __init__(self, subscriber=None):
+        """
+        Initialize the consumer
+
+        Parameters:
+            subscriber: A Pub/Sub subscriber client, e.g. a stand-in for benchmarks; defaults to a new SubscriberClient
+        """
         self.subscription_id = self.__subscription_id__
         self.project_id = os.getenv("GCP_PROJECT_ID")
-        self.subscriber = pubsub_v1.SubscriberClient()
+        startup = get_startup_profile()
+        # The Pub/Sub client is only imported once a consumer is created, not with this module
+        pubsub_v1 = startup.import_module("google.cloud.pubsub_v1")
+        if subscriber is None:
+            with startup.stage("subscriber"):
+                subscriber = pubsub_v1.SubscriberClient()
+        self.subscriber = subscriber
         self.logger = logging.getLogger(__name__)
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
 
+        # Callbacks run concurrently on the loop, up to this many at a time
+        self.max_in_flight = int(os.getenv("MAX_IN_FLIGHT", "16"))
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        # Messages stay leased until their callback completes, so flow control bounds the
+        # number of messages held by the worker. The client extends their ack deadline
+        # in the background, up to max_lease_duration.
+        self.flow_control = pubsub_v1.types.FlowControl(
+            max_messages=int(os.getenv("PUBSUB_MAX_MESSAGES", str(self.max_in_flight * 2))),
+            max_bytes=int(os.getenv("PUBSUB_MAX_BYTES", str(100 * 1024 * 1024))),
+            max_lease_duration=int(os.getenv("PUBSUB_MAX_LEASE_DURATION", "3600")),
+        )
+        self.pending_futures: Set[Future] = set()
+        self._pending_lock = threading.Lock()
+        self.running = 0
+
+        # On SIGTERM new messages are nacked while the ones in flight finish, for up to drain_timeout seconds
+        self.drain_timeout = float(os.getenv("WORKER_DRAIN_TIMEOUT", "30"))
+        self.draining = False
+        get_registry().add_collector(self._collect_metrics)
+
         self.subscription_path = self.subscriber.subscription_path(
             self.project_id, self.subscription_id
         )
 
     @abstractmethod
     async def callback(self, message: dict):
+        """
+        Process a message.
+        Returning acks the message; raising nacks it so that Pub/Sub redelivers it, which is only
+        useful for transient errors (see is_transient_error).
+        """
         return NotImplemented
 
-    def wrapped_callback(self, message: Message):
+    async def startup(self):
+        """Prepare the consumer before it subscribes, e.g. open its connections"""
+
+    @staticmethod
+    def is_transient_error(error: BaseException) -> bool:
+        """
+        Whether an error may not happen again if the message is redelivered: a database or connection
+        error, a timeout, or a server error or rate limit of a Google API such as Gemini.
+        Other errors are deterministic, so raising them from a callback would redeliver the message forever.
+
+        Parameters:
+            error: The error raised while processing a message
+
+        Returns:
+            True if the message should be nacked so that it is retried
+        """
+        # Imported on failure only, like the Pub/Sub client it ships with
+        from google.api_core import exceptions as api_exceptions
+        from psycopg import OperationalError
+
+        transient = (OperationalError, ConnectionError, TimeoutError,
+                     api_exceptions.ServerError, api_exceptions.TooManyRequests)
+        while error is not None:
+            if isinstance(error, transient):
+                return True
+            error = error.__cause__
+        return False
+
+    async def _limited_callback(self, body: dict):
+        async with self.in_flight:
+            self.running += 1
+            try:
+                await self.callback(body)
+            finally:
+                self.running -= 1
+
+    def _collect_metrics(self):
+        """Messages waiting for a callback slot and callbacks running, at scrape time"""
+        with self._pending_lock:
+            pending = len(self.pending_futures)
+        running = self.running
+        labels = {"subscription": self.subscription_id}
+        return [
+            ("rag_pubsub_queued_messages", "gauge", "Received messages waiting for a callback slot",
+             labels, max(pending - running, 0)),
+            ("rag_pubsub_in_flight_messages", "gauge", "Messages whose callback is running", labels, running),
+        ]
+
+    def wrapped_callback(self, message: "Message"):
+        if self.draining:
+            # Another worker gets it; the subscription stays open until the messages in flight are acked
+            MESSAGES.inc(subscription=self.subscription_id, outcome="nack")
+            message.nack()
+            return
+
         self.logger.info(f" [x] {self.subscription_id} | Received {message.data}\n")
         try:
             body = json.loads(message.data)
-            asyncio.run_coroutine_threadsafe(self.callback(body), self.loop)
-            message.ack()
+            future = asyncio.run_coroutine_threadsafe(self._limited_callback(body), self.loop)
+            with self._pending_lock:
+                self.pending_futures.add(future)
+            future.add_done_callback(partial(self._settle_message, message))
         except Exception as e:
             self.logger.exception(f"Error in callback: {str(e)}")
             message.nack()
 
+    def _settle_message(self, message: "Message", future: Future):
+        """Ack the message once its callback succeeded, nack it otherwise"""
+        with self._pending_lock:
+            self.pending_futures.discard(future)
+
+        if future.cancelled():
+            self.logger.warning(f"Callback cancelled for message {message.message_id}")
+            MESSAGES.inc(subscription=self.subscription_id, outcome="nack")
+            message.nack()
+            return
+
+        error = future.exception()
+        if error is not None:
+            self.logger.error(f"Callback failed for message {message.message_id}: {str(error)}")
+            MESSAGES.inc(subscription=self.subscription_id, outcome="nack")
+            message.nack()
+            return
+
+        MESSAGES.inc(subscription=self.subscription_id, outcome="ack")
+        message.ack()
+
+    def drain(self):
+        """Stop taking new messages, and stop consuming once the messages in flight are settled"""
+        if self.draining:
+            return
+        self.draining = True
+        self.logger.info(f"Draining {self.subscription_id}, waiting up to {self.drain_timeout}s for messages in flight")
+        self.loop.create_task(self._stop_when_settled())
+
+    async def _stop_when_settled(self):
+        deadline = self.loop.time() + self.drain_timeout
+        while True:
+            # Messages received just before draining started may be registered meanwhile
+            with self._pending_lock:
+                pending = [asyncio.wrap_future(future, loop=self.loop) for future in self.pending_futures]
+            remaining = deadline - self.loop.time()
+            if not pending or remaining <= 0:
+                break
+            await asyncio.wait(pending, timeout=remaining)
+
+        if pending:
+            self.logger.warning(f"Stopping with {len(pending)} messages still in flight, they will be redelivered")
+        self.loop.stop()
+
     def consume(self):
+        start_metrics_server()
+        self.loop.run_until_complete(self.startup())
         streaming_pull_future = self.subscriber.subscribe(
             self.subscription_path,
             callback=self.wrapped_callback,
+            flow_control=self.flow_control,
         )
+        self.loop.add_signal_handler(signal.SIGTERM, self.drain)
 
         self.logger.info(f"Listening for messages on {self.subscription_id}...\n")
+        get_startup_profile().report()
 
         try:
             self.loop.run_forever()
@@ -54,4 +205,11 @@ class PubSubConsumer(ABC):
             self.logger.exception(f"Error: {e}")
         finally:
             streaming_pull_future.cancel()
+            try:
+                # Returns once the client has shut down, after sending the last acks
+                streaming_pull_future.result(timeout=self.drain_timeout)
+            except CancelledError:
+                pass
+            except Exception as e:
+                self.logger.warning(f"Subscriber did not shut down cleanly: {str(e)}")
             self.subscriber.close()
@@ -0,0 +1,176 @@
+import gc
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.connection import wait
+from typing import Callable, Dict, Optional
+
+from monitoring import get_startup_profile
+from pub_sub_consummer.pub_sub_consumer import PubSubConsumer
+from vector_store.embeddings import EmbeddingProvider, embedding_warmup_enabled
+
+logger = logging.getLogger(__name__)
+
+# A worker that exits sooner than this after starting is restarted with a growing delay
+MIN_WORKER_UPTIME = 60.0
+
+MAX_RESTART_DELAY = 60.0
+
+
+class WorkerSupervisor:
+    """
+    Runs a consumer in several worker processes forked from one parent.
+    The parent loads the embedding model before forking, so the workers share its weights copy-on-write
+    instead of loading a copy each. Workers that exit are restarted, with a growing delay while they keep
+    crashing, and SIGTERM drains every worker before the supervisor exits.
+    """
+
+    def __init__(self, consumer_factory: Callable[[], PubSubConsumer], processes: Optional[int] = None,
+                 drain_timeout: Optional[float] = None):
+        """
+        Initialize the supervisor
+
+        Parameters:
+            consumer_factory: Creates the consumer of a worker, called in the worker process
+            processes: Number of worker processes, defaults to the WORKER_PROCESSES setting
+            drain_timeout: Seconds a worker is given to finish its messages in flight on SIGTERM,
+                defaults to the WORKER_DRAIN_TIMEOUT setting
+        """
+        self.consumer_factory = consumer_factory
+        self.processes = processes or int(os.getenv("WORKER_PROCESSES", "1"))
+        self.drain_timeout = drain_timeout if drain_timeout is not None else float(
+            os.getenv("WORKER_DRAIN_TIMEOUT", "30"))
+        # Each worker gets its share of the cores for torch, unless WORKER_TORCH_THREADS is set
+        self.torch_threads = int(os.getenv("WORKER_TORCH_THREADS", "0")) or max(
+            1, (os.cpu_count() or 1) // self.processes)
+
+        self.context = multiprocessing.get_context("fork")
+        self.workers: Dict[int, multiprocessing.Process] = {}
+        self._started_at: Dict[int, float] = {}
+        self._failures: Dict[int, int] = {}
+        self._restart_at: Dict[int, float] = {}
+        self._stopping = False
+
+    def run(self):
+        """Start the workers and keep them running until SIGTERM or SIGINT, then drain them"""
+        self._preload()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for slot in range(self.processes):
+            self._start_worker(slot)
+
+        while not self._stopping:
+            alive = [worker.sentinel for worker in self.workers.values() if worker.exitcode is None]
+            wait(alive, timeout=1.0)
+
+            now = time.monotonic()
+            for slot, worker in self.workers.items():
+                if worker.exitcode is not None and slot not in self._restart_at:
+                    self._schedule_restart(slot, worker.exitcode, now)
+
+            for slot, restart_at in list(self._restart_at.items()):
+                if restart_at <= now and not self._stopping:
+                    del self._restart_at[slot]
+                    self._start_worker(slot)
+
+        self._drain()
+
+    def _preload(self):
+        """
+        Load the model in the parent, without running it: the threads torch starts on the first
+        forward pass would not survive the fork. The workers run the warmup pass instead.
+        """
+        EmbeddingProvider.get_instance(warmup=False).load()
+        # Keep the collector from writing to the parent's objects in every worker, which would copy their pages
+        gc.freeze()
+        logger.info(f"Model loaded, starting {self.processes} workers")
+        get_startup_profile().report()
+
+    def _start_worker(self, slot: int):
+        worker = self.context.Process(target=self._run_worker, args=(slot,), name=f"worker-{slot}")
+        worker.start()
+        self.workers[slot] = worker
+        self._started_at[slot] = time.monotonic()
+        logger.info(f"Started worker {slot} (pid {worker.pid})")
+
+    def _run_worker(self, slot: int):
+        """The body of a worker process"""
+        # The supervisor forwards SIGTERM to the workers, and a terminal's SIGINT reaches them through it
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # The worker reports its own startup, without the stages the supervisor ran before the fork
+        startup = get_startup_profile()
+        startup.restart()
+
+        os.environ["WORKER_DRAIN_TIMEOUT"] = str(self.drain_timeout)
+        # Every worker serves its own metrics, on consecutive ports
+        metrics_port = int(os.getenv("METRICS_PORT", "0"))
+        if metrics_port:
+            os.environ["METRICS_PORT"] = str(metrics_port + slot)
+
+        try:
+            import torch
+            torch.set_num_threads(self.torch_threads)
+        except ImportError:
+            pass
+
+        if embedding_warmup_enabled():
+            EmbeddingProvider.get_instance().warmup()
+
+        with startup.stage("consumer"):
+            consumer = self.consumer_factory()
+        consumer.consume()
+
+    def _schedule_restart(self, slot: int, exitcode: int, now: float):
+        """Restart an exited worker right away, or after a delay that doubles while it keeps exiting early"""
+        if now - self._started_at[slot] >= MIN_WORKER_UPTIME:
+            self._failures[slot] = 0
+            delay = 0.0
+        else:
+            self._failures[slot] = self._failures.get(slot, 0) + 1
+            delay = min(2.0 ** (self._failures[slot] - 1), MAX_RESTART_DELAY)
+
+        logger.error(f"Worker {slot} exited with code {exitcode}, restarting it in {delay:.0f}s")
+        self._restart_at[slot] = now + delay
+
+    def _stop(self, signum, frame):
+        if not self._stopping:
+            logger.info(f"Received signal {signum}, draining the workers")
+        self._stopping = True
+
+    def _drain(self):
+        """Ask every worker to drain, and kill the ones still running once they had the time to"""
+        alive = [worker for worker in self.workers.values() if worker.exitcode is None]
+        for worker in alive:
+            worker.terminate()
+
+        # Workers stop waiting for their messages after drain_timeout, then shut their subscriber down
+        deadline = time.monotonic() + 2 * self.drain_timeout + 5
+        for worker in alive:
+            worker.join(max(deadline - time.monotonic(), 0))
+
+        for worker in alive:
+            if worker.exitcode is None:
+                logger.warning(f"Worker {worker.name} (pid {worker.pid}) did not drain in time, killing it")
+                worker.kill()
+                worker.join()
+        logger.info("Every worker stopped")
+
+
+def run_workers(consumer_factory: Callable[[], PubSubConsumer]):
+    """
+    Run a consumer in this process, or in WORKER_PROCESSES worker processes under a supervisor
+
+    Parameters:
+        consumer_factory: Creates the consumer, e.g. the consumer class
+    """
+    processes = int(os.getenv("WORKER_PROCESSES", "1"))
+    if processes <= 1:
+        with get_startup_profile().stage("consumer"):
+            consumer = consumer_factory()
+        consumer.consume()
+    else:
+        WorkerSupervisor(consumer_factory, processes).run()
@@ -0,0 +1,141 @@
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import numpy as np
+from pgvector import Vector
+from pgvector.psycopg.vector import VectorBinaryLoader
+from psycopg import pq
+
+from db.connector import DatabaseConnector
+
+
+def vector_column(embedding):
+    """A vector column as the connector reads it: sent by Postgres in binary and loaded by pgvector"""
+    return VectorBinaryLoader(0).load(Vector(np.asarray(embedding, dtype=np.float32)).to_binary())
+
+
+class FakeCursor:
+    """Answers every query with the rows of the first result whose key the query contains"""
+
+    def __init__(self, connection: "FakeConnection"):
+        self.connection = connection
+        self.rowcount = 0
+        self._rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def execute(self, query, params=None, prepare=None):
+        if hasattr(query, "as_string"):
+            query = query.as_string(None)
+        query = " ".join(str(query).split())
+        self.connection.executed.append((query, params, self.connection.autocommit, self.connection.transactions))
+        rows = next((rows for key, rows in self.connection.results.items() if key in query), [])
+        self._rows = list(rows(params) if callable(rows) else rows)
+        self.rowcount = len(self._rows)
+
+    async def executemany(self, query, params_seq):
+        # Like psycopg, the row count of the statements adds up
+        rowcount = 0
+        for params in params_seq:
+            await self.execute(query, params)
+            rowcount += self.rowcount
+        self.rowcount = rowcount
+
+    @asynccontextmanager
+    async def copy(self, query):
+        copy = FakeCopy(" ".join(str(query).split()))
+        yield copy
+        self.connection.copies.append(copy)
+
+    async def fetchall(self):
+        return self._rows
+
+    async def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+
+class FakeCopy:
+    """Records the rows written to a COPY and the types they are sent as"""
+
+    def __init__(self, query):
+        self.query = query
+        self.types = None
+        self.rows = []
+
+    def set_types(self, types):
+        self.types = types
+
+    async def write_row(self, row):
+        self.rows.append(row)
+
+
+class FakeConnection:
+    """A stand-in for a pooled psycopg AsyncConnection that records the queries it runs"""
+
+    def __init__(self, results=None):
+        """
+        Parameters:
+            results: The rows of the queries containing each key, or a function of the query parameters returning them;
+                the row count of a write is the number of its rows
+        """
+        self.results = results or {}
+        self.executed = []
+        self.copies = []
+        self.autocommit = False
+        self.transactions = 0
+        self.commits = 0
+
+    @property
+    def info(self):
+        return SimpleNamespace(transaction_status=pq.TransactionStatus.IDLE)
+
+    def cursor(self, binary=False):
+        return FakeCursor(self)
+
+    async def execute(self, query, params=None, prepare=None):
+        cursor = self.cursor()
+        await cursor.execute(query, params, prepare)
+        return cursor
+
+    async def set_autocommit(self, value):
+        self.autocommit = value
+
+    async def commit(self):
+        self.commits += 1
+
+    @asynccontextmanager
+    async def transaction(self):
+        self.transactions += 1
+        try:
+            yield
+        finally:
+            self.transactions -= 1
+
+
+class FakePool:
+    """Hands out the same connection, like a pool of one"""
+
+    def __init__(self, connection: FakeConnection):
+        self._connection = connection
+        self.closed = False
+
+    @asynccontextmanager
+    async def connection(self):
+        yield self._connection
+
+    async def open(self):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def fake_connector(results=None) -> DatabaseConnector:
+    """A DatabaseConnector running its real queries and conversions against a FakeConnection"""
+    connector = DatabaseConnector()
+    connector.connection_pool = FakePool(FakeConnection(results))
+    return connector
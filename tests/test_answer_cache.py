@@ -0,0 +1,114 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from llm.answer_cache import SemanticAnswerCache
+from llm.retrieval import SearchResult
+
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+QUESTION = unit(1, 0, 0)
+REPHRASED = unit(1, 0.1, 0)
+OTHER_QUESTION = unit(0, 1, 0)
+PASSAGES = SemanticAnswerCache.fingerprint([SearchResult(1, chunk_id="1_0"), SearchResult(2, chunk_id="2_3")])
+
+
+class SemanticAnswerCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("llm.answer_cache.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = SemanticAnswerCache(threshold=0.95, max_entries=2, max_accounts=2, ttl=60)
+
+    def store(self, account_id, embedding, answer, fingerprint=PASSAGES):
+        self.cache.set(account_id, embedding, fingerprint, answer, self.cache.generation())
+
+    def test_a_close_question_gets_the_answer(self):
+        self.store(1, QUESTION, "answer")
+
+        self.assertEqual("answer", self.cache.get(1, REPHRASED, PASSAGES))
+        self.assertEqual("answer", self.cache.get("1", QUESTION, PASSAGES))
+        self.assertEqual(2, self.cache.hits)
+
+    def test_a_different_question_misses(self):
+        self.store(1, QUESTION, "answer")
+
+        self.assertIsNone(self.cache.get(1, OTHER_QUESTION, PASSAGES))
+        self.assertIsNone(self.cache.get(2, QUESTION, PASSAGES))
+        self.assertEqual(2, self.cache.misses)
+
+    def test_an_answer_is_only_reused_with_the_same_passages(self):
+        self.store(1, QUESTION, "answer")
+
+        other_passages = SemanticAnswerCache.fingerprint([SearchResult(3, chunk_id="3_0")])
+        self.assertIsNone(self.cache.get(1, QUESTION, other_passages))
+
+    def test_fingerprints_ignore_the_order_of_the_passages(self):
+        self.assertEqual(PASSAGES, SemanticAnswerCache.fingerprint([SearchResult(2, chunk_id="2_3"),
+                                                                    SearchResult(1, chunk_id="1_0")]))
+
+    def test_answers_expire(self):
+        self.store(1, QUESTION, "answer")
+        self.now += 61
+
+        self.assertIsNone(self.cache.get(1, QUESTION, PASSAGES))
+        self.assertEqual(0, self.cache.stats()["size"])
+
+    def test_the_same_question_replaces_its_answer(self):
+        self.store(1, QUESTION, "first")
+        self.store(1, REPHRASED, "second")
+
+        self.assertEqual("second", self.cache.get(1, QUESTION, PASSAGES))
+        self.assertEqual(1, self.cache.stats()["size"])
+
+    def test_a_full_account_evicts_its_least_recently_used_answer(self):
+        self.store(1, QUESTION, "first")
+        self.now += 1
+        self.store(1, OTHER_QUESTION, "second")
+        self.now += 1
+        self.cache.get(1, QUESTION, PASSAGES)
+        self.now += 1
+
+        self.store(1, unit(0, 0, 1), "third")
+
+        self.assertEqual("first", self.cache.get(1, QUESTION, PASSAGES))
+        self.assertIsNone(self.cache.get(1, OTHER_QUESTION, PASSAGES))
+        self.assertEqual(1, self.cache.evictions)
+
+    def test_the_least_recently_used_account_is_evicted(self):
+        for account_id in (1, 2, 3):
+            self.store(account_id, QUESTION, f"answer {account_id}")
+
+        self.assertIsNone(self.cache.get(1, QUESTION, PASSAGES))
+        self.assertEqual("answer 3", self.cache.get(3, QUESTION, PASSAGES))
+        self.assertEqual(2, self.cache.stats()["accounts"])
+
+    def test_invalidation_drops_the_answers_of_an_account(self):
+        self.store(1, QUESTION, "answer 1")
+        self.store(2, QUESTION, "answer 2")
+
+        self.assertEqual(1, self.cache.invalidate(1))
+
+        self.assertIsNone(self.cache.get(1, QUESTION, PASSAGES))
+        self.assertEqual("answer 2", self.cache.get(2, QUESTION, PASSAGES))
+
+    def test_an_answer_generated_while_its_account_changed_is_not_stored(self):
+        generation = self.cache.generation()
+        self.cache.invalidate("1")
+
+        self.cache.set(1, QUESTION, PASSAGES, "stale answer", generation)
+        self.cache.set(2, QUESTION, PASSAGES, "answer 2", generation)
+
+        self.assertIsNone(self.cache.get(1, QUESTION, PASSAGES))
+        self.assertEqual("answer 2", self.cache.get(2, QUESTION, PASSAGES))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from benchmarks.fakes import FakeEmbeddingProvider, InMemoryDatabase
+from vector_store.bulk_indexer import BulkIndexer, iter_jsonl_documents
+from vector_store.embeddings import EmbeddingProvider
+
+
+class RecordingBackend:
+    """Records the accounts whose vectors are rebuilt"""
+
+    def __init__(self):
+        self.rebuilt = []
+
+    async def rebuild_account(self, account_id):
+        self.rebuilt.append(account_id)
+
+
+class FailingDatabase(InMemoryDatabase):
+    """Fails to store every batch after the first few, like an interrupted run"""
+
+    def __init__(self, batches_before_failing):
+        super().__init__()
+        self.batches_before_failing = batches_before_failing
+
+    async def store_document_indexes(self, documents, replace_chunks=False):
+        if self.batches_before_failing == 0:
+            raise ConnectionError("server closed the connection")
+        self.batches_before_failing -= 1
+        return await super().store_document_indexes(documents, replace_chunks)
+
+
+def in_process_pool(max_workers, mp_context=None, initializer=None, initargs=()):
+    """Encodes in threads of this process, with the fake model, instead of spawning worker processes"""
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+
+class BulkIndexerTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint = os.path.join(directory.name, "checkpoint.json")
+        self.jsonl = os.path.join(directory.name, "documents.jsonl")
+        with open(self.jsonl, "w", encoding="utf-8") as file:
+            for document_id in range(1, 7):
+                file.write(json.dumps({"document_id": document_id, "document_text": f"Document {document_id}."}) + "\n")
+
+        self.provider = EmbeddingProvider._instance
+        EmbeddingProvider._instance = FakeEmbeddingProvider(dimension=8)
+        patcher = mock.patch("vector_store.bulk_indexer.ProcessPoolExecutor", in_process_pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        EmbeddingProvider._instance = self.provider
+
+    def indexer(self, db):
+        for document_id in range(1, 7):
+            db.add_document(document_id, 10 + document_id % 2, f"doc {document_id}", f"Document {document_id}.")
+        return BulkIndexer(self.checkpoint, workers=1, batch_size=2, db=db, vector_backend=RecordingBackend())
+
+    async def test_an_interrupted_run_resumes_after_its_last_stored_batch(self):
+        interrupted = self.indexer(FailingDatabase(batches_before_failing=1))
+        with self.assertRaises(ConnectionError):
+            await interrupted.index_jsonl(self.jsonl)
+
+        with open(self.checkpoint, encoding="utf-8") as file:
+            checkpoint = json.load(file)
+        self.assertEqual((2, [10, 11]), (checkpoint["position"], checkpoint["accounts"]))
+
+        db = InMemoryDatabase()
+        resumed = self.indexer(db)
+        await resumed.index_jsonl(self.jsonl)
+
+        self.assertEqual(4, resumed.processed)
+        self.assertEqual({3, 4, 5, 6}, {document_id for document_id, document in db.documents.items()
+                                        if document["embedding"] is not None})
+        self.assertEqual([10, 11], sorted(resumed.vector_backend.rebuilt))
+
+    async def test_a_checkpoint_of_another_source_is_ignored(self):
+        indexer = self.indexer(InMemoryDatabase())
+        indexer.save_checkpoint("database", 4)
+
+        self.assertEqual(0, indexer.load_checkpoint(f"jsonl:{os.path.abspath(self.jsonl)}"))
+        self.assertEqual(4, indexer.load_checkpoint("database"))
+
+    def test_jsonl_batches_skip_the_indexed_lines(self):
+        batches = list(iter_jsonl_documents(self.jsonl, skip=3, batch_size=2))
+
+        self.assertEqual([5, 6], [position for position, _ in batches])
+        self.assertEqual([4, 5, 6], [document_id for _, batch in batches for document_id, _ in batch])
+
+
+if __name__ == "__main__":
+    unittest.main()
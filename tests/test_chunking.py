@@ -0,0 +1,71 @@
+import re
+import unittest
+
+from vector_store.chunking import chunk_text, iter_chunks, iter_text_pieces
+
+
+def count_words(text):
+    return len(re.findall(r"\w+", text))
+
+
+def shared_text(previous, chunk):
+    """The longest start of a chunk that the previous chunk ends with"""
+    for size in range(min(len(previous), len(chunk)), 0, -1):
+        if previous.endswith(chunk[:size]):
+            return chunk[:size]
+    return ""
+
+
+class IterChunksTest(unittest.TestCase):
+
+    def test_chunks_respect_the_limit_with_their_joining_spaces(self):
+        chunks = chunk_text("Hi. " * 400, 500, 50)
+
+        self.assertTrue(chunks)
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), 500)
+
+    def test_chunks_respect_a_token_limit(self):
+        text = " ".join(f"Sentence number {i} has a few words." for i in range(200))
+
+        chunks = list(iter_chunks(text, max_tokens=40, overlap_tokens=10, count_tokens=count_words))
+
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(count_words(chunk), 40)
+
+    def test_consecutive_chunks_share_their_trailing_sentences(self):
+        sentences = [f"Sentence {i} is here." for i in range(30)]
+
+        chunks = list(iter_chunks(" ".join(sentences), max_tokens=100, overlap_tokens=45))
+
+        self.assertGreater(len(chunks), 1)
+        for previous, chunk in zip(chunks, chunks[1:]):
+            overlap = shared_text(previous, chunk)
+            self.assertTrue(overlap.endswith("."), f"{chunk!r} does not start with the last sentences of {previous!r}")
+            self.assertLessEqual(len(overlap), 45)
+        self.assertTrue(all(any(sentence in chunk for chunk in chunks) for sentence in sentences))
+
+    def test_without_overlap_every_sentence_appears_once(self):
+        sentences = [f"Sentence {i} is here." for i in range(30)]
+
+        chunks = list(iter_chunks(" ".join(sentences), max_tokens=100, overlap_tokens=0))
+
+        self.assertEqual(" ".join(sentences), " ".join(chunks))
+
+    def test_a_sentence_longer_than_the_limit_is_split_at_words(self):
+        text = " ".join(f"word{i}" for i in range(100)) + "."
+
+        chunks = list(iter_chunks(text, max_tokens=50, overlap_tokens=0))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), 50)
+        self.assertEqual(text, " ".join(chunks))
+
+    def test_a_stream_of_pieces_chunks_like_the_whole_text(self):
+        text = " ".join(f"Sentence {i} ends here! Another one? Yes." for i in range(50))
+
+        self.assertEqual(list(iter_chunks(text, 120, 30)), list(iter_chunks(iter_text_pieces(text, 7), 120, 30)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+import psycopg
+from pgvector.psycopg.vector import VectorBinaryLoader, register_vector_info
+from psycopg.adapt import AdaptersMap, PyFormat, Transformer
+from psycopg.types import TypeInfo
+
+from db.connector import DatabaseConnector
+from tests.fake_postgres import fake_connector, vector_column
+
+EMBEDDING = np.array([0.6, 0.8, 0.0], dtype=np.float32)
+
+
+def assert_embedding(test, embedding):
+    test.assertIsInstance(embedding, np.ndarray)
+    test.assertEqual(np.float32, embedding.dtype)
+    np.testing.assert_allclose(EMBEDDING, embedding)
+
+
+class VectorEncodingTest(unittest.TestCase):
+    """Embeddings are sent as binary pgvector values, with the adapters register_vector_async installs"""
+
+    def setUp(self):
+        self.vector_type = TypeInfo("vector", 16385, 16390)
+        context = SimpleNamespace(adapters=AdaptersMap(psycopg.adapters), connection=None)
+        register_vector_info(context, self.vector_type)
+        self.transformer = Transformer(context)
+
+    def test_embeddings_are_contiguous_float32_arrays(self):
+        embedding = np.arange(12, dtype=np.float64).reshape(3, 4)[:, 1]
+
+        vector = DatabaseConnector._to_vector(embedding)
+
+        self.assertEqual(np.float32, vector.dtype)
+        self.assertTrue(vector.flags["C_CONTIGUOUS"])
+        np.testing.assert_array_equal([1, 5, 9], vector)
+
+    def test_an_embedding_round_trips_through_the_binary_format(self):
+        embedding = np.random.default_rng(0).standard_normal(384).astype(np.float32)
+
+        dumper = self.transformer.get_dumper(DatabaseConnector._to_vector(embedding), PyFormat.BINARY)
+        loaded = VectorBinaryLoader(self.vector_type.oid).load(dumper.dump(DatabaseConnector._to_vector(embedding)))
+
+        self.assertEqual(self.vector_type.oid, dumper.oid)
+        np.testing.assert_array_equal(embedding, DatabaseConnector._from_vector(loaded))
+
+    def test_the_embeddings_of_a_batch_are_sent_as_a_vector_array(self):
+        embeddings = [DatabaseConnector._to_vector(np.full(4, value)) for value in (0.5, 0.25)]
+
+        dumper = self.transformer.get_dumper(embeddings, PyFormat.BINARY)
+
+        self.assertEqual(self.vector_type.array_oid, dumper.oid)
+        self.assertTrue(dumper.dump(embeddings))
+
+
+class StoreDocumentIndexesTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_new_chunks_are_copied_in_binary_with_float32_embeddings(self):
+        db = fake_connector({
+            "SELECT id, account_id FROM documents": [(1, 10)],
+            "SELECT chunk_id, content_hash FROM document_chunks": [("1_0", "h0"), ("1_9", "gone")],
+        })
+        connection = db.connection_pool._connection
+        chunks = [{"chunk_id": f"1_{i}", "chunk_index": i, "text": f"text {i}", "content_hash": f"h{i}"}
+                  for i in range(3)]
+        chunk_embeddings = np.eye(3, dtype=np.float64)
+
+        stored = await db.store_document_indexes([(1, EMBEDDING, chunks, chunk_embeddings),
+                                                  (2, EMBEDDING, chunks, chunk_embeddings)])
+
+        self.assertEqual({1: 10}, stored)
+        (copy,) = connection.copies
+        self.assertIn("FORMAT BINARY", copy.query)
+        self.assertEqual("vector", copy.types[-1])
+        # The stored chunk with the same content is left in place
+        self.assertEqual(["1_1", "1_2"], [row[0] for row in copy.rows])
+        for row, expected in zip(copy.rows, chunk_embeddings[1:]):
+            self.assertEqual((1, 10), row[1:3])
+            self.assertEqual(np.float32, row[-1].dtype)
+            np.testing.assert_array_equal(expected, row[-1])
+
+        queries = [(query, params) for query, params, _, _ in connection.executed]
+        self.assertIn(("DELETE FROM document_chunks WHERE chunk_id = ANY(%s)", (["1_9"],)), queries)
+        self.assertIn(("SELECT pg_notify(%s, %s)", ("document_index_updated", "10")), queries)
+        update = next(params for query, params in queries if query.startswith("UPDATE documents"))
+        self.assertEqual(np.float32, update[0].dtype)
+        self.assertEqual(1, update[1])
+        self.assertEqual(1, connection.commits)
+
+
+class VectorDecodingTest(unittest.IsolatedAsyncioTestCase):
+    """The connector hands out vector columns as float32 arrays, whatever pgvector reads them as"""
+
+    def test_from_vector(self):
+        assert_embedding(self, DatabaseConnector._from_vector(vector_column(EMBEDDING)))
+        assert_embedding(self, DatabaseConnector._from_vector(EMBEDDING.tolist()))
+        self.assertIsNone(DatabaseConnector._from_vector(None))
+
+    async def test_rank_chunks_by_embedding(self):
+        db = fake_connector({"AS distance": [("c1", 1, 0.1, vector_column(EMBEDDING)), ("c2", 2, 0.2, None)]})
+
+        rows = await db.rank_chunks_by_embedding(EMBEDDING, 1, top_k=2, with_embeddings=True)
+
+        self.assertEqual([("c1", 1, 0.1), ("c2", 2, 0.2)], [row[:3] for row in rows])
+        assert_embedding(self, rows[0][3])
+        self.assertIsNone(rows[1][3])
+
+    async def test_rank_chunks_by_embeddings(self):
+        db = fake_connector({"unnest": [(1, "c1", 1, 0.1, vector_column(EMBEDDING)), (2, "c2", 2, 0.3, None)]})
+
+        results = await db.rank_chunks_by_embeddings([(EMBEDDING, 1, 1, True), (EMBEDDING, 2, 1, False)])
+
+        self.assertEqual([["c1"], ["c2"]], [[row[0] for row in rows] for rows in results])
+        assert_embedding(self, results[0][0][3])
+        self.assertIsNone(results[1][0][3])
+
+    async def test_rank_chunks_by_text(self):
+        db = fake_connector({"ts_rank_cd": [("c1", 1, 0.5, vector_column(EMBEDDING))]})
+
+        rows = await db.rank_chunks_by_text("query", 1, top_k=1, with_embeddings=True)
+
+        self.assertEqual(("c1", 1, 0.5), rows[0][:3])
+        assert_embedding(self, rows[0][3])
+
+
+class ReadConnectionTest(unittest.IsolatedAsyncioTestCase):
+    """Read-only queries run in autocommit mode, so returning their connection sends no COMMIT"""
+
+    async def test_reads_run_in_autocommit_mode(self):
+        db = fake_connector({"ts_rank_cd": [("c1", 1, 0.5, None)], "chat_summaries": [(3, "m3", "summary")]})
+        connection = db.connection_pool._connection
+
+        await db.rank_chunks_by_text("query", 1)
+        await db.get_chat_summary(1)
+
+        self.assertEqual([(True, 0), (True, 0)], [(autocommit, transactions)
+                                                  for _, _, autocommit, transactions in connection.executed])
+        self.assertFalse(connection.autocommit)
+
+    async def test_search_overrides_apply_to_a_transaction_around_the_query(self):
+        db = fake_connector({"AS distance": [("c1", 1, 0.1, None)]})
+        connection = db.connection_pool._connection
+
+        await db.rank_chunks_by_embedding(EMBEDDING, 1, ef_search=200)
+
+        (setting, setting_params, _, setting_transactions), (_, _, _, query_transactions) = connection.executed
+        self.assertIn("set_config", setting)
+        self.assertEqual(("hnsw.ef_search", "200", True), setting_params)
+        self.assertEqual((1, 1), (setting_transactions, query_transactions))
+        self.assertFalse(connection.autocommit)
+
+    async def test_the_connection_leaves_autocommit_mode_when_a_read_fails(self):
+        def fail(params):
+            raise ValueError("invalid input")
+        db = fake_connector({"chat_summaries": fail})
+
+        with self.assertRaises(ValueError):
+            await db.get_chat_summary(1)
+
+        self.assertFalse(db.connection_pool._connection.autocommit)
+
+
+class CreateVectorIndexesTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_indexes_are_built_concurrently_outside_a_transaction(self):
+        db = fake_connector()
+        db.vector_index_config.update(hnsw_m=16, hnsw_ef_construction=64)
+        connection = db.connection_pool._connection
+
+        await db.create_vector_indexes("hnsw")
+
+        self.assertEqual([
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS "documents_embedding_hnsw_idx" ON "documents" '
+            'USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)',
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS "document_chunks_embedding_hnsw_idx" ON "document_chunks" '
+            'USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)',
+        ], [query for query, _, _, _ in connection.executed])
+        self.assertTrue(all(autocommit for _, _, autocommit, _ in connection.executed))
+        self.assertFalse(connection.autocommit)
+
+    async def test_an_unknown_method_is_rejected(self):
+        with self.assertRaises(ValueError):
+            await fake_connector().create_vector_indexes("flat")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+
+import numpy as np
+
+from llm.context_builder import ContextBuilder
+from llm.retrieval import SearchResult
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def passage(name, distance, embedding, words=10):
+    embedding = np.asarray(embedding, dtype=np.float32)
+    return SearchResult(1, chunk_id=name, distance=distance, name=name,
+                        embedding=embedding / np.linalg.norm(embedding),
+                        text=" ".join(f"{name}{i}" for i in range(words)))
+
+
+class ContextBuilderTest(unittest.TestCase):
+
+    def builder(self, token_budget=1000, mmr_lambda=0.5, min_passage_tokens=5):
+        # A header such as "--- a (Relevance: 0.90) ---" counts 5 words
+        return ContextBuilder(token_budget=token_budget, mmr_lambda=mmr_lambda, duplicate_threshold=0.95,
+                              min_passage_tokens=min_passage_tokens, count_tokens=count_words)
+
+    def test_near_duplicates_are_left_out(self):
+        context = self.builder().build([
+            passage("a", 0.1, [1, 0, 0]),
+            passage("b", 0.2, [1, 0.01, 0]),
+            passage("c", 0.3, [0, 1, 0]),
+        ])
+
+        self.assertIn("--- a", context)
+        self.assertNotIn("--- b", context)
+        self.assertIn("--- c", context)
+
+    def test_a_novel_passage_is_chosen_over_a_redundant_more_relevant_one(self):
+        # Only two passages fit: b is close to a, so c comes second although b is more relevant
+        context = self.builder(token_budget=30).build([
+            passage("a", 0.10, [1, 0, 0]),
+            passage("b", 0.15, [0.9, 0.43, 0]),
+            passage("c", 0.20, [0, 0, 1]),
+        ])
+
+        self.assertEqual(["a", "c"], [line.split()[1] for line in context.splitlines() if line.startswith("---")])
+
+    def test_passages_are_written_most_relevant_first(self):
+        context = self.builder(mmr_lambda=0.1).build([
+            passage("a", 0.3, [1, 0, 0]),
+            passage("b", 0.1, [0.8, 0.6, 0]),
+        ])
+
+        self.assertLess(context.index("--- b (Relevance: 0.90)"), context.index("--- a (Relevance: 0.70)"))
+
+    def test_the_last_passage_is_cut_to_the_budget(self):
+        context = self.builder(token_budget=30).build([
+            passage("a", 0.1, [1, 0, 0]),
+            passage("b", 0.2, [0, 1, 0], words=100),
+        ])
+
+        self.assertLessEqual(count_words(context), 30)
+        self.assertTrue(context.rstrip().endswith("..."))
+        self.assertIn("b0 b1", context)
+
+    def test_a_passage_is_skipped_when_too_little_of_it_fits(self):
+        context = self.builder(token_budget=20, min_passage_tokens=8).build([
+            passage("a", 0.1, [1, 0, 0]),
+            passage("b", 0.2, [0, 1, 0]),
+        ])
+
+        self.assertNotIn("--- b", context)
+        self.assertNotIn("...", context)
+
+    def test_passages_without_a_distance_keep_their_order_after_the_others(self):
+        lexical = [SearchResult(2, name="x", text="x text"), SearchResult(3, name="y", text="y text")]
+
+        context = self.builder().build([passage("a", 0.5, [1, 0, 0])] + lexical)
+
+        self.assertLess(context.index("--- a"), context.index("--- x ---"))
+        self.assertLess(context.index("--- x ---"), context.index("--- y ---"))
+
+    def test_no_context_without_text(self):
+        self.assertIsNone(self.builder().build([SearchResult(1, distance=0.1)]))
+
+
+if __name__ == "__main__":
+    unittest.main()
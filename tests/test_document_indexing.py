@@ -0,0 +1,126 @@
+import asyncio
+import threading
+import unittest
+
+import numpy as np
+from psycopg import OperationalError
+
+from benchmarks.fakes import FakeEmbeddingProvider, FakeSubscriber
+from db.connector import DatabaseConnector
+from pub_sub_consummer.document_indexing_consumer import DocumentIndexingConsumer
+from tests.fake_postgres import fake_connector, vector_column
+from vector_store import backends
+from vector_store.embeddings import EmbeddingProvider
+
+TEXT = "The first sentence of the document. The second sentence of the document."
+
+
+class RecordingEmbeddingProvider(FakeEmbeddingProvider):
+    """Records the texts it encodes"""
+
+    def __init__(self):
+        super().__init__(dimension=8)
+        self.encoded = []
+        # The threads that loaded the model, which reading the token limit does on a real provider
+        self.loading_threads = []
+
+    def load(self):
+        self.loading_threads.append(threading.current_thread())
+
+    @property
+    def chunk_token_limit(self):
+        self.load()
+        return self._chunk_token_limit
+
+    @chunk_token_limit.setter
+    def chunk_token_limit(self, value):
+        self._chunk_token_limit = value
+
+    def embed(self, texts):
+        self.encoded.extend(texts)
+        return super().embed(texts)
+
+
+class DocumentIndexingConsumerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stored_embedding = np.full(8, 1 / np.sqrt(8), dtype=np.float32)
+        # Every content hash the consumer looks up is already stored for the account
+        self.db = fake_connector({
+            "content_hash = ANY": lambda params: [(content_hash, vector_column(self.stored_embedding))
+                                                  for content_hash in params[1]],
+        })
+        self.provider = RecordingEmbeddingProvider()
+        self.singletons = (DatabaseConnector._instance, EmbeddingProvider._instance, backends._backend)
+        DatabaseConnector._instance = self.db
+        EmbeddingProvider._instance = self.provider
+        backends._backend = None
+        self.consumer = DocumentIndexingConsumer(subscriber=FakeSubscriber())
+
+    def tearDown(self):
+        self.consumer.loop.close()
+        asyncio.set_event_loop(None)
+        DatabaseConnector._instance, EmbeddingProvider._instance, backends._backend = self.singletons
+
+    def test_stored_embeddings_are_reused_as_arrays(self):
+        chunks, embeddings = self.consumer.loop.run_until_complete(
+            self.consumer._generate_chunk_embeddings(7, TEXT)
+        )
+
+        self.assertTrue(chunks)
+        self.assertEqual([], self.provider.encoded)
+        self.assertEqual((len(chunks), 8), embeddings.shape)
+        self.assertEqual(np.float32, embeddings.dtype)
+        np.testing.assert_allclose(np.tile(self.stored_embedding, (len(chunks), 1)), embeddings)
+
+    def test_only_unknown_contents_are_encoded(self):
+        self.db.connection_pool._connection.results = {"content_hash = ANY": []}
+
+        chunks, embeddings = self.consumer.loop.run_until_complete(
+            self.consumer._generate_chunk_embeddings(7, TEXT)
+        )
+
+        self.assertEqual([chunk['text'] for chunk in chunks], self.provider.encoded)
+        self.assertEqual((len(chunks), 8), embeddings.shape)
+
+    def test_the_model_is_loaded_off_the_event_loop(self):
+        self.db.open = self.open_nothing
+
+        self.consumer.loop.run_until_complete(self.consumer.startup())
+        self.consumer.loop.run_until_complete(self.consumer._generate_chunk_embeddings(7, TEXT))
+
+        self.assertEqual(2, len(self.provider.loading_threads))
+        self.assertNotIn(threading.main_thread(), self.provider.loading_threads)
+
+    def test_a_database_outage_is_raised_so_the_message_is_retried(self):
+        self.db.connection_pool._connection.results = {"content_hash = ANY": self.refuse_connection}
+
+        with self.assertRaises(OperationalError):
+            self.consumer.loop.run_until_complete(
+                self.consumer.callback({"document_id": 7, "document_text": TEXT})
+            )
+
+    def test_a_permanent_error_is_logged_so_the_message_is_acked(self):
+        self.provider.embed = self.reject_texts
+        self.db.connection_pool._connection.results = {"content_hash = ANY": []}
+
+        with self.assertLogs("pub_sub_consummer.pub_sub_consumer", level="ERROR"):
+            self.consumer.loop.run_until_complete(
+                self.consumer.callback({"document_id": 7, "document_text": TEXT})
+            )
+
+    @staticmethod
+    async def open_nothing():
+        pass
+
+    @staticmethod
+    def refuse_connection(params):
+        raise OperationalError("connection refused")
+
+    @staticmethod
+    def reject_texts(texts):
+        raise ValueError("texts cannot be encoded")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import asyncio
+import unittest
+
+import numpy as np
+
+from vector_store.embedding_batcher import EmbeddingBatcher
+
+
+class RecordingProvider:
+    """Embeds a text as a row holding its length, and records every encoded batch"""
+
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    async def embed_async(self, texts):
+        self.batches.append(list(texts))
+        if self.error:
+            raise self.error
+        return np.array([[float(len(text))] for text in texts], dtype=np.float32)
+
+
+class EmbeddingBatcherTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_requests_share_a_batch_and_get_their_own_rows(self):
+        provider = RecordingProvider()
+        batcher = EmbeddingBatcher(provider, max_batch_size=100, max_latency=0.01)
+
+        results = await asyncio.gather(batcher.embed(["a", "bb"]), batcher.embed(["ccc"]), batcher.embed(["dddd", "e"]))
+
+        self.assertEqual([["a", "bb", "ccc", "dddd", "e"]], provider.batches)
+        self.assertEqual([[1, 2], [3], [4, 1]], [result[:, 0].tolist() for result in results])
+
+    async def test_a_full_batch_is_flushed_immediately(self):
+        provider = RecordingProvider()
+        batcher = EmbeddingBatcher(provider, max_batch_size=3, max_latency=60)
+
+        results = await asyncio.wait_for(asyncio.gather(batcher.embed(["a", "bb"]), batcher.embed(["ccc"])), timeout=5)
+
+        self.assertEqual([["a", "bb", "ccc"]], provider.batches)
+        self.assertEqual([[1, 2], [3]], [result[:, 0].tolist() for result in results])
+
+    async def test_an_idle_batcher_does_not_wait_for_the_batch_to_fill(self):
+        provider = RecordingProvider()
+        batcher = EmbeddingBatcher(provider, max_batch_size=100, max_latency=60, flush_when_idle=True)
+
+        result = await asyncio.wait_for(batcher.embed(["abc"]), timeout=5)
+
+        self.assertEqual([[3.0]], result.tolist())
+
+    async def test_an_encoding_error_fails_every_request_of_the_batch(self):
+        batcher = EmbeddingBatcher(RecordingProvider(ValueError("model failed")), max_batch_size=100, max_latency=0)
+
+        results = await asyncio.gather(batcher.embed(["a"]), batcher.embed(["b"]), return_exceptions=True)
+
+        self.assertEqual(["model failed", "model failed"], [str(result) for result in results])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import asyncio
+import unittest
+
+from benchmarks.fakes import InMemoryDatabase
+from llm.history import ConversationHistory
+
+
+class RecordingSummarizer:
+    """Summarizes by listing the IDs of the messages, and records what it was asked"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def summarize_conversation(self, messages, previous_summary=None):
+        self.calls.append(([message["id"] for message in messages], previous_summary))
+        ids = " ".join(message["id"] for message in messages)
+        return f"{previous_summary} {ids}" if previous_summary else ids
+
+
+def chat(first, last):
+    return [{"id": f"m{i}", "sender": "user", "text": f"message {i}"} for i in range(first, last + 1)]
+
+
+def ids(messages):
+    return [message["id"] for message in messages]
+
+
+class ConversationHistoryTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.llm = RecordingSummarizer()
+        self.db = InMemoryDatabase()
+        # The 2 messages before the question are sent verbatim, and a summary is extended every 2 messages
+        self.history = ConversationHistory(self.llm, db=self.db, recent_messages=2, summary_batch=2)
+
+    async def settle(self):
+        await asyncio.gather(*self.history._refreshes.values())
+
+    async def test_a_short_chat_is_sent_whole(self):
+        messages = chat(0, 2)
+
+        self.assertEqual((None, messages), await self.history.window(1, messages))
+        self.assertEqual([], self.llm.calls)
+
+    async def test_a_chat_never_summarized_waits_for_its_summary(self):
+        summary, verbatim = await self.history.window(1, chat(0, 9))
+
+        self.assertEqual("m0 m1 m2 m3 m4 m5 m6", summary)
+        self.assertEqual(["m7", "m8", "m9"], ids(verbatim))
+        self.assertEqual((7, "m6", summary), self.db.summaries[1])
+
+    async def test_a_few_aged_out_messages_are_summarized_in_the_background(self):
+        self.db.summaries[1] = (4, "m3", "m0 m1 m2 m3")
+
+        summary, verbatim = await self.history.window(1, chat(0, 9))
+
+        self.assertEqual("m0 m1 m2 m3", summary)
+        self.assertEqual(["m4", "m5", "m6", "m7", "m8", "m9"], ids(verbatim))
+        await self.settle()
+        self.assertEqual([(["m4", "m5", "m6"], "m0 m1 m2 m3")], self.llm.calls)
+        self.assertEqual((7, "m6", "m0 m1 m2 m3 m4 m5 m6"), self.db.summaries[1])
+
+    async def test_the_summary_is_located_by_its_last_message(self):
+        # Only the last messages of a long chat are loaded
+        self.db.summaries[1] = (50, "m53", "the first 54 messages")
+
+        summary, verbatim = await self.history.window(1, chat(52, 59))
+
+        self.assertEqual("the first 54 messages", summary)
+        self.assertEqual(["m54", "m55", "m56", "m57", "m58", "m59"], ids(verbatim))
+
+    async def test_a_summary_of_changed_messages_is_rebuilt(self):
+        self.db.summaries[1] = (4, "deleted", "a summary of other messages")
+
+        summary, verbatim = await self.history.window(1, chat(0, 9))
+
+        self.assertEqual("m0 m1 m2 m3 m4 m5 m6", summary)
+        self.assertEqual([(["m0", "m1", "m2", "m3", "m4", "m5", "m6"], None)], self.llm.calls)
+
+    async def test_a_chat_is_refreshed_once_at_a_time(self):
+        self.db.summaries[1] = (4, "m3", "m0 m1 m2 m3")
+
+        await self.history.window(1, chat(0, 9))
+        await self.history.window(1, chat(0, 9))
+        await self.settle()
+
+        self.assertEqual(1, len(self.llm.calls))
+
+
+if __name__ == "__main__":
+    unittest.main()
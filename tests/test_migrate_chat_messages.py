@@ -0,0 +1,105 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+import migrate_chat_messages
+from db.connector import DatabaseConnector
+from migrate_chat_messages import message_rows
+from tests.fake_postgres import fake_connector
+
+
+class MessageRowsTest(unittest.TestCase):
+
+    def test_rows_keep_the_order_of_the_array(self):
+        messages = [
+            {"id": "a", "timestamp": "2024-05-01T10:00:00+00:00"},
+            {"id": "b", "timestamp": "2024-05-01T09:00:00+00:00"},
+            {"id": "c"},
+            {"id": "d", "timestamp": "2024-05-01T11:00:00+00:00"},
+        ]
+
+        rows = message_rows(7, messages)
+
+        self.assertEqual(["a", "b", "c", "d"], [message_id for _, message_id, _, _ in rows])
+        created_at = [row[2] for row in rows]
+        self.assertEqual(sorted(created_at), created_at)
+        self.assertEqual(datetime(2024, 5, 1, 10, tzinfo=timezone.utc), created_at[1])
+        self.assertEqual(datetime(2024, 5, 1, 11, tzinfo=timezone.utc), created_at[3])
+        self.assertEqual(messages, [message for _, _, _, message in rows])
+
+    def test_messages_without_an_id_get_their_position(self):
+        rows = message_rows(7, [{"text": "hello"}, "not a message", {"text": "bye", "timestamp": "2024-05-01T10:00:00"}])
+
+        self.assertEqual([(7, "legacy-0"), (7, "legacy-1")], [row[:2] for row in rows])
+        # Timestamps without a zone are read as UTC
+        self.assertEqual(datetime(2024, 5, 1, 10, tzinfo=timezone.utc), rows[1][2])
+
+    def test_malformed_timestamps_are_ignored(self):
+        rows = message_rows(7, [{"id": "a", "timestamp": "yesterday"}, {"id": "b", "timestamp": 42}])
+
+        self.assertEqual(2, len(rows))
+        self.assertTrue(all(row[2].tzinfo is not None for row in rows))
+
+
+class MigrateChatMessagesTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint = os.path.join(directory.name, "checkpoint.json")
+
+        self.chats = {chat_id: [{"id": f"{chat_id}-{i}", "text": "hi"} for i in range(2)] for chat_id in (1, 2, 3)}
+        self.inserted = set()
+        self.db = fake_connector({
+            "FROM chats": lambda params: [(chat_id, messages) for chat_id, messages in self.chats.items()
+                                          if chat_id > params[0]][:params[1]],
+            "INSERT INTO chat_messages": self.insert,
+        })
+        self.connector = DatabaseConnector._instance
+        DatabaseConnector._instance = self.db
+
+    def tearDown(self):
+        DatabaseConnector._instance = self.connector
+
+    def insert(self, params):
+        """ON CONFLICT DO NOTHING: only a new (chat_id, message_id) counts as an inserted row"""
+        key = params[:2]
+        if key in self.inserted:
+            return []
+        self.inserted.add(key)
+        return [key]
+
+    async def migrate(self, *args):
+        with mock.patch("sys.argv", ["migrate_chat_messages.py", "--batch-size", "2",
+                                     "--checkpoint", self.checkpoint, *args]):
+            await migrate_chat_messages.main()
+
+    async def test_every_message_is_copied_and_the_progress_saved(self):
+        await self.migrate()
+
+        self.assertEqual(6, len(self.inserted))
+        with open(self.checkpoint) as checkpoint:
+            self.assertEqual({"after_id": 3}, json.load(checkpoint))
+        self.assertTrue(self.db.connection_pool.closed)
+
+    async def test_a_run_resumes_after_the_checkpoint(self):
+        migrate_chat_messages.save_checkpoint(self.checkpoint, 2)
+
+        await self.migrate()
+
+        self.assertEqual({(3, "3-0"), (3, "3-1")}, self.inserted)
+
+    async def test_running_again_copies_nothing_twice(self):
+        await self.migrate()
+        await self.migrate("--restart")
+
+        executed = self.db.connection_pool._connection.executed
+        self.assertEqual(12, sum(1 for query, _, _, _ in executed if "INSERT INTO chat_messages" in query))
+        self.assertEqual(6, len(self.inserted))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from tests.fake_postgres import fake_connector, vector_column
+from vector_store.backends import MmapVectorBackend
+from vector_store.mmap_index import MmapVectorIndex
+
+
+def unit_vectors(*rows):
+    vectors = np.asarray(rows, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class MmapVectorIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.index = MmapVectorIndex(self.directory.name, account_id=1, max_segments=2)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def ranked_chunks(self, index, query, top_k=10):
+        return [chunk_id for chunk_id, _, _, _ in index.search(unit_vectors(query)[0], top_k)]
+
+    def test_search_ranks_the_upserted_chunks_by_distance(self):
+        self.index.upsert_document(10, ["a", "b"], unit_vectors([1, 0, 0], [0, 1, 0]))
+        self.index.upsert_document(20, ["c"], unit_vectors([1, 1, 0]))
+
+        rows = self.index.search(unit_vectors([1, 0, 0])[0], top_k=2)
+
+        self.assertEqual(["a", "c"], [chunk_id for chunk_id, _, _, _ in rows])
+        self.assertEqual([10, 20], [document_id for _, document_id, _, _ in rows])
+        self.assertAlmostEqual(0.0, rows[0][2], places=5)
+        self.assertEqual(3, len(self.index))
+
+    def test_an_upsert_replaces_the_chunks_of_its_document(self):
+        self.index.upsert_document(10, ["a", "b"], unit_vectors([1, 0, 0], [0, 1, 0]))
+        self.index.upsert_document(10, ["a2"], unit_vectors([0, 0, 1]))
+
+        self.assertEqual(["a2"], self.ranked_chunks(self.index, [1, 0, 0]))
+        self.assertEqual(1, len(self.index))
+
+    def test_a_delete_removes_the_chunks_of_its_document(self):
+        self.index.upsert_document(10, ["a"], unit_vectors([1, 0, 0]))
+        self.index.upsert_document(20, ["b"], unit_vectors([0, 1, 0]))
+        self.index.delete_document(10)
+        self.index.delete_document(30)
+
+        self.assertEqual(["b"], self.ranked_chunks(self.index, [1, 0, 0]))
+        self.assertEqual(1, len(self.index))
+
+    def test_writes_beyond_max_segments_are_compacted(self):
+        for document_id in range(6):
+            self.index.upsert_document(document_id, [f"chunk-{document_id}"], unit_vectors([document_id + 1, 1, 0]))
+        self.index.upsert_document(0, ["chunk-0b"], unit_vectors([0, 0, 1]))
+
+        self.assertLessEqual(len(self.index.segments), self.index.max_segments + 1)
+        self.assertEqual(6, len(self.index))
+        self.assertEqual("chunk-0b", self.ranked_chunks(self.index, [0, 0, 1])[0])
+        self.assertNotIn("chunk-0", self.ranked_chunks(self.index, [1, 1, 0]))
+
+    def test_a_reader_sees_the_writes_of_another_instance(self):
+        reader = MmapVectorIndex(self.directory.name, account_id=1)
+        self.assertFalse(reader.exists())
+        self.assertEqual([], reader.search(unit_vectors([1, 0, 0])[0]))
+
+        self.index.upsert_document(10, ["a"], unit_vectors([1, 0, 0]))
+        self.assertEqual(["a"], self.ranked_chunks(reader, [1, 0, 0]))
+
+        self.index.upsert_document(20, ["b"], unit_vectors([0, 1, 0]))
+        self.index.delete_document(10)
+        self.assertEqual(["b"], self.ranked_chunks(reader, [1, 0, 0]))
+
+    def test_a_rebuild_replaces_the_whole_index(self):
+        self.index.upsert_document(10, ["a"], unit_vectors([1, 0, 0]))
+        self.index.rebuild(["x", "y"], [1, 2], unit_vectors([0, 1, 0], [0, 0, 1]))
+
+        self.assertEqual(["x", "y"], self.ranked_chunks(self.index, [0, 1, 0.1]))
+        self.assertEqual(2, len(self.index))
+
+    def test_a_failed_load_is_retried_by_the_next_search(self):
+        self.index.upsert_document(10, ["a"], unit_vectors([1, 0, 0]))
+        reader = MmapVectorIndex(self.directory.name, account_id=1)
+
+        # The segment files of every attempt were removed by a compaction meanwhile
+        with mock.patch.object(reader, "_map", side_effect=FileNotFoundError):
+            self.assertEqual([], self.ranked_chunks(reader, [1, 0, 0]))
+
+        self.assertEqual(["a"], self.ranked_chunks(reader, [1, 0, 0]))
+
+    def test_an_account_without_chunks_can_be_rebuilt(self):
+        self.index.rebuild([], [], np.array([], dtype=np.float32))
+        self.assertEqual(0, len(self.index))
+
+        self.index.upsert_document(10, ["a"], unit_vectors([1, 0, 0]))
+        self.assertEqual(["a"], self.ranked_chunks(self.index, [1, 0, 0]))
+
+
+class MmapVectorBackendTest(unittest.TestCase):
+    """The backend builds an account's index from the chunk embeddings the connector reads"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_the_index_is_built_from_the_database_on_first_use(self):
+        db = fake_connector({"ORDER BY document_id, chunk_index": [
+            ("a", 10, vector_column(unit_vectors([1, 0, 0])[0])),
+            ("b", 20, vector_column(unit_vectors([0, 1, 0])[0])),
+        ]})
+        backend = MmapVectorBackend(db=db, directory=self.directory.name)
+
+        rows = asyncio.run(backend.rank_chunks(unit_vectors([0, 1, 0])[0], 1, top_k=2))
+
+        self.assertEqual([("b", 20), ("a", 10)], [row[:2] for row in rows])
+        self.assertAlmostEqual(0.0, rows[0][2], places=5)
+
+    def test_an_account_without_chunks_is_rebuilt_empty(self):
+        backend = MmapVectorBackend(db=fake_connector(), directory=self.directory.name)
+
+        asyncio.run(backend.rebuild_account(1))
+
+        self.assertEqual([], asyncio.run(backend.rank_chunks(unit_vectors([1, 0, 0])[0], 1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
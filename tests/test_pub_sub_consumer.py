@@ -0,0 +1,86 @@
+import asyncio
+import unittest
+from concurrent.futures import Future
+
+from google.api_core import exceptions as api_exceptions
+from psycopg import OperationalError
+
+from benchmarks.fakes import FakeMessage, FakeSubscriber
+from pub_sub_consummer.pub_sub_consumer import PubSubConsumer
+
+
+class NoopConsumer(PubSubConsumer):
+    __subscription_id__ = "noop"
+
+    async def callback(self, message: dict):
+        pass
+
+
+def settled_future(result=None, error=None):
+    future = Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+class SettleMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = NoopConsumer(subscriber=FakeSubscriber())
+
+    def tearDown(self):
+        self.consumer.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_a_succeeded_callback_acks(self):
+        message = FakeMessage("1", b"{}")
+        future = settled_future()
+        self.consumer.pending_futures.add(future)
+
+        self.consumer._settle_message(message, future)
+
+        self.assertTrue(message.acked)
+        self.assertFalse(self.consumer.pending_futures)
+
+    def test_a_failed_callback_nacks(self):
+        message = FakeMessage("1", b"{}")
+
+        self.consumer._settle_message(message, settled_future(error=OperationalError("connection refused")))
+
+        self.assertFalse(message.acked)
+
+    def test_a_cancelled_callback_nacks(self):
+        message = FakeMessage("1", b"{}")
+        future = Future()
+        future.cancel()
+
+        self.consumer._settle_message(message, future)
+
+        self.assertFalse(message.acked)
+
+
+class TransientErrorTest(unittest.TestCase):
+
+    def test_unavailable_services_are_transient(self):
+        for error in (OperationalError("connection refused"), ConnectionResetError(), TimeoutError(),
+                      api_exceptions.ServiceUnavailable("down"), api_exceptions.TooManyRequests("quota")):
+            self.assertTrue(PubSubConsumer.is_transient_error(error), error)
+
+    def test_the_cause_of_an_error_is_followed(self):
+        try:
+            try:
+                raise OperationalError("connection refused")
+            except OperationalError as e:
+                raise RuntimeError("could not store the document") from e
+        except RuntimeError as e:
+            self.assertTrue(PubSubConsumer.is_transient_error(e))
+
+    def test_deterministic_errors_are_permanent(self):
+        for error in (ValueError("bad message"), KeyError("document_text"), api_exceptions.InvalidArgument("too long")):
+            self.assertFalse(PubSubConsumer.is_transient_error(error), error)
+
+
+if __name__ == "__main__":
+    unittest.main()
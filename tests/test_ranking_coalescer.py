@@ -0,0 +1,79 @@
+import asyncio
+import unittest
+
+import numpy as np
+
+from vector_store.ranking_coalescer import RankingCoalescer
+
+
+class RankingCoalescerTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.single_calls = []
+        self.batch_calls = []
+        # Holds the single rankings while it is cleared
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def rank(self, request):
+        self.single_calls.append(request)
+        await self.gate.wait()
+        return [(f"chunk-{request.account_id}", request.top_k)]
+
+    async def rank_batch(self, requests):
+        self.batch_calls.append(requests)
+        return [[(f"chunk-{request.account_id}", request.top_k)] for request in requests]
+
+    async def test_concurrent_rankings_run_as_one_batch(self):
+        coalescer = RankingCoalescer("chunks", self.rank, self.rank_batch, max_batch_size=10, max_latency=0.01)
+        query = np.ones(3, dtype=np.float32)
+
+        results = await asyncio.gather(*(coalescer.rank(query, account_id, top_k=account_id + 1)
+                                         for account_id in range(4)))
+
+        self.assertEqual([[("chunk-0", 1)], [("chunk-1", 2)], [("chunk-2", 3)], [("chunk-3", 4)]], results)
+        self.assertEqual(1, len(self.batch_calls))
+        self.assertEqual([0, 1, 2, 3], [request.account_id for request in self.batch_calls[0]])
+        self.assertEqual([], self.single_calls)
+
+    async def test_a_lone_ranking_runs_on_its_own(self):
+        coalescer = RankingCoalescer("chunks", self.rank, self.rank_batch, max_batch_size=10, max_latency=60)
+
+        result = await asyncio.wait_for(coalescer.rank(np.ones(3), 7, top_k=5, with_embeddings=True), timeout=5)
+
+        self.assertEqual([("chunk-7", 5)], result)
+        self.assertEqual([], self.batch_calls)
+        self.assertTrue(self.single_calls[0].with_embeddings)
+
+    async def test_rankings_made_during_a_batch_wait_for_it(self):
+        coalescer = RankingCoalescer("chunks", self.rank, self.rank_batch, max_batch_size=10, max_latency=60)
+        self.gate.clear()
+
+        first = asyncio.ensure_future(coalescer.rank(np.ones(3), 1, top_k=1))
+        while not self.single_calls:
+            await asyncio.sleep(0)
+        rest = [asyncio.ensure_future(coalescer.rank(np.ones(3), account_id, top_k=1)) for account_id in (2, 3)]
+        await asyncio.sleep(0)
+        self.gate.set()
+
+        # The later rankings are flushed together once the first batch completes, not after max_latency
+        results = await asyncio.wait_for(asyncio.gather(first, *rest), timeout=5)
+
+        self.assertEqual([[("chunk-1", 1)], [("chunk-2", 1)], [("chunk-3", 1)]], results)
+        self.assertEqual([1], [request.account_id for request in self.single_calls])
+        self.assertEqual([[2, 3]], [[request.account_id for request in batch] for batch in self.batch_calls])
+
+    async def test_a_batch_error_fails_every_ranking(self):
+        async def failing_batch(requests):
+            raise ConnectionError("database unavailable")
+
+        coalescer = RankingCoalescer("chunks", self.rank, failing_batch, max_batch_size=10, max_latency=0.01)
+
+        results = await asyncio.gather(coalescer.rank(np.ones(3), 1, 1), coalescer.rank(np.ones(3), 2, 1),
+                                       return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, ConnectionError) for result in results))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+from psycopg import OperationalError
+
+from benchmarks.fakes import FakeEmbeddingProvider
+from db.connector import DatabaseConnector
+from llm.retrieval import DocumentRetriever, InvalidationClock, SearchResult, TTLLRUCache, reciprocal_rank_fusion
+from tests.fake_postgres import fake_connector, vector_column
+from vector_store import backends
+from vector_store.embeddings import EmbeddingProvider
+
+
+class ReciprocalRankFusionTest(unittest.TestCase):
+
+    def test_items_found_by_both_rankings_come_first(self):
+        vector = [SearchResult(1, distance=0.1), SearchResult(2, distance=0.2), SearchResult(3, distance=0.3)]
+        lexical = [SearchResult(3, rank=0.9), SearchResult(4, rank=0.5)]
+
+        fused = reciprocal_rank_fusion([vector, lexical], key="document_id", top_k=3, k=60)
+
+        self.assertEqual([3, 1, 2], [result.document_id for result in fused])
+        self.assertAlmostEqual(1 / 63 + 1 / 61, fused[0].rrf_score)
+        self.assertAlmostEqual(1 / 61, fused[1].rrf_score)
+
+    def test_fused_items_keep_the_scores_of_every_ranking(self):
+        vector = [SearchResult(1, chunk_id="a", distance=0.1)]
+        lexical = [SearchResult(1, chunk_id="a", rank=0.7, text="text")]
+
+        fused = reciprocal_rank_fusion([vector, lexical], key="chunk_id", top_k=5)
+
+        self.assertEqual(1, len(fused))
+        self.assertEqual((0.1, 0.7, "text"), (fused[0].distance, fused[0].rank, fused[0].text))
+
+    def test_a_single_ranking_keeps_its_order(self):
+        ranking = [SearchResult(i) for i in (5, 3, 8)]
+
+        fused = reciprocal_rank_fusion([ranking, []], key="document_id", top_k=2)
+
+        self.assertEqual([5, 3], [result.document_id for result in fused])
+
+
+class TTLLRUCacheTest(unittest.TestCase):
+
+    def test_the_least_recently_used_entry_is_evicted(self):
+        cache = TTLLRUCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual((1, None, 3), (cache.get("a"), cache.get("b"), cache.get("c")))
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(2, len(cache))
+
+    def test_entries_expire_after_their_ttl(self):
+        cache = TTLLRUCache(max_size=2, ttl=10)
+        with mock.patch("llm.retrieval.time.monotonic", return_value=100.0):
+            cache.set("a", 1)
+        with mock.patch("llm.retrieval.time.monotonic", return_value=109.0):
+            self.assertEqual(1, cache.get("a"))
+        with mock.patch("llm.retrieval.time.monotonic", return_value=111.0):
+            self.assertIsNone(cache.get("a"))
+
+        self.assertEqual(0, len(cache))
+        self.assertEqual({"hits": 1, "misses": 1}, {key: cache.stats()[key] for key in ("hits", "misses")})
+
+    def test_invalidate_removes_the_selected_keys(self):
+        cache = TTLLRUCache(max_size=10, ttl=60)
+        for key in [("passages", 1), ("passages", 2), ("documents", 1)]:
+            cache.set(key, key)
+
+        self.assertEqual(2, cache.invalidate(lambda key: key[1] == 1))
+        self.assertEqual([("passages", 2)], [key for key in [("passages", 1), ("passages", 2)] if cache.get(key)])
+        self.assertEqual(1, cache.invalidate())
+        self.assertEqual(0, len(cache))
+
+    def test_a_cache_without_entries_stores_nothing(self):
+        cache = TTLLRUCache(max_size=0, ttl=60)
+        cache.set("a", 1)
+
+        self.assertIsNone(cache.get("a"))
+
+
+class InvalidationClockTest(unittest.TestCase):
+
+    def test_only_the_invalidated_account_changed(self):
+        clock = InvalidationClock(max_accounts=10)
+        time = clock.now()
+        clock.invalidate(1)
+
+        self.assertTrue(clock.changed_since("1", time))
+        self.assertFalse(clock.changed_since(2, time))
+        self.assertFalse(clock.changed_since(1, clock.now()))
+
+    def test_a_global_invalidation_changes_every_account(self):
+        clock = InvalidationClock(max_accounts=10)
+        time = clock.now()
+        clock.invalidate()
+
+        self.assertTrue(clock.changed_since(42, time))
+
+    def test_forgotten_accounts_count_as_changed(self):
+        clock = InvalidationClock(max_accounts=2)
+        time = clock.now()
+        for account_id in range(5):
+            clock.invalidate(account_id)
+
+        self.assertEqual(2, len(clock))
+        self.assertTrue(clock.changed_since(0, time))
+        self.assertFalse(clock.changed_since(0, clock.now()))
+
+
+class DocumentRetrieverTest(unittest.IsolatedAsyncioTestCase):
+    """Retrieval on the default Postgres backend, with vector columns decoded as the connector reads them"""
+
+    def setUp(self):
+        embedding = np.array([0.6, 0.8, 0.0], dtype=np.float32)
+        self.db = fake_connector({
+            "AS distance": [("c1", 1, 0.1, vector_column(embedding))],
+            "ts_rank_cd": [("c2", 2, 0.5, vector_column(embedding))],
+            "JOIN documents": lambda params: [(chunk_id, 0, "name", f"text of {chunk_id}") for chunk_id in params[-2]],
+        })
+        self.singletons = (DatabaseConnector._instance, EmbeddingProvider._instance, backends._backend)
+        DatabaseConnector._instance = self.db
+        EmbeddingProvider._instance = FakeEmbeddingProvider(dimension=3)
+        backends._backend = None
+        self.retriever = DocumentRetriever()
+        # There is no database to listen to
+        self.retriever._ensure_invalidation_listener = lambda: None
+
+    def tearDown(self):
+        DatabaseConnector._instance, EmbeddingProvider._instance, backends._backend = self.singletons
+
+    async def test_passages_come_with_their_embeddings(self):
+        passages = await self.retriever.retrieve_passages("a question", 1, top_k=1, mode="vector",
+                                                          with_embeddings=True)
+
+        self.assertEqual(["c1"], [passage.chunk_id for passage in passages])
+        self.assertEqual("text of c1", passages[0].text)
+        self.assertIsInstance(passages[0].embedding, np.ndarray)
+
+    async def test_hybrid_passages_found_by_text_get_a_distance(self):
+        passages = await self.retriever.retrieve_passages("a question", 1, top_k=2, mode="hybrid")
+
+        self.assertEqual({"c1", "c2"}, {passage.chunk_id for passage in passages})
+        self.assertTrue(all(passage.distance is not None for passage in passages))
+        self.assertTrue(all(passage.embedding is None for passage in passages))
+
+    async def test_cached_passages_are_copies(self):
+        first = await self.retriever.retrieve_passages("a question", 1, top_k=1, mode="vector", with_embeddings=True)
+        first[0].text = "changed by the caller"
+        first[0].embedding[0] = 0.0
+
+        second = await self.retriever.retrieve_passages("a question", 1, top_k=1, mode="vector", with_embeddings=True)
+
+        self.assertEqual("text of c1", second[0].text)
+        self.assertAlmostEqual(0.6, float(second[0].embedding[0]), places=5)
+        self.assertEqual(1, self.retriever.result_cache.hits)
+
+    async def test_a_database_outage_is_raised_rather_than_answered_without_context(self):
+        def refuse_connection(params):
+            raise OperationalError("connection refused")
+        self.db.connection_pool._connection.results = {"": refuse_connection}
+
+        for mode in ("vector", "lexical", "hybrid"):
+            with self.assertRaises(OperationalError):
+                await self.retriever.retrieve_passages("a question", 1, top_k=1, mode=mode)
+            with self.assertRaises(OperationalError):
+                await self.retriever.retrieve_documents("a question", 1, top_k=1, mode=mode)
+
+
+if __name__ == "__main__":
+    unittest.main()
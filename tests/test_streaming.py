@@ -0,0 +1,67 @@
+import unittest
+from types import SimpleNamespace
+
+from benchmarks.fakes import InMemoryDatabase
+from llm.fake_gemini import FakeGeminiModel
+from llm.gemini_client import GeminiClient
+from llm.response_sinks import ChatMessageSink
+from pub_sub_consummer.ai_assistant_consumer import AiAssistantConsumer
+
+REPLY = "Paris is the capital of France."
+QUESTION = [{"id": "m1", "sender": "user", "text": "What is the capital of France?"}]
+
+
+class RecordingDatabase(InMemoryDatabase):
+    """Records the text of every chat message write"""
+
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    async def upsert_chat_message(self, chat_id, message):
+        self.writes.append((message["id"], message["text"]))
+        await super().upsert_chat_message(chat_id, message)
+
+
+class StreamResponseTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.model = FakeGeminiModel(reply=REPLY, chunk_size=5)
+        self.client = GeminiClient(self.model)
+        self.db = RecordingDatabase()
+
+    async def test_stream_yields_the_reply_in_chunks(self):
+        chunks = [text async for text in self.client.stream_response(QUESTION, "Some context", "A summary")]
+
+        self.assertEqual(REPLY, "".join(chunks))
+        self.assertEqual([REPLY[i:i + 5] for i in range(0, len(REPLY), 5)], chunks)
+
+        session = self.model.sessions[-1]
+        self.assertEqual([QUESTION[-1]["text"]], session.sent_messages)
+        self.assertEqual(["Summary of the earlier conversation:\nA summary", "Some context"],
+                         [message["parts"][0] for message in session.history])
+
+    async def test_every_partial_response_is_written_then_the_final_one(self):
+        sink = ChatMessageSink(self.db, 1, {"id": "m1-response", "sender": "assistant", "text": ""}, flush_interval=0)
+        consumer = SimpleNamespace(llm=self.client)
+
+        text = await AiAssistantConsumer._stream_response(consumer, QUESTION, None, sink)
+
+        self.assertEqual(REPLY, text)
+        # Each chunk extends the same message; the final text was already written, so it is not written twice
+        self.assertEqual([("m1-response", REPLY[:end]) for end in range(5, len(REPLY), 5)] + [("m1-response", REPLY)],
+                         self.db.writes)
+        self.assertEqual([{"id": "m1-response", "sender": "assistant", "text": REPLY}], self.db.chats[1])
+
+    async def test_partial_writes_are_throttled(self):
+        sink = ChatMessageSink(self.db, 1, {"id": "m1-response", "sender": "assistant", "text": ""}, flush_interval=60)
+        consumer = SimpleNamespace(llm=self.client)
+
+        await AiAssistantConsumer._stream_response(consumer, QUESTION, None, sink)
+
+        # The first chunk is written immediately, the rest only once the response is complete
+        self.assertEqual([("m1-response", REPLY[:5]), ("m1-response", REPLY)], self.db.writes)
+
+
+if __name__ == "__main__":
+    unittest.main()
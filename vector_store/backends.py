@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from db.connector import DatabaseConnector, get_db_connector
+from vector_store.mmap_index import MmapVectorIndex
+
+logger = logging.getLogger(__name__)
+
+
+class VectorBackend(ABC):
+    """
+    Ranks the chunks of an account against a query embedding.
+    Postgres always stores the chunks; a backend may keep its own copy of the vectors to rank them.
+    """
+
+    def __init__(self, db: Optional[DatabaseConnector] = None):
+        self.db = db or get_db_connector()
+
+    @abstractmethod
+    async def rank_chunks(self, query_embedding: np.ndarray, account_id: int, top_k: int = 5,
+                          with_embeddings: bool = False) -> List[Tuple[str, int, float, Optional[np.ndarray]]]:
+        """
+        Find the chunks closest to a query embedding. Their text is fetched separately, once the
+        caller has chosen which of them it needs.
+
+        Parameters:
+            query_embedding: The normalized query embedding
+            account_id: The account whose documents are searched
+            top_k: Number of chunks to return
+            with_embeddings: Also return the embedding of every chunk
+
+        Returns:
+            The (chunk ID, document ID, distance, embedding or None) of the closest chunks, closest first
+        """
+        return NotImplemented
+
+    async def rank_chunks_batch(self, queries: List[Tuple[np.ndarray, int, int, bool]]
+                                ) -> List[List[Tuple[str, int, float, Optional[np.ndarray]]]]:
+        """
+        Find the chunks closest to several query embeddings, e.g. the questions of many chats at once
+
+        Parameters:
+            queries: The (normalized query embedding, account ID, number of chunks, with embeddings) of every query
+
+        Returns:
+            The rows rank_chunks would return for every query, in the order of the queries
+        """
+        return list(await asyncio.gather(*(self.rank_chunks(*query) for query in queries)))
+
+    async def upsert_document(self, account_id: int, document_id: int, chunk_ids: List[str], embeddings: np.ndarray):
+        """Keep the backend in sync after a document was (re)indexed in Postgres"""
+
+    async def delete_document(self, account_id: int, document_id: int):
+        """Keep the backend in sync after a document was removed from Postgres"""
+
+    async def rebuild_account(self, account_id: int):
+        """Reload the vectors of an account from Postgres after many of its documents were written in bulk"""
+
+
+class PostgresVectorBackend(VectorBackend):
+    """Ranks chunks with pgvector inside Postgres"""
+
+    async def rank_chunks(self, query_embedding: np.ndarray, account_id: int, top_k: int = 5,
+                          with_embeddings: bool = False) -> List[Tuple[str, int, float, Optional[np.ndarray]]]:
+        return await self.db.rank_chunks_by_embedding(query_embedding, account_id, top_k, with_embeddings)
+
+    async def rank_chunks_batch(self, queries: List[Tuple[np.ndarray, int, int, bool]]
+                                ) -> List[List[Tuple[str, int, float, Optional[np.ndarray]]]]:
+        # One statement and one connection for every query
+        return await self.db.rank_chunks_by_embeddings(queries)
+
+
+class MmapVectorBackend(VectorBackend):
+    """
+    Ranks chunks in process against a memory-mapped float32 matrix per account, without querying Postgres.
+    """
+
+    def __init__(self, db: Optional[DatabaseConnector] = None, directory: Optional[str] = None):
+        super().__init__(db)
+        self.directory = directory or os.getenv("VECTOR_INDEX_DIR", "/var/lib/rag-api/vector-index")
+        self.indexes: Dict[int, MmapVectorIndex] = {}
+
+    async def _get_index(self, account_id: int) -> MmapVectorIndex:
+        """Get the index of an account, building it from Postgres the first time it is needed"""
+        index = self.indexes.get(account_id)
+        if index is None:
+            index = MmapVectorIndex(self.directory, account_id)
+            if not index.exists():
+                logger.info(f"Building vector index for account {account_id} from the database")
+                chunk_ids, document_ids, embeddings = await self.db.get_account_chunk_embeddings(account_id)
+                await asyncio.to_thread(index.rebuild, chunk_ids, document_ids, embeddings)
+            self.indexes[account_id] = index
+        return index
+
+    async def rank_chunks(self, query_embedding: np.ndarray, account_id: int, top_k: int = 5,
+                          with_embeddings: bool = False) -> List[Tuple[str, int, float, Optional[np.ndarray]]]:
+        index = await self._get_index(account_id)
+        return index.search(query_embedding, top_k, with_embeddings)
+
+    async def rank_chunks_batch(self, queries: List[Tuple[np.ndarray, int, int, bool]]
+                                ) -> List[List[Tuple[str, int, float, Optional[np.ndarray]]]]:
+        # The queries of an account are scored against its matrix in one product
+        by_account: Dict[int, List[int]] = {}
+        for position, (_, account_id, _, _) in enumerate(queries):
+            by_account.setdefault(account_id, []).append(position)
+
+        results: List[List[Tuple[str, int, float, Optional[np.ndarray]]]] = [[] for _ in queries]
+        for account_id, positions in by_account.items():
+            index = await self._get_index(account_id)
+            top_k = max(queries[position][2] for position in positions)
+            with_embeddings = any(queries[position][3] for position in positions)
+            rankings = index.search_batch(np.stack([queries[position][0] for position in positions]), top_k,
+                                          with_embeddings)
+            for position, rows in zip(positions, rankings):
+                _, _, query_top_k, query_with_embeddings = queries[position]
+                results[position] = [
+                    row if query_with_embeddings else (*row[:3], None) for row in rows[:query_top_k]
+                ]
+        return results
+
+    async def rebuild_account(self, account_id: int):
+        index = self.indexes.get(account_id) or MmapVectorIndex(self.directory, account_id)
+        chunk_ids, document_ids, embeddings = await self.db.get_account_chunk_embeddings(account_id)
+        await asyncio.to_thread(index.rebuild, chunk_ids, document_ids, embeddings)
+        self.indexes[account_id] = index
+
+    async def upsert_document(self, account_id: int, document_id: int, chunk_ids: List[str], embeddings: np.ndarray):
+        index = await self._get_index(account_id)
+        await asyncio.to_thread(index.upsert_document, document_id, chunk_ids, embeddings)
+
+    async def delete_document(self, account_id: int, document_id: int):
+        index = await self._get_index(account_id)
+        await asyncio.to_thread(index.delete_document, document_id)
+
+
+VECTOR_BACKENDS = {
+    "postgres": PostgresVectorBackend,
+    "mmap": MmapVectorBackend,
+}
+
+_backend: Optional[VectorBackend] = None
+
+
+def get_vector_backend() -> VectorBackend:
+    """Get the shared vector backend selected by the RETRIEVAL_BACKEND setting"""
+    global _backend
+    if _backend is None:
+        name = os.getenv("RETRIEVAL_BACKEND", "postgres")
+        if name not in VECTOR_BACKENDS:
+            raise ValueError(f"Unknown retrieval backend '{name}', expected one of {list(VECTOR_BACKENDS)}")
+        _backend = VECTOR_BACKENDS[name]()
+        logger.info(f"Using the {name} retrieval backend")
+    return _backend
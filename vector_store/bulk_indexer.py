@@ -0,0 +1,265 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from db.connector import DatabaseConnector, get_db_connector
+from vector_store.backends import VectorBackend, get_vector_backend
+from vector_store.chunking import chunk_document, content_hash
+from vector_store.embeddings import get_embedding_provider, mean_embedding
+
+logger = logging.getLogger(__name__)
+
+# A batch of documents to index, with the source position to resume from once it is stored
+DocumentBatch = Tuple[int, List[Tuple[int, str]]]
+
+
+def _init_worker(threads: int):
+    """Load the embedding model once per worker process, limiting the threads torch uses"""
+    import torch
+
+    torch.set_num_threads(threads)
+    get_embedding_provider().load()
+
+
+def _embed_documents(documents: List[Tuple[int, str]], max_tokens: Optional[int],
+                     overlap_tokens: int) -> List[Tuple[int, List[Dict[str, Any]], np.ndarray]]:
+    """
+    Chunk a batch of documents and encode all their chunks in one call, in a worker process
+
+    Parameters:
+        documents: The (document_id, text) pairs to index
+        max_tokens: Maximum number of tokens per chunk, defaults to what the model reads without truncating
+        overlap_tokens: Maximum number of tokens repeated from the previous chunk
+
+    Returns:
+        The chunk dictionaries and chunk embeddings of every document
+    """
+    provider = get_embedding_provider()
+
+    chunked = []
+    for document_id, text in documents:
+        chunks = chunk_document(
+            {'document_id': document_id, 'document_text': text},
+            max_tokens or provider.chunk_token_limit,
+            overlap_tokens,
+            provider.count_tokens
+        )
+        if not chunks:
+            chunks = [{
+                'chunk_id': f"{document_id}_0",
+                'document_id': document_id,
+                'chunk_index': 0,
+                'text': text[:512],
+                'content_hash': content_hash(text[:512]),
+                'chunk_count': 1
+            }]
+        chunked.append((document_id, chunks))
+
+    embeddings = provider.embed([chunk['text'] for _, chunks in chunked for chunk in chunks])
+
+    results = []
+    offset = 0
+    for document_id, chunks in chunked:
+        results.append((document_id, chunks, embeddings[offset:offset + len(chunks)]))
+        offset += len(chunks)
+    return results
+
+
+def iter_jsonl_documents(path: str, skip: int = 0, batch_size: int = 64) -> Iterator[DocumentBatch]:
+    """
+    Read documents from a JSONL file holding one document indexing message per line
+
+    Parameters:
+        path: The file, with 'document_id' and 'document_text' (or 'id' and 'text') on every line
+        skip: Number of lines already indexed
+        batch_size: Number of documents per batch
+
+    Returns:
+        An iterator over batches, with the number of lines read so far as their position
+    """
+    batch = []
+    line_number = 0
+    with open(path, encoding='utf-8') as file:
+        for line_number, line in enumerate(file, start=1):
+            if line_number <= skip or not line.strip():
+                continue
+
+            record = json.loads(line)
+            document_id = record.get('document_id', record.get('id'))
+            text = record.get('document_text', record.get('text'))
+            if not document_id or not text:
+                logger.warning(f"Skipping line {line_number} of {path}: missing document id or text")
+                continue
+
+            batch.append((int(document_id), text))
+            if len(batch) >= batch_size:
+                yield line_number, batch
+                batch = []
+
+    if batch:
+        yield line_number, batch
+
+
+class BulkIndexer:
+    """
+    Re-indexes many documents at once, outside the Pub/Sub queue.
+    Documents are chunked and encoded in large batches by a pool of processes, each with its own copy
+    of the model, and the results are written with the same bulk writes as the indexing consumer.
+    Progress is saved to a checkpoint file after every stored batch, so an interrupted run can resume,
+    with the accounts whose vector indexes must be rebuilt at the end.
+    """
+
+    def __init__(self, checkpoint_path: str, workers: Optional[int] = None, batch_size: int = 64,
+                 max_tokens: Optional[int] = None, overlap_tokens: int = 32,
+                 db: Optional[DatabaseConnector] = None, vector_backend: Optional[VectorBackend] = None):
+        """
+        Initialize the indexer
+
+        Parameters:
+            checkpoint_path: The JSON file progress is saved to and resumed from
+            workers: Number of encoding processes, defaults to the number of CPUs
+            batch_size: Number of documents encoded per worker task and stored per transaction
+            max_tokens: Maximum number of tokens per chunk, defaults to what the model reads without truncating
+            overlap_tokens: Maximum number of tokens repeated from the previous chunk
+            db: The database connector
+            vector_backend: The vector backend to rebuild once the run is over
+        """
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.db = db or get_db_connector()
+        self.vector_backend = vector_backend or get_vector_backend()
+
+        self.processed = 0
+        self.indexed = 0
+        self.accounts: Set[int] = set()
+        self._started_at = 0.0
+
+    def load_checkpoint(self, source: str) -> int:
+        """
+        Get the position an earlier run over the same source stopped at, and the accounts it indexed
+
+        Parameters:
+            source: Identifies the source, e.g. 'database' or the JSONL path
+
+        Returns:
+            The saved position, or 0 to start from the beginning
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+
+        with open(self.checkpoint_path, encoding='utf-8') as file:
+            checkpoint = json.load(file)
+
+        if checkpoint.get('source') != source:
+            logger.warning(f"Ignoring checkpoint {self.checkpoint_path}, which belongs to source {checkpoint.get('source')}")
+            return 0
+
+        self.accounts.update(checkpoint.get('accounts', []))
+        logger.info(f"Resuming {source} from position {checkpoint['position']}")
+        return checkpoint['position']
+
+    def save_checkpoint(self, source: str, position: int):
+        """Atomically record that every document up to a source position is stored, and their accounts"""
+        temporary_path = f"{self.checkpoint_path}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump({'source': source, 'position': position, 'accounts': sorted(self.accounts),
+                       'updated_at': time.time()}, file)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    async def index_database(self, account_id: Optional[int] = None):
+        """
+        Re-index the documents stored in the database, in ID order
+
+        Parameters:
+            account_id: Only re-index the documents of this account
+        """
+        source = 'database' if account_id is None else f'database:{account_id}'
+        after_id = self.load_checkpoint(source)
+
+        async def batches() -> AsyncIterator[DocumentBatch]:
+            async for rows in self.db.iter_documents(after_id, account_id, self.batch_size):
+                yield rows[-1][0], [(document_id, text) for document_id, _, text in rows]
+
+        await self.run(source, batches())
+
+    async def index_jsonl(self, path: str):
+        """
+        Re-index the documents of a JSONL file of document indexing messages
+
+        Parameters:
+            path: The JSONL file
+        """
+        source = f'jsonl:{os.path.abspath(path)}'
+        skip = self.load_checkpoint(source)
+
+        async def batches() -> AsyncIterator[DocumentBatch]:
+            for batch in iter_jsonl_documents(path, skip, self.batch_size):
+                yield batch
+
+        await self.run(source, batches())
+
+    async def run(self, source: str, batches: AsyncIterator[DocumentBatch]):
+        """
+        Encode batches in the process pool while earlier batches are written to the database.
+        Batches are stored in source order, so the checkpoint never skips an unstored document.
+
+        Parameters:
+            source: Identifies the source in the checkpoint
+            batches: The document batches, with their source positions
+        """
+        loop = asyncio.get_running_loop()
+        threads = max(1, (os.cpu_count() or 1) // self.workers)
+        pending: Deque[Tuple[int, int, asyncio.Future]] = deque()
+        self._started_at = time.monotonic()
+
+        logger.info(f"Indexing {source} with {self.workers} worker processes, {self.batch_size} documents per batch")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=(threads,)) as pool:
+            async for position, documents in batches:
+                future = loop.run_in_executor(
+                    pool, partial(_embed_documents, documents, self.max_tokens, self.overlap_tokens)
+                )
+                pending.append((position, len(documents), future))
+
+                # Keep every worker busy while bounding the encoded batches held in memory
+                if len(pending) >= 2 * self.workers:
+                    await self._store(source, *pending.popleft())
+
+            while pending:
+                await self._store(source, *pending.popleft())
+
+        for account_id in self.accounts:
+            await self.vector_backend.rebuild_account(account_id)
+
+        elapsed = time.monotonic() - self._started_at
+        logger.info(f"Indexed {self.indexed} of {self.processed} documents in {elapsed:.0f}s "
+                    f"({self.processed / elapsed if elapsed else 0:.1f} docs/s)")
+
+    async def _store(self, source: str, position: int, count: int, future: asyncio.Future):
+        """Write an encoded batch in one transaction and checkpoint its position"""
+        results = await future
+        stored = await self.db.store_document_indexes([
+            (document_id, mean_embedding(embeddings), chunks, embeddings)
+            for document_id, chunks, embeddings in results
+        ], replace_chunks=True)
+
+        self.accounts.update(stored.values())
+        self.processed += count
+        self.indexed += len(stored)
+        self.save_checkpoint(source, position)
+
+        elapsed = time.monotonic() - self._started_at
+        logger.info(f"Indexed {self.indexed} documents, up to position {position} "
+                    f"({self.processed / elapsed if elapsed else 0:.1f} docs/s)")
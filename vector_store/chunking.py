@@ -1,9 +1,175 @@
-from typing import List
+import hashlib
+from collections import deque
+from typing import Callable, Deque, Iterable, Iterator, List, Optional, Tuple, Union
 import re
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Sentence terminator, optionally followed by closing quotes or brackets, then whitespace
+_SENTENCE_END = re.compile(r'[.!?]["\')\]]*\s')
+
+_WHITESPACE = re.compile(r'\s+')
+
+# Longest run of text kept while waiting for a sentence terminator, which bounds memory use
+MAX_SENTENCE_CHARS = 4000
+
+# Size of the slices a string is read in
+TEXT_PIECE_SIZE = 64 * 1024
+
+
+def iter_text_pieces(text: str, piece_size: int = TEXT_PIECE_SIZE) -> Iterator[str]:
+    """
+    Read a string in fixed-size slices, so that it can be chunked like a stream
+
+    Parameters:
+        text: The text to read
+        piece_size: Number of characters per slice
+
+    Returns:
+        An iterator over the slices
+    """
+    for start in range(0, len(text), piece_size):
+        yield text[start:start + piece_size]
+
+
+def iter_sentences(pieces: Iterable[str]) -> Iterator[str]:
+    """
+    Split a stream of text into sentences in a single pass, collapsing whitespace.
+    Text without a sentence terminator is cut at a space every MAX_SENTENCE_CHARS characters.
+
+    Parameters:
+        pieces: The text, as an iterable of consecutive pieces (e.g. a file object or iter_text_pieces)
+
+    Returns:
+        An iterator over the sentences
+    """
+    buffer = ""
+
+    for piece in pieces:
+        piece = _WHITESPACE.sub(' ', piece)
+        if piece.startswith(' ') and (not buffer or buffer.endswith(' ')):
+            piece = piece[1:]
+
+        # A terminator at the end of the previous piece only matches once its whitespace arrives
+        scan_from = max(len(buffer) - 4, 0)
+        buffer += piece
+
+        last_end = 0
+        for match in _SENTENCE_END.finditer(buffer, scan_from):
+            sentence = buffer[last_end:match.end()].strip()
+            if sentence:
+                yield sentence
+            last_end = match.end()
+        buffer = buffer[last_end:]
+
+        while len(buffer) > MAX_SENTENCE_CHARS:
+            cut = buffer.rfind(' ', 0, MAX_SENTENCE_CHARS)
+            if cut <= 0:
+                cut = MAX_SENTENCE_CHARS
+            sentence = buffer[:cut].strip()
+            if sentence:
+                yield sentence
+            buffer = buffer[cut:]
+
+    sentence = buffer.strip()
+    if sentence:
+        yield sentence
+
+
+def _split_long_sentence(sentence: str, max_tokens: int, count_tokens: Callable[[str], int]) -> Iterator[Tuple[str, int]]:
+    """Split a sentence that does not fit in a chunk into runs of words that do, spaces included"""
+    separator_tokens = count_tokens(' ')
+    words: List[str] = []
+    words_tokens = 0
+
+    for word in sentence.split(' '):
+        word_tokens = count_tokens(word) + (separator_tokens if words else 0)
+        if words and words_tokens + word_tokens > max_tokens:
+            yield ' '.join(words), words_tokens
+            words, words_tokens = [], 0
+            word_tokens -= separator_tokens
+        words.append(word)
+        words_tokens += word_tokens
+
+    if words:
+        yield ' '.join(words), words_tokens
+
+
+def iter_chunks(source: Union[str, Iterable[str]], max_tokens: int = 256, overlap_tokens: int = 32,
+                count_tokens: Optional[Callable[[str], int]] = None) -> Iterator[str]:
+    """
+    Split a text into chunks of whole sentences holding at most max_tokens tokens, counting the spaces
+    that join the sentences. Consecutive chunks share their trailing sentences, up to overlap_tokens tokens.
+    The text is consumed as a stream, so memory use does not depend on its length.
+
+    Parameters:
+        source: The text, or an iterable of consecutive pieces of it
+        max_tokens: Maximum number of tokens per chunk
+        overlap_tokens: Maximum number of tokens repeated from the previous chunk
+        count_tokens: Counts the tokens of a string; defaults to counting characters
+
+    Returns:
+        An iterator over the chunks
+    """
+    if isinstance(source, str):
+        source = iter_text_pieces(source)
+    count_tokens = count_tokens or len
+    # The sentences of a chunk are joined by a space, which counts as a character but usually not as a token
+    separator_tokens = count_tokens(' ')
+
+    window: Deque[Tuple[str, int]] = deque()
+    window_tokens = 0
+    has_new_text = False
+
+    def sentence_parts() -> Iterator[Tuple[str, int]]:
+        for sentence in iter_sentences(source):
+            sentence_tokens = count_tokens(sentence)
+            if sentence_tokens > max_tokens:
+                yield from _split_long_sentence(sentence, max_tokens, count_tokens)
+            else:
+                yield sentence, sentence_tokens
+
+    for sentence, sentence_tokens in sentence_parts():
+        if window and window_tokens + separator_tokens + sentence_tokens > max_tokens:
+            if has_new_text:
+                yield ' '.join(text for text, _ in window)
+
+            # Keep the trailing sentences as overlap, as long as the next sentence still fits
+            overlap = 0
+            keep = 0
+            for _, tokens in reversed(window):
+                kept_tokens = tokens + (separator_tokens if keep else 0)
+                if (overlap + kept_tokens > overlap_tokens
+                        or overlap + kept_tokens + separator_tokens + sentence_tokens > max_tokens):
+                    break
+                overlap += kept_tokens
+                keep += 1
+            while len(window) > keep:
+                window.popleft()
+            window_tokens = overlap
+            has_new_text = False
+
+        window_tokens += sentence_tokens + (separator_tokens if window else 0)
+        window.append((sentence, sentence_tokens))
+        has_new_text = True
+
+    if window and has_new_text:
+        yield ' '.join(text for text, _ in window)
+
+
+def content_hash(text: str) -> str:
+    """
+    Hash the content of a chunk, to recognize chunks whose embedding is already known
+
+    Parameters:
+        text: The chunk text
+
+    Returns:
+        The hex SHA-256 digest of the UTF-8 text
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
 
 def chunk_text(text: str, chunk_size: int = 500, chunk_overlap: int = 50) -> List[str]:
     """
@@ -20,53 +186,26 @@ def chunk_text(text: str, chunk_size: int = 500, chunk_overlap: int = 50) -> Lis
     if not text or len(text) <= chunk_size:
         return [text] if text else []
 
-    # Clean the text - remove excessive whitespace
-    text = re.sub(r'\s+', ' ', text).strip()
-
-    chunks = []
-    start = 0
-    text_length = len(text)
-
-    while start < text_length:
-        end = min(start + chunk_size, text_length)
-
-        if end < text_length:
-            # Look for the last period, question mark, or exclamation point followed by a space
-            last_sentence_break = max(
-                text.rfind('. ', start, end),
-                text.rfind('? ', start, end),
-                text.rfind('! ', start, end)
-            )
-
-            # If we found a good sentence break, use it
-            if last_sentence_break != -1 and last_sentence_break > start + (chunk_size // 2):
-                end = last_sentence_break + 1
-            else:
-                last_space = text.rfind(' ', start, end)
-                if last_space != -1:
-                    end = last_space
-
-        chunk = text[start:end].strip()
-        if chunk:
-            chunks.append(chunk)
-
-        start = end - chunk_overlap if end < text_length else text_length
+    chunks = list(iter_chunks(text, max_tokens=chunk_size, overlap_tokens=chunk_overlap))
 
     logger.debug(f"Split text into {len(chunks)} chunks")
     return chunks
 
 
-def chunk_document(document: dict, chunk_size: int = 500, chunk_overlap: int = 50) -> List[dict]:
+def chunk_document(document: dict, chunk_size: int = 500, chunk_overlap: int = 50,
+                   count_tokens: Optional[Callable[[str], int]] = None) -> List[dict]:
     """
     Split a document into chunks
 
     Parameters:
-        document: A dictionary containing 'document_id' and 'document_text'
-        chunk_size: The target size for each chunk
-        chunk_overlap: The number of characters to overlap between chunks
+        document: A dictionary containing 'document_id' and 'document_text'; the text may be
+            a string or an iterable of consecutive pieces of it
+        chunk_size: The maximum size of each chunk, in tokens as counted by count_tokens
+        chunk_overlap: The maximum number of tokens to overlap between chunks
+        count_tokens: Counts the tokens of a string; defaults to counting characters
 
     Returns:
-        A list of document chunks with metadata
+        A list of document chunks with metadata, including the content hash of every chunk
     """
     document_id = document.get('document_id')
     document_text = document.get('document_text', '')
@@ -75,11 +214,12 @@ def chunk_document(document: dict, chunk_size: int = 500, chunk_overlap: int = 5
         logger.warning(f"Invalid document: missing id or text")
         return []
 
-    text_chunks = chunk_text(
-        text=document_text,
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap
-    )
+    text_chunks = list(iter_chunks(
+        document_text,
+        max_tokens=chunk_size,
+        overlap_tokens=chunk_overlap,
+        count_tokens=count_tokens
+    ))
 
     document_chunks = []
     for i, text in enumerate(text_chunks):
@@ -88,6 +228,7 @@ def chunk_document(document: dict, chunk_size: int = 500, chunk_overlap: int = 5
             'document_id': document_id,
             'chunk_index': i,
             'text': text,
+            'content_hash': content_hash(text),
             'chunk_count': len(text_chunks)
         })
 
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+from vector_store.embeddings import EmbeddingProvider
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """
+    Collects texts from many in-flight requests and encodes them with a single model call.
+
+    A batch is flushed as soon as it holds `max_batch_size` texts, or when the oldest
+    pending request has waited `max_latency` seconds, whichever happens first.
+    The flushed batch is encoded on the embedding executor, so the next batch keeps filling meanwhile.
+    With `flush_when_idle`, requests made while no batch is encoding are flushed on the next iteration of
+    the event loop instead, and the ones waiting for an encoding are flushed as soon as it completes.
+    """
+
+    def __init__(self, provider: EmbeddingProvider, max_batch_size: Optional[int] = None,
+                 max_latency: Optional[float] = None, flush_when_idle: bool = False):
+        """
+        Initialize the batcher
+
+        Parameters:
+            provider: The embedding provider used to encode the texts
+            max_batch_size: Number of texts that triggers an immediate flush
+            max_latency: Maximum time in seconds a request waits for its batch to fill
+            flush_when_idle: Only wait for the batch to fill while another one is encoding, e.g. for queries
+                that should not wait when the worker is quiet
+        """
+        self.provider = provider
+        self.max_batch_size = max_batch_size or int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+        if max_latency is None:
+            max_latency = float(os.getenv("EMBEDDING_BATCH_MAX_LATENCY_MS", "50")) / 1000
+        self.max_latency = max_latency
+        self.flush_when_idle = flush_when_idle
+
+        self._pending: List[Tuple[List[str], asyncio.Future]] = []
+        self._pending_size = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._encode_tasks: Set[asyncio.Task] = set()
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode a list of texts as part of the next batch.
+
+        Parameters:
+            texts: The texts to encode
+
+        Returns:
+            A (len(texts), dim) array with one normalized embedding per text
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        self._pending.append((list(texts), future))
+        self._pending_size += len(texts)
+
+        if self._pending_size >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            idle = self.flush_when_idle and not self._encode_tasks
+            self._flush_handle = loop.call_later(0 if idle else self.max_latency, self._flush)
+
+        return await future
+
+    def _flush(self):
+        """Close the pending batch and start encoding it"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, []
+        self._pending_size = 0
+
+        if not pending:
+            return
+
+        task = asyncio.get_running_loop().create_task(self._encode(pending))
+        self._encode_tasks.add(task)
+        task.add_done_callback(self._encoded)
+
+    def _encoded(self, task: asyncio.Task):
+        self._encode_tasks.discard(task)
+        if self.flush_when_idle and self._pending and not self._encode_tasks:
+            self._flush()
+
+    async def _encode(self, pending: List[Tuple[List[str], asyncio.Future]]):
+        """Encode every text of a batch in one call and hand each request its slice of the result"""
+        texts = [text for request_texts, _ in pending for text in request_texts]
+
+        try:
+            embeddings = await self.provider.embed_async(texts)
+        except Exception as e:
+            logger.error(f"Error encoding batch of {len(texts)} texts: {str(e)}")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        logger.debug(f"Encoded batch of {len(texts)} texts for {len(pending)} requests")
+
+        offset = 0
+        for request_texts, future in pending:
+            count = len(request_texts)
+            if not future.done():
+                future.set_result(embeddings[offset:offset + count])
+            offset += count
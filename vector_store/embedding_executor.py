@@ -0,0 +1,23 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_embedding_executor() -> ThreadPoolExecutor:
+    """
+    Get the executor that runs model forward passes.
+
+    Encoding is CPU-bound, so it runs on its own small thread pool instead of the event loop.
+    Torch releases the GIL while it computes, so the loop keeps serving I/O meanwhile.
+    """
+    global _executor
+    if _executor is None:
+        workers = int(os.getenv("EMBEDDING_WORKERS", "1"))
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embedding")
+        logger.info(f"Created embedding executor with {workers} workers")
+    return _executor
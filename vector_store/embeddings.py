@@ -0,0 +1,211 @@
+import asyncio
+import copy
+import logging
+import os
+import threading
+from concurrent.futures import Executor
+from functools import partial
+from typing import List, Optional
+
+import numpy as np
+
+from monitoring import get_startup_profile, timed
+from vector_store.embedding_executor import get_embedding_executor
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BACKENDS = ('torch', 'onnx')
+
+EMBEDDING_PRECISIONS = ('float32', 'float16', 'bfloat16')
+
+
+class EmbeddingProvider:
+    """
+    Owns the sentence-transformers model of the process, shared by indexing and retrieval.
+    The model is loaded on first use, and encoding is serialized so it is safe to call from any thread.
+    Implements the Singleton pattern.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls, warmup: Optional[bool] = None):
+        """
+        Get the singleton instance of EmbeddingProvider
+
+        Parameters:
+            warmup: Warm up the model when the instance is created, defaults to the EMBEDDING_WARMUP setting
+        """
+        if cls._instance is None:
+            cls._instance = cls()
+            if warmup is None:
+                warmup = embedding_warmup_enabled()
+            if warmup:
+                cls._instance.warmup()
+        return cls._instance
+
+    def __init__(self, model_name: Optional[str] = None, device: Optional[str] = None,
+                 precision: Optional[str] = None, backend: Optional[str] = None,
+                 executor: Optional[Executor] = None):
+        """
+        Initialize the provider without loading the model
+
+        Parameters:
+            model_name: The sentence-transformers model to load
+            device: The torch device the model runs on
+            precision: The torch weights precision, one of EMBEDDING_PRECISIONS
+            backend: 'torch', or 'onnx' to run the model with ONNX Runtime
+            executor: The executor used by embed_async, defaults to the shared embedding executor
+        """
+        self.model_name = model_name or os.getenv("EMBEDDING_MODEL_NAME", "all-MiniLM-L6-v2")
+        self.device = device or os.getenv("EMBEDDING_DEVICE", "cpu")
+        self.precision = precision or os.getenv("EMBEDDING_PRECISION", "float32")
+        self.backend = backend or os.getenv("EMBEDDING_BACKEND", "torch")
+        # e.g. "onnx/model_qint8_avx512_vnni.onnx" for the int8 quantized CPU model
+        self.onnx_file = os.getenv("EMBEDDING_ONNX_FILE")
+        self.batch_size = int(os.getenv("EMBEDDING_ENCODE_BATCH_SIZE", "32"))
+        self.executor = executor or get_embedding_executor()
+
+        if self.backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unknown embedding backend '{self.backend}', expected one of {EMBEDDING_BACKENDS}")
+        if self.precision not in EMBEDDING_PRECISIONS:
+            raise ValueError(f"Unknown embedding precision '{self.precision}', expected one of {EMBEDDING_PRECISIONS}")
+
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._encode_lock = threading.Lock()
+        self._counting_tokenizer = None
+        self._count_lock = threading.Lock()
+
+    @property
+    def model(self):
+        """The loaded model, loading it on first access"""
+        if self._model is None:
+            self.load()
+        return self._model
+
+    @property
+    def tokenizer(self):
+        """The tokenizer of the model"""
+        return self.model.tokenizer
+
+    @property
+    def max_seq_length(self) -> int:
+        """Number of tokens the model reads before truncating its input"""
+        return self.model.max_seq_length
+
+    @property
+    def chunk_token_limit(self) -> int:
+        """Number of text tokens that fit in the model input next to the special tokens"""
+        return self.max_seq_length - 2
+
+    @property
+    def dimension(self) -> int:
+        """Size of the embeddings produced by the model"""
+        return self.model.get_sentence_embedding_dimension()
+
+    def load(self):
+        """Load the model if it is not loaded yet"""
+        with self._load_lock:
+            if self._model is not None:
+                return
+
+            startup = get_startup_profile()
+            # sentence_transformers imports torch, so it is only imported once a model is needed
+            SentenceTransformer = startup.import_module("sentence_transformers").SentenceTransformer
+
+            logger.info(f"Loading embedding model {self.model_name} ({self.backend}, {self.precision}) on {self.device}")
+            kwargs = {"device": self.device}
+            if self.backend == "onnx":
+                kwargs["backend"] = "onnx"
+                if self.onnx_file:
+                    kwargs["model_kwargs"] = {"file_name": self.onnx_file}
+
+            with startup.stage("model"):
+                model = SentenceTransformer(self.model_name, **kwargs)
+
+                if self.backend == "torch" and self.precision == "float16":
+                    model = model.half()
+                elif self.backend == "torch" and self.precision == "bfloat16":
+                    model = model.bfloat16()
+
+            self._model = model
+            logger.info("Embedding model loaded")
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Count the tokens of a text as the model tokenizes it, without truncation or special tokens.
+        Counting uses its own copy of the tokenizer, so it can run while the model is encoding.
+
+        Parameters:
+            text: The text to count
+
+        Returns:
+            The number of tokens
+        """
+        with self._count_lock:
+            if self._counting_tokenizer is None:
+                self._counting_tokenizer = copy.deepcopy(self.tokenizer.backend_tokenizer)
+                self._counting_tokenizer.no_truncation()
+                self._counting_tokenizer.no_padding()
+            return len(self._counting_tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def warmup(self):
+        """Load the model and run one forward pass, so the first real request does not pay for it"""
+        self.load()
+        with get_startup_profile().stage("model.warmup"):
+            self.embed(["warmup"])
+        logger.info("Embedding model warmed up")
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode texts into normalized embeddings.
+
+        Parameters:
+            texts: The texts to encode
+
+        Returns:
+            A (len(texts), dim) float32 array
+        """
+        model = self.model
+        with self._encode_lock, timed("embedding.encode"):
+            embeddings = model.encode(
+                texts,
+                batch_size=self.batch_size,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+        return np.asarray(embeddings, dtype=np.float32)
+
+    async def embed_async(self, texts: List[str]) -> np.ndarray:
+        """Encode texts on the embedding executor without blocking the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(self.embed, texts))
+
+
+def mean_embedding(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Build a document-level embedding by averaging its chunk embeddings.
+
+    Parameters:
+        embeddings: The chunk embeddings of a document
+
+    Returns:
+        The normalized mean embedding
+    """
+    mean = np.mean(embeddings, axis=0)
+
+    norm = np.linalg.norm(mean)
+    if norm > 0:
+        mean = mean / norm
+
+    return mean
+
+
+def embedding_warmup_enabled() -> bool:
+    """Whether the EMBEDDING_WARMUP setting asks for a forward pass when the worker starts"""
+    return os.getenv("EMBEDDING_WARMUP", "false").lower() == "true"
+
+
+def get_embedding_provider():
+    """Get the singleton instance of EmbeddingProvider"""
+    return EmbeddingProvider.get_instance()
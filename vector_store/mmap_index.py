@@ -0,0 +1,318 @@
+import fcntl
+import json
+import logging
+import os
+from contextlib import contextmanager
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class _Segment(NamedTuple):
+    """The mapped files of one write, and which of their rows later writes did not replace"""
+    vectors: np.ndarray
+    chunk_ids: np.ndarray
+    document_ids: np.ndarray
+    live: Optional[np.ndarray]
+
+
+class MmapVectorIndex:
+    """
+    The chunk embeddings of one account, kept as float32 matrices in memory-mapped .npy files.
+
+    The index is a base segment followed by the delta segments of the writes since: a write only saves
+    the chunks of its document, and the documents it replaces are masked in the older segments. Once
+    there are more than `max_segments` deltas, the next write compacts every live row into a new base.
+    Every write atomically swaps a small manifest listing the segments, so readers in other processes
+    never see a half-written index. Readers map the new segments when the manifest changes.
+    """
+
+    def __init__(self, directory: str, account_id: int, max_segments: Optional[int] = None):
+        """
+        Initialize the index of an account
+
+        Parameters:
+            directory: The directory where the index files are stored
+            account_id: The account the index belongs to
+            max_segments: Number of delta segments after which they are compacted into the base
+        """
+        self.account_id = account_id
+        self.directory = os.path.join(directory, str(account_id))
+        self.manifest_path = os.path.join(self.directory, "manifest.json")
+        self.max_segments = max_segments or int(os.getenv("VECTOR_INDEX_MAX_SEGMENTS", "8"))
+
+        self.segments: List[_Segment] = []
+        self.live_count = 0
+        self._entries: List[Dict[str, Any]] = []
+        self._mapped: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._loaded_version: Optional[int] = None
+        self._manifest_mtime: Optional[int] = None
+
+    def exists(self) -> bool:
+        """Whether the index has been written at least once"""
+        return os.path.exists(self.manifest_path)
+
+    def __len__(self) -> int:
+        self.refresh()
+        return self.live_count
+
+    def refresh(self):
+        """Map the new segments if another process wrote a new version"""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+
+        if mtime == self._manifest_mtime:
+            return
+
+        # A writer may compact the segments and remove the files of the version we just read
+        for _ in range(3):
+            with open(self.manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+
+            version = manifest["version"]
+            if version != self._loaded_version:
+                # Indexes written before delta segments have a single segment named after their version
+                entries = manifest.get("segments") or [{"id": version, "count": manifest["count"], "replaces": []}]
+                try:
+                    mapped = {entry["id"]: self._mapped.get(entry["id"]) or self._map(entry) for entry in entries}
+                except FileNotFoundError:
+                    continue
+
+                self._load(entries, mapped)
+                self._loaded_version = version
+                logger.debug(f"Loaded vector index version {version} for account {self.account_id} "
+                             f"with {len(entries)} segments")
+
+            # Only remembered once its version is loaded, so that a failed load is retried by the next search
+            self._manifest_mtime = mtime
+            return
+
+        logger.warning(f"Vector index of account {self.account_id} changed while it was loaded, "
+                       f"keeping version {self._loaded_version}")
+
+    def search(self, query_embedding: np.ndarray, top_k: int = 5,
+               with_embeddings: bool = True) -> List[Tuple[str, int, float, Optional[np.ndarray]]]:
+        """
+        Find the chunks closest to a query embedding
+
+        Parameters:
+            query_embedding: The normalized query embedding
+            top_k: Number of chunks to return
+            with_embeddings: Copy the embedding of every chunk out of the mapped file
+
+        Returns:
+            (chunk_id, document_id, cosine distance, embedding or None) tuples, closest first
+        """
+        return self.search_batch(np.asarray(query_embedding, dtype=np.float32)[np.newaxis], top_k, with_embeddings)[0]
+
+    def search_batch(self, query_embeddings: np.ndarray, top_k: int = 5,
+                     with_embeddings: bool = True) -> List[List[Tuple[str, int, float, Optional[np.ndarray]]]]:
+        """
+        Find the chunks closest to each of several query embeddings, scoring them all in one matrix product
+        per segment
+
+        Parameters:
+            query_embeddings: A (queries, dim) array of normalized query embeddings
+            top_k: Number of chunks to return per query
+            with_embeddings: Copy the embedding of every chunk out of the mapped file
+
+        Returns:
+            For every query, (chunk_id, document_id, cosine distance, embedding or None) tuples, closest first
+        """
+        self.refresh()
+        if self.live_count == 0:
+            return [[] for _ in range(len(query_embeddings))]
+
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        scores = []
+        for segment in self.segments:
+            segment_scores = query_embeddings @ segment.vectors.T
+            if segment.live is not None:
+                # Replaced chunks can never rank, since at most live_count chunks are selected
+                segment_scores[:, ~segment.live] = -np.inf
+            scores.append(segment_scores)
+        scores = np.hstack(scores)
+        k = min(top_k, self.live_count)
+
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+
+        return [[self._row(i, 1.0 - query_scores[i], with_embeddings) for i in query_top]
+                for query_scores, query_top in zip(scores, top)]
+
+    def upsert_document(self, document_id: int, chunk_ids: List[str], embeddings: np.ndarray):
+        """
+        Replace the chunks of a document in the index
+
+        Parameters:
+            document_id: The ID of the document
+            chunk_ids: The IDs of the document's chunks
+            embeddings: One normalized embedding per chunk
+        """
+        with self._write_lock():
+            self.refresh()
+            self._append_segment(
+                np.asarray(embeddings, dtype=np.float32).reshape(len(chunk_ids), -1),
+                np.asarray(chunk_ids, dtype=str),
+                np.full(len(chunk_ids), document_id, dtype=np.int64),
+                replaces=[document_id]
+            )
+
+    def delete_document(self, document_id: int):
+        """
+        Remove every chunk of a document from the index
+
+        Parameters:
+            document_id: The ID of the document
+        """
+        with self._write_lock():
+            self.refresh()
+            if not any(np.any(segment.document_ids[self._live_mask(segment)] == document_id)
+                       for segment in self.segments):
+                return
+            self._append_segment(np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=str),
+                                 np.empty(0, dtype=np.int64), replaces=[document_id])
+
+    def rebuild(self, chunk_ids: List[str], document_ids: List[int], embeddings: np.ndarray):
+        """
+        Replace the whole index
+
+        Parameters:
+            chunk_ids: The IDs of every chunk of the account
+            document_ids: The document of each chunk
+            embeddings: One normalized embedding per chunk
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self._write_lock():
+            self.refresh()
+            self._write_base(
+                # An account without chunks has no embedding dimension to reshape to
+                embeddings.reshape(len(chunk_ids), -1) if len(chunk_ids) else embeddings.reshape(0, 0),
+                np.asarray(chunk_ids, dtype=str),
+                np.asarray(document_ids, dtype=np.int64)
+            )
+
+    def _map(self, entry: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Map the files of a segment; a segment that only removes documents has none"""
+        if entry["count"] == 0:
+            return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=str), np.empty(0, dtype=np.int64)
+        return tuple(np.load(self._path(entry["id"], name), mmap_mode="r")
+                     for name in ("vectors", "chunk_ids", "document_ids"))
+
+    def _load(self, entries: List[Dict[str, Any]], mapped: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]]):
+        """Mask the rows of every segment whose document a later segment replaces"""
+        segments = []
+        replaced = np.empty(0, dtype=np.int64)
+        for entry in reversed(entries):
+            vectors, chunk_ids, document_ids = mapped[entry["id"]]
+            if chunk_ids.shape[0]:
+                live = ~np.isin(document_ids, replaced) if replaced.size else None
+                segments.append(_Segment(vectors, chunk_ids, document_ids, live))
+            replaced = np.union1d(replaced, np.asarray(entry["replaces"], dtype=np.int64))
+        segments.reverse()
+
+        self.segments = segments
+        self.live_count = sum(s.chunk_ids.shape[0] if s.live is None else int(s.live.sum()) for s in segments)
+        self._offsets = np.cumsum([0] + [s.chunk_ids.shape[0] for s in segments])
+        self._entries = entries
+        self._mapped = mapped
+
+    def _row(self, column: int, distance: float, with_embeddings: bool) -> Tuple[str, int, float, Optional[np.ndarray]]:
+        """The result at a column of the scores of every segment"""
+        position = int(np.searchsorted(self._offsets, column, side="right")) - 1
+        segment, row = self.segments[position], column - self._offsets[position]
+        return (str(segment.chunk_ids[row]), int(segment.document_ids[row]), float(distance),
+                np.array(segment.vectors[row]) if with_embeddings else None)
+
+    @staticmethod
+    def _live_mask(segment: _Segment) -> np.ndarray:
+        return np.ones(segment.chunk_ids.shape[0], dtype=bool) if segment.live is None else segment.live
+
+    def _append_segment(self, vectors: np.ndarray, chunk_ids: np.ndarray, document_ids: np.ndarray,
+                        replaces: List[int]):
+        """Publish a write as a new delta segment, or compact it with the others once there are too many"""
+        if not self._entries or len(self._entries) - 1 >= self.max_segments:
+            # The live rows of every segment except the replaced documents, then the written ones
+            parts = []
+            for segment in self.segments:
+                keep = self._live_mask(segment) & ~np.isin(segment.document_ids, replaces)
+                if keep.any():
+                    parts.append((np.asarray(segment.vectors)[keep], np.asarray(segment.chunk_ids)[keep],
+                                  np.asarray(segment.document_ids)[keep]))
+            if chunk_ids.shape[0]:
+                parts.append((vectors, chunk_ids, document_ids))
+
+            if parts:
+                vectors, chunk_ids, document_ids = (np.concatenate(arrays) for arrays in zip(*parts))
+            self._write_base(vectors, chunk_ids, document_ids)
+            return
+
+        version = self._next_version()
+        if chunk_ids.shape[0]:
+            self._save(version, vectors, chunk_ids, document_ids)
+        self._publish(version, self._entries + [
+            {"id": version, "count": int(chunk_ids.shape[0]), "replaces": [int(d) for d in replaces]}
+        ])
+
+    def _write_base(self, vectors: np.ndarray, chunk_ids: np.ndarray, document_ids: np.ndarray):
+        """Replace every segment with a single one"""
+        version = self._next_version()
+        if chunk_ids.shape[0]:
+            self._save(version, vectors, chunk_ids, document_ids)
+        self._publish(version, [{"id": version, "count": int(chunk_ids.shape[0]), "replaces": []}])
+
+    def _next_version(self) -> int:
+        return (self._loaded_version or 0) + 1
+
+    def _save(self, segment_id: int, vectors: np.ndarray, chunk_ids: np.ndarray, document_ids: np.ndarray):
+        """Write the files of a segment"""
+        if vectors.size == 0 and chunk_ids.size:
+            raise ValueError("Embeddings are missing for the indexed chunks")
+
+        np.save(self._path(segment_id, "vectors"), np.ascontiguousarray(vectors, dtype=np.float32))
+        np.save(self._path(segment_id, "chunk_ids"), chunk_ids)
+        np.save(self._path(segment_id, "document_ids"), document_ids)
+
+    def _publish(self, version: int, entries: List[Dict[str, Any]]):
+        """Swap the manifest to a new list of segments and remove the files no longer listed"""
+        previous = {entry["id"]: entry for entry in self._entries}
+
+        tmp_manifest_path = f"{self.manifest_path}.tmp"
+        with open(tmp_manifest_path, "w") as manifest_file:
+            json.dump({"version": version, "segments": entries}, manifest_file)
+        os.replace(tmp_manifest_path, self.manifest_path)
+
+        # Readers that still map the previous files keep them alive until they refresh
+        listed = {entry["id"] for entry in entries}
+        for segment_id, entry in previous.items():
+            if segment_id in listed or entry["count"] == 0:
+                continue
+            for name in ("vectors", "chunk_ids", "document_ids"):
+                try:
+                    os.remove(self._path(segment_id, name))
+                except FileNotFoundError:
+                    pass
+
+        self.refresh()
+        logger.info(f"Wrote vector index version {version} for account {self.account_id} "
+                    f"with {self.live_count} chunks in {len(entries)} segments")
+
+    def _path(self, segment_id: int, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.{segment_id}.npy")
+
+    @contextmanager
+    def _write_lock(self):
+        """Serialize writers of the same account across processes"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, List, NamedTuple, Optional, Set, Tuple
+
+import numpy as np
+
+from monitoring import get_registry, timed
+
+logger = logging.getLogger(__name__)
+
+COALESCED_REQUESTS = get_registry().counter(
+    "rag_coalesced_rankings_total", "Number of vector rankings requested", ("ranking",)
+)
+COALESCED_BATCHES = get_registry().counter(
+    "rag_coalesced_ranking_batches_total", "Number of batches the vector rankings were run in", ("ranking",)
+)
+
+
+class RankingRequest(NamedTuple):
+    """A vector ranking waiting for its batch"""
+    query_embedding: np.ndarray
+    account_id: int
+    top_k: int
+    with_embeddings: bool = False
+
+
+class RankingCoalescer:
+    """
+    Collects the vector rankings requested concurrently, e.g. by many chats at once, and runs them
+    as one batch: a single SQL statement or a single matrix product instead of one round trip each.
+
+    While no batch is running, requests are flushed on the next iteration of the event loop, so a lone
+    request does not wait and requests made in the same iteration, e.g. by the queries of one encoding
+    batch, share a batch. While a batch runs, the next one fills until it completes, it holds
+    `max_batch_size` requests, or its oldest request has waited `max_latency` seconds. A batch of one
+    request runs the single ranking.
+    """
+
+    def __init__(self, name: str, rank: Callable[[RankingRequest], Awaitable[List[Any]]],
+                 rank_batch: Callable[[List[RankingRequest]], Awaitable[List[List[Any]]]],
+                 max_batch_size: Optional[int] = None, max_latency: Optional[float] = None):
+        """
+        Initialize the coalescer
+
+        Parameters:
+            name: Labels the metrics of the coalescer, e.g. 'chunks'
+            rank: Runs one ranking on its own
+            rank_batch: Runs several rankings at once, returning the rows of each request in order
+            max_batch_size: Number of requests that triggers an immediate flush
+            max_latency: Maximum time in seconds a request waits for its batch to fill
+        """
+        self.name = name
+        self.rank_one = rank
+        self.rank_batch = rank_batch
+        self.max_batch_size = max_batch_size or int(os.getenv("RETRIEVAL_BATCH_SIZE", "32"))
+        if max_latency is None:
+            max_latency = float(os.getenv("RETRIEVAL_BATCH_WINDOW_MS", "5")) / 1000
+        self.max_latency = max_latency
+
+        self._pending: List[Tuple[RankingRequest, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._rank_tasks: Set[asyncio.Task] = set()
+
+    async def rank(self, query_embedding: np.ndarray, account_id: int, top_k: int,
+                   with_embeddings: bool = False) -> List[Any]:
+        """
+        Run a ranking as part of the next batch
+
+        Parameters:
+            query_embedding: The normalized query embedding
+            account_id: The account whose documents are searched
+            top_k: Number of results to return
+            with_embeddings: Also return the embedding of every result
+
+        Returns:
+            The rows of the ranking, closest first
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((RankingRequest(query_embedding, account_id, top_k, with_embeddings), future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_latency if self._rank_tasks else 0, self._flush)
+
+        return await future
+
+    def _flush(self):
+        """Close the pending batch and start ranking it"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        task = asyncio.get_running_loop().create_task(self._rank(pending))
+        self._rank_tasks.add(task)
+        task.add_done_callback(self._ranked)
+
+    def _ranked(self, task: asyncio.Task):
+        """Flush the requests that waited for a batch to complete"""
+        self._rank_tasks.discard(task)
+        if self._pending and not self._rank_tasks:
+            self._flush()
+
+    async def _rank(self, pending: List[Tuple[RankingRequest, asyncio.Future]]):
+        """Run every ranking of a batch at once and hand each request its rows"""
+        requests = [request for request, _ in pending]
+        COALESCED_REQUESTS.inc(len(requests), ranking=self.name)
+        COALESCED_BATCHES.inc(ranking=self.name)
+
+        try:
+            if len(requests) == 1:
+                results = [await self.rank_one(requests[0])]
+            else:
+                with timed(f"retrieval.rank_batch.{self.name}"):
+                    results = await self.rank_batch(requests)
+        except Exception as e:
+            logger.error(f"Error ranking batch of {len(requests)} {self.name} queries: {str(e)}")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        logger.debug(f"Ranked {self.name} for {len(requests)} queries at once")
+        for (_, future), rows in zip(pending, results):
+            if not future.done():
+                future.set_result(rows)